@@ -1,31 +1,37 @@
 # app/__init__.py
-import os
 import logging
-import sys
 from flask import Flask
+from .settings import get_settings
 
 def create_app(config_name=None):
     """
     Fábrica de la aplicación Flask.
     Configura y devuelve la instancia de la aplicación.
     """
+    # Configuración leída una vez del entorno; los módulos la consultan con get_settings()
+    settings = get_settings()
+    # Imports diferidos: run.py y python -m app importan app.settings (y con él este
+    # paquete) antes de cargar el .env, así que aquí no se importa nada que lea la
+    # configuración al importarse.
+    from .logging_config import configure_logging
+    from . import json_codec
+
     app = Flask(__name__)
+    # Codec JSON más rápido (orjson) para request.get_json()/jsonify si está disponible
+    json_codec.init_app(app)
 
     # Configuración de Logging
     # El nivel de log se puede controlar con la variable de entorno LOG_LEVEL
-    log_level_str = os.environ.get("LOG_LEVEL", "INFO").upper()
-    numeric_log_level = getattr(logging, log_level_str, logging.INFO)
+    numeric_log_level = getattr(logging, settings.log_level, logging.INFO)
     
-    # Configurar el logger raíz y el logger de la app Flask
-    # Usar sys.stdout para que los logs sean visibles en contenedores
-    logging.basicConfig(stream=sys.stdout,
-                        level=numeric_log_level,
-                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    # Configurar el logger raíz: salida a sys.stdout (visible en contenedores) a través
+    # de una cola no bloqueante, con enmascarado de datos sensibles, formato texto o
+    # JSON (LOG_FORMAT) y muestreo opcional de INFO por logger (LOG_SAMPLE_RATES).
+    configure_logging(numeric_log_level)
 
     # Asegurar que el logger de la app Flask también respete el nivel
     # y que el modo debug de Flask se alinee con FLASK_DEBUG.
-    is_debug_mode = os.environ.get("FLASK_DEBUG", "0").lower() in ("true", "1", "t")
-    app.debug = is_debug_mode # Configurar el modo debug de Flask
+    app.debug = settings.debug # Configurar el modo debug de Flask
     
     if app.debug:
         app.logger.setLevel(logging.DEBUG)
@@ -34,7 +40,15 @@ def create_app(config_name=None):
         app.logger.setLevel(logging.INFO)
         logging.getLogger('werkzeug').setLevel(logging.WARNING) # Menos verboso en producción
 
-    app.logger.info(f"Flask app '{app.name}' created. Debug mode: {app.debug}. Log level: {logging.getLevelName(app.logger.getEffectiveLevel())}")
+    app.logger.info("Flask app '%s' created. Debug mode: %s. Log level: %s",
+                    app.name, app.debug, logging.getLevelName(app.logger.getEffectiveLevel()))
+
+    # Detrás de un balanceador o ingress, request.remote_addr es la IP del proxy: con
+    # TRUSTED_PROXY_HOPS la del cliente se toma de X-Forwarded-For (y el esquema de
+    # X-Forwarded-Proto), contando solo esa cantidad de proxies de confianza.
+    if settings.trusted_proxy_hops > 0:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=settings.trusted_proxy_hops, x_proto=settings.trusted_proxy_hops)
 
 
     # Cargar configuración específica si es necesario (ej. desde un config.py)
@@ -44,12 +58,49 @@ def create_app(config_name=None):
     # elif config_name == 'production':
     #     app.config.from_object('config.ProductionConfig')
 
+    # Trazas: span raíz por solicitud (continúa el traceparent entrante), X-Request-ID
+    # en la respuesta y trace_id en cada línea de log. Las sondas y /metrics no se trazan.
+    probe_endpoints = ("health.liveness", "health.readiness_endpoint", "payments.health", "metrics.metrics_endpoint")
+    if settings.tracing_enabled:
+        from . import tracing
+        tracing.init_app(app, exclude_endpoints=probe_endpoints)
+
+    # Solicitudes en curso del proceso, para la saturación que informa /readyz
+    from .services import readiness
+    readiness.init_app(app, exclude_endpoints=probe_endpoints)
+
     # Registrar Blueprints
     with app.app_context():
+        # El registro de comercios se construye aquí (al consultarlo) y no en el primer
+        # pago: un error de configuración detiene el arranque
+        from .services.merchants import merchant_registry
+
         from .routes import payment_routes # Importar dentro del contexto o al inicio si no hay dependencias circulares
         app.register_blueprint(payment_routes.bp)
         app.logger.info("Payment routes blueprint registered.")
 
+        from .routes import health_routes
+        app.register_blueprint(health_routes.bp)
+
+        # Los workers de notificaciones se arrancan en cada proceso que atiende
+        # solicitudes (tras el fork de Gunicorn), y retoman lo pendiente en la cola.
+        # Sin secreto de notificaciones el endpoint las rechaza todas: no hay cola que atender.
+        if merchant_registry.with_notification_secret():
+            from .services.notification_queue import notification_queue
+            app.before_request(notification_queue.ensure_started)
+
+        # Igual con el despachador del outbox de pagos aceptados, si el modo está activo
+        if settings.payments_accept_mode != "off":
+            from .services.payment_outbox import payment_outbox
+            app.before_request(payment_outbox.ensure_started)
+
+        from . import metrics
+        metrics.configure(settings)
+        if metrics.ENABLED:
+            from .routes import metrics_routes
+            app.register_blueprint(metrics_routes.bp)
+            app.logger.info("Metrics blueprint registered at /metrics.")
+
         # Podrías registrar otros blueprints aquí
 
     app.logger.info("Flask application factory finished setup.")
@@ -0,0 +1,185 @@
+# app/asgi.py
+import time
+import logging
+from asgiref.wsgi import WsgiToAsgi
+from app.services import khipu_service
+from app.services import idempotency
+from app.services import rate_limit
+from app.settings import get_settings
+from app.services.merchants import merchant_registry
+from app.services.payment_outbox import payment_outbox, wants_accepted
+from app.routes.payment_routes import service_error_response, retry_after_headers, accepted_body, accepted_headers
+from app import metrics
+from app import tracing
+from app.services.readiness import worker_load
+from app import json_codec
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentsASGIApp:
+    """
+    Aplicación ASGI que atiende POST /v3/payments de forma nativa con asyncio
+    (ver `khipu_service.create_payment_intent_async`) y delega el resto de las
+    rutas a la aplicación Flask (WSGI) existente.
+
+    Mientras se espera a Khipu no se ocupa ningún hilo, así que un proceso puede
+    mantener cientos de llamadas en vuelo en lugar de una por hilo del worker.
+    """
+
+    PAYMENTS_PATH = "/v3/payments"
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self._wsgi = WsgiToAsgi(flask_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] == self.PAYMENTS_PATH:
+            started = time.perf_counter()
+            request_span, token = tracing.start_request_span(
+                f"POST {self.PAYMENTS_PATH}", _header(scope, b"traceparent"),
+                **{"http.method": "POST", "http.route": self.PAYMENTS_PATH})
+            send = _traced_send(send, request_span, _header(scope, b"x-request-id"))
+            status = 500
+            try:
+                with metrics.REQUESTS_IN_FLIGHT.labels(self.PAYMENTS_PATH).track_inprogress(), worker_load.track():
+                    status = await self._create_payment(scope, receive, send)
+            finally:
+                tracing.end_request_span(request_span, token, status)
+            metrics.REQUEST_DURATION.labels(self.PAYMENTS_PATH).observe(time.perf_counter() - started)
+            metrics.REQUESTS.labels(self.PAYMENTS_PATH, str(status)).inc()
+            return
+        await self._wsgi(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await merchant_registry.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _create_payment(self, scope, receive, send) -> int:
+        """Atiende POST /v3/payments y devuelve el código HTTP enviado."""
+        headers = dict(scope.get("headers") or [])
+        # Control de admisión por cliente, igual que en la ruta Flask
+        client_header = get_settings().rate_limit_client_header
+        client_header = headers.get(client_header.lower().encode("latin-1"), b"").decode("latin-1") if client_header else None
+        remote_addr = rate_limit.forwarded_client(headers.get(b"x-forwarded-for", b"").decode("latin-1"),
+                                                  (scope.get("client") or ("unknown",))[0], get_settings().trusted_proxy_hops)
+        try:
+            rate_limit.rate_limiter.admit_client(rate_limit.client_id_for(client_header, remote_addr))
+        except rate_limit.RateLimitExceeded as e:
+            logger.warning("Solicitud limitada en /v3/payments desde %s: %s", remote_addr, e)
+            await _send_json(send, {"error": str(e), "retry_after": round(e.retry_after, 3)}, 429,
+                             [(b"retry-after", rate_limit.retry_after_header(e.retry_after).encode("ascii"))])
+            return 429
+
+        content_type = headers.get(b"content-type", b"").decode("latin-1")
+        if not content_type.split(";")[0].strip().endswith("json"):
+            logger.warning("Solicitud a /v3/payments no es JSON.")
+            await _send_json(send, {"error": "El cuerpo de la solicitud debe ser JSON"}, 400)
+            return 400
+
+        body = await _read_body(receive)
+        try:
+            with metrics.stage("parse"):
+                client_data = json_codec.loads(body)
+        except ValueError:
+            logger.warning("Cuerpo JSON inválido en /v3/payments.")
+            await _send_json(send, {"error": "El cuerpo de la solicitud debe ser JSON"}, 400)
+            return 400
+        logger.debug("Ruta /v3/payments (asgi) recibió datos: %s", client_data)
+
+        try:
+            if not isinstance(client_data, dict):
+                raise khipu_service.KhipuServiceError("El cuerpo de la solicitud debe ser un objeto JSON", status_code=400)
+            tenant_header = get_settings().khipu_tenant_header.lower().encode("latin-1")
+            merchant = khipu_service.resolve_merchant(headers.get(tenant_header, b"").decode("latin-1") or None,
+                                                      client_data.get("currency"))
+            header_key = headers.get(b"idempotency-key", b"").decode("latin-1") or None
+            idempotency_key = idempotency.idempotency_key_for(header_key, client_data, merchant.name)
+            if wants_accepted(headers.get(b"prefer", b"").decode("latin-1")):
+                # Modo aceptado: el INSERT en SQLite (WAL) es sub-milisegundo, no vale la pena un hilo
+                submission, created = payment_outbox.accept(client_data, merchant, idempotency_key)
+                await _send_json(send, accepted_body(submission), 202,
+                                 [(name.lower().encode("ascii"), value.encode("ascii"))
+                                  for name, value in accepted_headers(submission, created).items()])
+                return 202
+            if idempotency_key is None:
+                khipu_response, replayed = await khipu_service.create_payment_intent_async(client_data, merchant), False
+            else:
+                khipu_response, replayed = await idempotency.payment_idempotency.execute_async(
+                    idempotency_key, lambda: khipu_service.create_payment_intent_async(client_data, merchant))
+            extra_headers = [(b"idempotent-replayed", b"true")] if replayed else []
+            with metrics.stage("serialize"):
+                response_body = json_codec.dumps(khipu_response)
+            await _send_body(send, response_body, 201, extra_headers)
+            return 201
+        except Exception as e:
+            error_body, status_code = service_error_response(e, logger)
+            extra_headers = [(name.lower().encode("ascii"), value.encode("ascii"))
+                             for name, value in retry_after_headers(e).items()]
+            await _send_json(send, error_body, status_code, extra_headers)
+            return status_code
+
+
+def _header(scope, name: bytes):
+    for key, value in scope.get("headers") or ():
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+def _traced_send(send, request_span, request_id):
+    """`send` que agrega X-Request-ID y traceresponse al inicio de la respuesta (como en Flask)."""
+    if request_span is None:
+        return send
+    trace_headers = [(b"x-request-id", (request_id or request_span.trace_id).encode("latin-1")),
+                     (b"traceresponse", request_span.traceparent.encode("ascii"))]
+
+    async def send_with_trace(message):
+        if message["type"] == "http.response.start":
+            message = dict(message, headers=[*message.get("headers", ()), *trace_headers])
+        await send(message)
+    return send_with_trace
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+async def _send_json(send, data, status_code: int, extra_headers=()):
+    await _send_body(send, json_codec.dumps(data), status_code, extra_headers)
+
+
+async def _send_body(send, body: bytes, status_code: int, extra_headers=()):
+    await send({
+        "type": "http.response.start",
+        "status": status_code,
+        "headers": [(b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode("ascii")),
+                    *extra_headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def create_asgi_app(flask_app=None):
+    """
+    Fábrica de la aplicación ASGI. Si no se pasa una aplicación Flask,
+    se crea una con `create_app()`.
+    """
+    if flask_app is None:
+        from app import create_app
+        flask_app = create_app()
+    return PaymentsASGIApp(flask_app)
@@ -0,0 +1,68 @@
+# app/json_codec.py
+import json
+from flask.json.provider import DefaultJSONProvider
+from app.settings import get_settings
+
+# Codec JSON de la aplicación. Usa orjson si está instalado, salvo JSON_CODEC=stdlib.
+try:
+    import orjson
+except ImportError: # orjson es opcional: sin él se usa el módulo json de la stdlib
+    orjson = None
+
+# Lo fija init_app según JSON_CODEC (la configuración no se lee al importar el módulo)
+USE_ORJSON = orjson is not None
+
+
+def dumps(obj) -> bytes:
+    """Serializa a bytes UTF-8 (listo para enviar como cuerpo HTTP)."""
+    if USE_ORJSON:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data):
+    """Deserializa desde bytes o str."""
+    if USE_ORJSON:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    Proveedor JSON de Flask basado en orjson, para `request.get_json()` y `jsonify`.
+    Mantiene sort_keys/compact del proveedor por defecto y su `default` para tipos
+    que orjson no conoce (Decimal, etc.).
+    """
+
+    def dumps(self, obj, **kwargs) -> str:
+        return self._dumps_bytes(obj, **kwargs).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def _dumps_bytes(self, obj, **kwargs) -> bytes:
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.pop("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.pop("indent", None):
+            option |= orjson.OPT_INDENT_2
+        kwargs.pop("ensure_ascii", None)
+        if kwargs:
+            # Opciones que orjson no soporta (cls, separators, ...): usar la stdlib
+            return super().dumps(obj, **kwargs).encode("utf-8")
+        return orjson.dumps(obj, default=self.default, option=option)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = None
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            indent = 2
+        return self._app.response_class(self._dumps_bytes(obj, indent=indent) + b"\n", mimetype=self.mimetype)
+
+
+def init_app(app):
+    """Elige el codec según JSON_CODEC e instala el proveedor orjson en la app Flask si corresponde."""
+    global USE_ORJSON
+    USE_ORJSON = orjson is not None and get_settings().json_codec != "stdlib"
+    if USE_ORJSON:
+        app.json = OrjsonProvider(app)
@@ -0,0 +1,198 @@
+# app/logging_config.py
+import os
+import re
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+from app.settings import get_settings
+from app.tracing import current_span
+
+# Constantes
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s%(_trace)s'
+
+# Atributos estándar de LogRecord; el resto se considera "extra" y va al JSON
+_RESERVED_RECORD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+# Cabeceras y datos personales que nunca deben llegar a los logs
+_REDACTIONS = (
+    (re.compile(r"""(['"]?(?:x-api-key|authorization|api[_-]?key)['"]?\s*[:=]\s*)(['"]?)[^'",}\s]+""", re.IGNORECASE),
+     r"\1\2[REDACTED]"),
+    (re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}"), "[EMAIL]"),
+)
+_SENSITIVE_HEADERS = frozenset({"x-api-key", "authorization", "cookie", "set-cookie"})
+
+
+def redact(text: str) -> str:
+    """Enmascara API keys y emails en un texto ya formateado."""
+    for pattern, replacement in _REDACTIONS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def redact_headers(headers) -> dict:
+    """Copia de las cabeceras con los valores sensibles enmascarados."""
+    return {k: ("[REDACTED]" if k.lower() in _SENSITIVE_HEADERS else v) for k, v in dict(headers).items()}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formatea cada registro como una línea JSON (incluye los campos pasados en `extra`)."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "pid": record.process,
+            "thread": record.threadName,
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class RedactingFilter(logging.Filter):
+    """
+    Formatea el mensaje (en el hilo del listener, no en el de la solicitud)
+    y enmascara los datos sensibles antes de escribirlo.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.msg = redact(record.getMessage())
+        record.args = None
+        return True
+
+
+class TraceContextFilter(logging.Filter):
+    """
+    Agrega al registro el trace_id y span_id del span actual. Corre en el hilo que
+    registra (el contexto de la traza no existe en el hilo del listener).
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        active = current_span()
+        if active is None:
+            record._trace = ""
+        else:
+            record.trace_id = active.trace_id
+            record.span_id = active.span_id
+            record._trace = f" [trace_id={active.trace_id}]"
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Muestreo por logger para los registros INFO (p. ej. líneas de éxito del camino caliente).
+    WARNING y superiores siempre pasan. La tasa se toma del prefijo de logger más largo que coincida.
+    """
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+        self._cache = {}
+
+    def _rate_for(self, name: str) -> float:
+        rate = self._cache.get(name)
+        if rate is None:
+            rate, best = 1.0, -1
+            for prefix, prefix_rate in self.rates.items():
+                if (name == prefix or name.startswith(prefix + ".")) and len(prefix) > best:
+                    rate, best = prefix_rate, len(prefix)
+            self._cache[name] = rate
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno != logging.INFO:
+            return True
+        rate = self._rate_for(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler que nunca bloquea al hilo de la solicitud: encola el registro sin
+    formatearlo (el formateo ocurre en el listener) y lo descarta si la cola está llena.
+    """
+
+    dropped = 0
+
+    def prepare(self, record):
+        # En proceso no hace falta serializar; se difiere el formateo al listener
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+
+def parse_sample_rates(spec: str) -> dict:
+    """Convierte "app.services.khipu_service=0.1,app=0.5" en {logger: tasa}."""
+    rates = {}
+    for item in (spec or "").split(","):
+        if "=" not in item:
+            continue
+        name, _, value = item.partition("=")
+        try:
+            rates[name.strip()] = min(max(float(value), 0.0), 1.0)
+        except ValueError:
+            continue
+    return rates
+
+
+_listener = None
+
+
+def _start_listener(handler: NonBlockingQueueHandler, output_handler: logging.Handler):
+    global _listener
+    handler.queue = queue.Queue(maxsize=get_settings().log_queue_size)
+    _listener = logging.handlers.QueueListener(handler.queue, output_handler, respect_handler_level=True)
+    _listener.start()
+
+
+def configure_logging(level: int):
+    """
+    Configura el logging del proceso (idempotente):
+
+    - LOG_FORMAT=json para una línea JSON por registro; por defecto, texto.
+    - Los registros se encolan sin formatear y un hilo listener los escribe en stdout,
+      así los hilos de las solicitudes nunca esperan por I/O.
+    - API keys y emails se enmascaran antes de escribirse.
+    - Cada registro lleva el trace_id de la solicitud en curso (ver app/tracing.py).
+    - LOG_SAMPLE_RATES permite muestrear los INFO por logger (ej. "app.services.khipu_service=0.1").
+    """
+    settings = get_settings()
+    root = logging.getLogger()
+    root.setLevel(level)
+    if any(isinstance(h, NonBlockingQueueHandler) for h in root.handlers):
+        return
+
+    output_handler = logging.StreamHandler(sys.stdout)
+    if settings.log_format == "json":
+        output_handler.setFormatter(JsonFormatter())
+    else:
+        output_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    output_handler.addFilter(RedactingFilter())
+
+    queue_handler = NonBlockingQueueHandler(None)
+    # Antes de encolar: vincula cada línea de log con la traza de la solicitud
+    queue_handler.addFilter(TraceContextFilter())
+    sample_rates = parse_sample_rates(settings.log_sample_rates)
+    if sample_rates:
+        queue_handler.addFilter(SamplingFilter(sample_rates))
+    root.addHandler(queue_handler)
+
+    _start_listener(queue_handler, output_handler)
+    atexit.register(lambda: _listener.stop())
+    if hasattr(os, "register_at_fork"):
+        # El hilo listener no sobrevive al fork (p. ej. workers con preload): se crea uno nuevo
+        os.register_at_fork(after_in_child=lambda: _start_listener(queue_handler, output_handler))
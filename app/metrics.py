@@ -0,0 +1,480 @@
+# app/metrics.py
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Métricas en memoria del proceso con exposición en formato de texto de Prometheus.
+# Con METRICS_ENABLED=0 todas las operaciones son no-ops y /metrics no se registra.
+# ENABLED y MULTIPROCESS los fija configure() (create_app), no la importación del módulo.
+ENABLED = True
+
+# Varios procesos (workers de Gunicorn; app/server.py la define): con METRICS_MULTIPROC_DIR
+# cada proceso vuelca sus series a <dir>/metrics-<pid>.json cada FLUSH_INTERVAL_SECONDS, y
+# /metrics, lo atienda el worker que lo atienda, suma las de todos. Los contadores e
+# histogramas de workers ya terminados se conservan (se compactan en un archivo aparte);
+# los gauges solo cuentan los procesos vivos.
+FLUSH_INTERVAL_SECONDS = 1.0
+
+DEFAULT_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                           0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=None) -> str:
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def labels(self, *labelvalues):
+        """Devuelve (creándola si hace falta) la serie para esos valores de etiqueta."""
+        child = self._children.get(labelvalues)
+        if child is None:
+            with self._lock:
+                child = self._children.get(labelvalues)
+                if child is None:
+                    child = self._children[labelvalues] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def snapshot(self) -> list:
+        """Series del proceso como [[valores de etiqueta], valor] serializables en JSON."""
+        return [[list(labelvalues), child.snapshot()] for labelvalues, child in list(self._children.items())]
+
+    def merge(self, children: dict, snapshot: list, live: bool = True):
+        """Suma a `children` (valores de etiqueta -> serie nueva) un snapshot de otro proceso."""
+        for labelvalues, value in snapshot:
+            labelvalues = tuple(labelvalues)
+            child = children.get(labelvalues)
+            if child is None:
+                child = children[labelvalues] = self._new_child()
+            child.merge(value)
+
+    def render(self, children: dict = None) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for labelvalues, child in sorted((self._children if children is None else children).items()):
+            lines.extend(child.render(self.name, self.labelnames, labelvalues))
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ("_value", "_lock")
+
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        if not ENABLED:
+            return
+        with self._lock:
+            self._value += amount
+
+    def snapshot(self):
+        return self._value
+
+    def merge(self, value):
+        self._value += value
+
+    def render(self, name, labelnames, labelvalues):
+        return [f"{name}_total{_format_labels(labelnames, labelvalues)} {_format_value(self._value)}"]
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+
+class _GaugeChild:
+    __slots__ = ("_value", "_lock")
+
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        if not ENABLED:
+            return
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.inc(-amount)
+
+    def set(self, value: float):
+        if ENABLED:
+            self._value = float(value)
+
+    def snapshot(self):
+        return self._value
+
+    def merge(self, value):
+        self._value += value
+
+    @contextmanager
+    def track_inprogress(self):
+        self.inc()
+        try:
+            yield
+        finally:
+            self.dec()
+
+    def render(self, name, labelnames, labelvalues):
+        return [f"{name}{_format_labels(labelnames, labelvalues)} {_format_value(self._value)}"]
+
+
+class Gauge(_Metric):
+    """
+    Gauge por proceso. Al sumar procesos (METRICS_MULTIPROC_DIR) solo cuentan los
+    vivos; `multiprocess_mode="max"` toma el máximo en lugar de la suma.
+    """
+    type_name = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, multiprocess_mode: str = "sum"):
+        self.multiprocess_mode = multiprocess_mode
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def merge(self, children: dict, snapshot: list, live: bool = True):
+        if not live:
+            return
+        if self.multiprocess_mode != "max":
+            return super().merge(children, snapshot)
+        for labelvalues, value in snapshot:
+            child = children.setdefault(tuple(labelvalues), self._new_child())
+            child._value = max(child._value, value)
+
+
+class _HistogramChild:
+    __slots__ = ("_upper_bounds", "_counts", "_sum", "_lock")
+
+    def __init__(self, upper_bounds):
+        self._upper_bounds = upper_bounds
+        self._counts = [0] * (len(upper_bounds) + 1) # El último es +Inf
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        if not ENABLED:
+            return
+        index = bisect.bisect_left(self._upper_bounds, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def snapshot(self):
+        return [list(self._counts), self._sum]
+
+    def merge(self, value):
+        counts, total = value
+        if len(counts) == len(self._counts):
+            self._counts = [a + b for a, b in zip(self._counts, counts)]
+            self._sum += total
+
+    def render(self, name, labelnames, labelvalues):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self._upper_bounds + (float("inf"),), self._counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{_format_labels(labelnames, labelvalues, ('le', _format_value(bound)))} {cumulative}")
+        labels = _format_labels(labelnames, labelvalues)
+        lines.append(f"{name}_sum{labels} {_format_value(self._sum)}")
+        lines.append(f"{name}_count{labels} {cumulative}")
+        return lines
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collect_hooks = []
+
+    def register(self, metric: _Metric):
+        self._metrics.append(metric)
+
+    def on_collect(self, hook):
+        """Registra `hook()`, que actualiza gauges derivados de otro estado antes de cada exposición o volcado."""
+        self._collect_hooks.append(hook)
+        return hook
+
+    def _collect(self):
+        for hook in self._collect_hooks:
+            hook()
+
+    def render(self) -> str:
+        self._collect()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        self._collect()
+        return {metric.name: metric.snapshot() for metric in self._metrics}
+
+    def merge(self, snapshots) -> dict:
+        """Suma snapshots de varios procesos (tuplas (snapshot, vivo)): nombre -> series."""
+        merged = {metric.name: {} for metric in self._metrics}
+        for snapshot, live in snapshots:
+            for metric in self._metrics:
+                if metric.name in snapshot:
+                    metric.merge(merged[metric.name], snapshot[metric.name], live)
+        return merged
+
+    def render_merged(self, snapshots) -> str:
+        merged = self.merge(snapshots)
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render(merged[metric.name]))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+# Métricas del pipeline de pagos
+REQUESTS = Counter("payments_requests", "Solicitudes atendidas por ruta y código HTTP", ("route", "status"))
+REQUEST_DURATION = Histogram("payments_request_duration_seconds", "Latencia total por ruta", ("route",))
+REQUESTS_IN_FLIGHT = Gauge("payments_requests_in_flight", "Solicitudes en curso por ruta", ("route",))
+STAGE_DURATION = Histogram("payments_stage_duration_seconds",
+                           "Latencia por etapa: parse, validate, upstream, serialize", ("stage",))
+UPSTREAM_RESPONSES = Counter("khipu_upstream_responses", "Respuestas de Khipu por código HTTP", ("status_code",))
+UPSTREAM_IN_FLIGHT = Gauge("khipu_upstream_in_flight", "Llamadas a Khipu en curso")
+ERRORS = Counter("payments_errors", "Errores por clase (subtipos de KhipuServiceError)", ("error",))
+STATUS_CACHE_LOOKUPS = Counter("payment_status_cache_lookups",
+                               "Consultas de estado por resultado de caché (hit, miss, coalesced)", ("result",))
+RATE_LIMITED = Counter("payments_rate_limited",
+                       "Solicitudes rechazadas por control de admisión (client, global, concurrency)", ("scope",))
+CIRCUIT_OPEN = Gauge("khipu_circuit_open", "1 si el circuit breaker de Khipu del comercio está abierto (en algún worker)",
+                     ("merchant",), multiprocess_mode="max")
+
+
+def stage(name: str):
+    """Context manager que mide la duración de una etapa del pipeline de pagos."""
+    return STAGE_DURATION.labels(name).time()
+
+
+class _MultiprocessStore:
+    """
+    Snapshots de cada proceso en un directorio compartido (ver METRICS_MULTIPROC_DIR).
+    Al exponer, los archivos de procesos terminados se compactan en metrics-archive.json
+    (solo contadores e histogramas) bajo un flock, para que el directorio no crezca
+    con cada worker reciclado.
+    """
+
+    ARCHIVE = "metrics-archive.json"
+
+    def __init__(self, directory: str, registry: Registry):
+        self.directory = directory
+        self.registry = registry
+        self._started_pid = None
+
+    def _path(self, pid: int) -> str:
+        return os.path.join(self.directory, f"metrics-{pid}.json")
+
+    @staticmethod
+    def _write(path: str, data: dict):
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, path) # Reemplazo atómico: quien expone nunca lee un archivo a medias
+
+    @staticmethod
+    def _read(path: str):
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def flush(self):
+        """Vuelca las series de este proceso."""
+        try:
+            self._write(self._path(os.getpid()), self.registry.snapshot())
+        except OSError as e:
+            logger.warning("No se pudieron volcar las métricas a %s: %s", self.directory, e)
+
+    def ensure_started(self):
+        """Hilo que vuelca las series del proceso periódicamente (uno por pid; seguro tras fork)."""
+        if self._started_pid == os.getpid():
+            return
+        self._started_pid = os.getpid()
+        os.makedirs(self.directory, exist_ok=True)
+        threading.Thread(target=self._run, name="metrics-flush", daemon=True).start()
+
+    def _run(self):
+        while True:
+            self.flush()
+            time.sleep(FLUSH_INTERVAL_SECONDS)
+
+    def collect(self) -> list:
+        """Snapshots de todos los procesos como tuplas (snapshot, vivo), compactando los terminados."""
+        self.flush()
+        with open(os.path.join(self.directory, ".lock"), "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            archive_path = os.path.join(self.directory, self.ARCHIVE)
+            archive = self._read(archive_path) or {}
+            snapshots, archived = [], []
+            for entry in os.scandir(self.directory):
+                name = entry.name
+                if not (name.startswith("metrics-") and name.endswith(".json")) or name == self.ARCHIVE:
+                    continue
+                snapshot = self._read(entry.path)
+                if snapshot is None:
+                    continue
+                pid = name[len("metrics-"):-len(".json")]
+                if not pid.isdigit():
+                    continue
+                if _pid_alive(int(pid)):
+                    snapshots.append((snapshot, True))
+                else:
+                    archived.append((entry.path, snapshot))
+            if archived:
+                merged = self.registry.merge([(archive, False)] + [(snapshot, False) for _, snapshot in archived])
+                archive = {name: [[list(labelvalues), child.snapshot()] for labelvalues, child in children.items()]
+                           for name, children in merged.items() if children}
+                self._write(archive_path, archive)
+                for path, _ in archived:
+                    os.unlink(path)
+        snapshots.append((archive, False))
+        return snapshots
+
+    def clear(self):
+        """Borra los snapshots de una ejecución anterior (lo llama el master al arrancar)."""
+        if not os.path.isdir(self.directory):
+            return
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith("metrics-") and entry.name.endswith(".json"):
+                os.unlink(entry.path)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+MULTIPROCESS = None
+
+
+def configure(settings):
+    """Aplica METRICS_ENABLED y METRICS_MULTIPROC_DIR (idempotente; create_app y app/server.py lo llaman)."""
+    global ENABLED, MULTIPROCESS
+    ENABLED = settings.metrics_enabled
+    if MULTIPROCESS is not None or not (ENABLED and settings.metrics_multiproc_dir):
+        return
+    MULTIPROCESS = _MultiprocessStore(settings.metrics_multiproc_dir, REGISTRY)
+    MULTIPROCESS.ensure_started()
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=MULTIPROCESS.ensure_started)
+
+
+def render_latest() -> str:
+    """Exposición de /metrics: la suma de todos los workers con METRICS_MULTIPROC_DIR; si no, la del proceso."""
+    if MULTIPROCESS is not None:
+        return REGISTRY.render_merged(MULTIPROCESS.collect())
+    return REGISTRY.render()
+
+
+def flush():
+    """Vuelca las series del proceso antes de que termine (app/server.py, al salir cada worker)."""
+    if MULTIPROCESS is not None:
+        MULTIPROCESS.flush()
+
+
+def track_request(route: str):
+    """
+    Decorador para vistas Flask: mide la latencia total, las solicitudes en curso
+    y cuenta las respuestas por código HTTP. Las respuestas en streaming (lotes) se
+    miden hasta enviar el último byte, no hasta que la vista devuelve la respuesta.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return view(*args, **kwargs)
+            started = time.perf_counter()
+            status = 500
+            in_flight = REQUESTS_IN_FLIGHT.labels(route)
+            in_flight.inc()
+            streamed = False
+            try:
+                result = view(*args, **kwargs)
+                response = result[0] if isinstance(result, tuple) else result
+                status = result[1] if isinstance(result, tuple) else getattr(result, "status_code", 200)
+                if getattr(response, "is_streamed", False):
+                    response.call_on_close(lambda: _finish_request(route, status, started, in_flight))
+                    streamed = True
+                return result
+            finally:
+                if not streamed:
+                    _finish_request(route, status, started, in_flight)
+        return wrapper
+    return decorator
+
+
+def _finish_request(route: str, status, started: float, in_flight):
+    in_flight.dec()
+    REQUEST_DURATION.labels(route).observe(time.perf_counter() - started)
+    REQUESTS.labels(route, str(status)).inc()
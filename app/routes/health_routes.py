@@ -0,0 +1,22 @@
+# app/routes/health_routes.py
+from flask import Blueprint, jsonify
+from app.services import readiness
+
+# Sondas del orquestador (Kubernetes, balanceador). Responden desde memoria, sin log
+# por solicitud, sin trazas y sin llamar a Khipu.
+bp = Blueprint('health', __name__)
+
+@bp.route('/livez', methods=['GET'])
+def liveness():
+    """El proceso atiende solicitudes. No depende de Khipu: un fallo aquí reinicia el contenedor."""
+    return jsonify({"status": "alive"}), 200
+
+
+@bp.route('/readyz', methods=['GET'])
+def readiness_endpoint():
+    """
+    El proceso puede recibir tráfico: 503 si está saturado o si Khipu no está
+    disponible para ningún comercio (ver readiness.readiness).
+    """
+    body, ready = readiness.readiness()
+    return jsonify(body), 200 if ready else 503
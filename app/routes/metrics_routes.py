@@ -0,0 +1,18 @@
+# app/routes/metrics_routes.py
+from flask import Blueprint, Response
+from app import metrics
+from app.services import khipu_service
+
+# Blueprint para exponer las métricas en formato de texto de Prometheus
+bp = Blueprint('metrics', __name__)
+
+@metrics.REGISTRY.on_collect
+def _update_circuit_gauges():
+    for merchant, breaker_stats in khipu_service.get_circuit_breaker_stats().items():
+        metrics.CIRCUIT_OPEN.labels(merchant).set(1 if breaker_stats["state"] == "open" else 0)
+
+
+@bp.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Métricas de todos los workers con METRICS_MULTIPROC_DIR (app/server.py lo define); si no, las del proceso."""
+    return Response(metrics.render_latest(), mimetype="text/plain; version=0.0.4")
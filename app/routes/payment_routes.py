@@ -1,6 +1,18 @@
 # app/routes/payment_routes.py
-from flask import Blueprint, request, jsonify, current_app
+import json
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Blueprint, request, jsonify, current_app, Response, stream_with_context
+from app.settings import get_settings
 from app.services import khipu_service # Importar el servicio de Khipu
+from app.services import idempotency
+from app.services import rate_limit
+from app.services.notification_queue import notification_queue
+from app.services.payment_status_cache import payment_status_cache
+from app.services.payment_outbox import payment_outbox, wants_accepted, STATUS_PATH
+from app.services.merchants import merchant_registry
+from app import metrics
+from app import json_codec
 
 # Crear un Blueprint para las rutas de pago
 # El primer argumento es el nombre del blueprint, el segundo es el __name__ del módulo,
@@ -8,7 +20,46 @@ from app.services import khipu_service # Importar el servicio de Khipu
 # Dado que tus rutas originales eran /v3/payments, usaremos /v3 como prefijo.
 bp = Blueprint('payments', __name__, url_prefix='/v3')
 
+# Rutas que terminan en llamadas a Khipu: pasan por el token bucket del cliente.
+# El lote se cobra dentro de la vista, un token por pago (ver handle_create_payment_batch).
+RATE_LIMITED_ENDPOINTS = frozenset(("payments.handle_create_payment", "payments.handle_get_payment"))
+
+
+def _tenant():
+    """Tenant indicado por el cliente (KHIPU_TENANT_HEADER), o None."""
+    return request.headers.get(get_settings().khipu_tenant_header)
+
+
+def _currency_of(data):
+    return data.get("currency") if isinstance(data, dict) else None
+
+
+def _client_id() -> str:
+    client_header = get_settings().rate_limit_client_header
+    return rate_limit.client_id_for(request.headers.get(client_header) if client_header else None, request.remote_addr)
+
+
+def _admit_client(cost: float = 1.0):
+    """:return: Respuesta 429 con Retry-After si el bucket del cliente está vacío; si no, None."""
+    try:
+        rate_limit.rate_limiter.admit_client(_client_id(), cost)
+    except rate_limit.RateLimitExceeded as e:
+        current_app.logger.warning("Solicitud limitada en %s desde %s: %s", request.path, request.remote_addr, e)
+        return jsonify({"error": str(e), "retry_after": round(e.retry_after, 3)}), 429, \
+            {"Retry-After": rate_limit.retry_after_header(e.retry_after)}
+    return None
+
+
+@bp.before_request
+def admission_control():
+    """Control de admisión por cliente, antes de leer el cuerpo de la solicitud."""
+    if request.endpoint in RATE_LIMITED_ENDPOINTS:
+        return _admit_client()
+    return None
+
+
 @bp.route('/payments', methods=['POST'])
+@metrics.track_request("/v3/payments")
 def handle_create_payment():
     """
     Manejador de la ruta para crear un nuevo pago a través de Khipu.
@@ -17,33 +68,281 @@ def handle_create_payment():
         current_app.logger.warning("Solicitud a /v3/payments no es JSON.")
         return jsonify({"error": "El cuerpo de la solicitud debe ser JSON"}), 400
 
-    client_data = request.get_json()
-    current_app.logger.info(f"Ruta /v3/payments recibió datos: {client_data}")
+    with metrics.stage("parse"):
+        client_data = request.get_json()
+    current_app.logger.debug("Ruta /v3/payments recibió datos: %s", client_data)
 
     try:
-        khipu_response = khipu_service.create_payment_intent(client_data)
+        # Comercio por tenant o por moneda: credenciales, límites y conexiones propias
+        merchant = khipu_service.resolve_merchant(_tenant(), _currency_of(client_data))
+        # Reintentos del cliente con la misma clave reciben la respuesta ya obtenida de Khipu
+        idempotency_key = idempotency.idempotency_key_for(request.headers.get("Idempotency-Key"), client_data, merchant.name)
+        if wants_accepted(request.headers.get("Prefer")):
+            # Modo aceptado: se valida, se guarda en el outbox y se responde sin esperar a Khipu
+            submission, created = payment_outbox.accept(client_data, merchant, idempotency_key)
+            return jsonify(accepted_body(submission)), 202, accepted_headers(submission, created)
+        if idempotency_key is None:
+            khipu_response, replayed = khipu_service.create_payment_intent(client_data, merchant), False
+        else:
+            khipu_response, replayed = idempotency.payment_idempotency.execute(
+                idempotency_key, lambda: khipu_service.create_payment_intent(client_data, merchant))
         # Si create_payment_intent es exitoso, devuelve los datos de Khipu y un 201.
-        return jsonify(khipu_response), 201
-    except khipu_service.KhipuConfigError as e:
-        current_app.logger.error(f"Error de configuración de Khipu: {e}")
-        return jsonify({"error": str(e)}), e.status_code or 500
-    except khipu_service.KhipuServiceError as e: # Captura KhipuRequestError, KhipuConnectionError también
-        current_app.logger.error(f"Error del servicio Khipu: {e} - Data: {e.khipu_response_data}")
+        with metrics.stage("serialize"):
+            response = jsonify(khipu_response)
+        if replayed:
+            current_app.logger.info("Respuesta idempotente reutilizada para la clave %s", idempotency_key)
+            response.headers["Idempotent-Replayed"] = "true"
+        return response, 201
+    except Exception as e:
+        return _error_response(e)
+
+
+@bp.route('/payments/<payment_id>', methods=['GET'])
+@metrics.track_request("/v3/payments/<payment_id>")
+def handle_get_payment(payment_id):
+    """
+    Devuelve el estado de un pago desde la caché read-through (ver payment_status_cache).
+    La cabecera `X-Cache` indica si se respondió desde caché (HIT), con una consulta
+    propia a Khipu (MISS) o esperando la de otra solicitud concurrente (COALESCED).
+    Sin cabecera de tenant se consulta con el comercio por defecto.
+    """
+    try:
+        payment_status, cache_result = payment_status_cache.get(payment_id, khipu_service.resolve_merchant(_tenant()))
+    except Exception as e:
+        return _error_response(e)
+    response = jsonify(payment_status)
+    response.headers["X-Cache"] = cache_result.upper()
+    return response, 200
+
+
+@bp.route('/payments/accepted/<tracking_id>', methods=['GET'])
+@metrics.track_request("/v3/payments/accepted/<tracking_id>")
+def handle_get_accepted_payment(tracking_id):
+    """
+    Estado de un pago aceptado (modo PAYMENTS_ACCEPT_MODE): pending, processing,
+    done (con la respuesta de Khipu en "payment"), failed (con el error en "error")
+    o unknown (envío interrumpido; el pago pudo haberse creado en Khipu).
+    """
+    submission = payment_outbox.get(tracking_id)
+    if submission is None:
+        return jsonify({"error": "Pago aceptado no encontrado"}), 404
+    return jsonify(submission), 200
+
+
+def accepted_body(submission: dict) -> dict:
+    """Cuerpo del 202 del modo aceptado. Compartido con app/asgi.py."""
+    return {"status": submission["status"], "tracking_id": submission["tracking_id"],
+            "status_url": STATUS_PATH.format(submission["tracking_id"])}
+
+
+def accepted_headers(submission: dict, created: bool) -> dict:
+    headers = {"Location": STATUS_PATH.format(submission["tracking_id"]), "Preference-Applied": "respond-async"}
+    if not created:
+        headers["Idempotent-Replayed"] = "true"
+    return headers
+
+
+def _error_response(e: Exception):
+    body, status_code = service_error_response(e, current_app.logger)
+    return jsonify(body), status_code, retry_after_headers(e)
+
+
+def retry_after_headers(e: Exception) -> dict:
+    """Cabecera Retry-After para los rechazos que indican cuándo reintentar (circuito abierto, límites)."""
+    retry_after = getattr(e, "retry_after", None)
+    return {"Retry-After": rate_limit.retry_after_header(retry_after)} if retry_after is not None else {}
+
+
+def service_error_response(e: Exception, log) -> tuple:
+    """
+    Traduce una excepción del servicio Khipu a (cuerpo, código HTTP).
+    Compartido por la vista Flask y el punto de entrada ASGI (app/asgi.py).
+    """
+    metrics.ERRORS.labels(type(e).__name__).inc()
+    if isinstance(e, khipu_service.KhipuConfigError):
+        log.error("Error de configuración de Khipu: %s", e)
+        return {"error": str(e)}, e.status_code or 500
+    if isinstance(e, khipu_service.KhipuServiceError): # Incluye KhipuRequestError y KhipuConnectionError
+        log.error("Error del servicio Khipu: %s - Data: %s", e, e.khipu_response_data)
         # Devolver el error de Khipu si está disponible y es un diccionario (JSON)
         if isinstance(e.khipu_response_data, dict):
-            return jsonify(e.khipu_response_data), e.status_code or 400
-        else: # Sino, un error genérico con el mensaje
-            return jsonify({"error": str(e), "details": e.khipu_response_data}), e.status_code or 400
-    except Exception as e: # Captura cualquier otra excepción inesperada
-        current_app.logger.error(f"Error inesperado en la ruta de creación de pago: {str(e)}", exc_info=True)
-        return jsonify({"error": "Error interno del servidor al procesar el pago"}), 500
+            return e.khipu_response_data, e.status_code or 400
+        # Sino, un error genérico con el mensaje
+        return {"error": str(e), "details": e.khipu_response_data}, e.status_code or 400
+    # Cualquier otra excepción inesperada
+    log.error("Error inesperado en la ruta de creación de pago: %s", e, exc_info=True)
+    return {"error": "Error interno del servidor al procesar el pago"}, 500
+
+
+@bp.route('/payments/batch', methods=['POST'])
+@metrics.track_request("/v3/payments/batch")
+def handle_create_payment_batch():
+    """
+    Crea varios pagos en una sola solicitud.
+
+    Acepta un arreglo JSON o NDJSON (`application/x-ndjson`, un pago por línea).
+    Todos los pagos se validan antes de llamar a Khipu; si alguno es inválido se
+    rechaza el lote completo con 400. El lote consume del bucket del cliente un
+    token por pago (como máximo la ráfaga permitida). Luego se envían a Khipu con concurrencia
+    acotada (`?concurrency=N`) y cada resultado se devuelve como una línea NDJSON
+    apenas termina, con su `index` en el lote original.
+    """
+    try:
+        items = _parse_batch_items()
+    except ValueError as e:
+        current_app.logger.warning("Lote inválido en /v3/payments/batch: %s", e)
+        return jsonify({"error": str(e)}), 400
+
+    settings = get_settings()
+    max_items = settings.batch_max_items
+    if not items:
+        return jsonify({"error": "El lote no contiene pagos"}), 400
+    if len(items) > max_items:
+        return jsonify({"error": f"El lote excede el máximo de {max_items} pagos"}), 413
+    limited = _admit_client(min(len(items), rate_limit.rate_limiter.client_burst))
+    if limited is not None:
+        return limited
+
+    # Validación completa por adelantado: ningún pago llega a Khipu si el lote tiene errores
+    validation_errors = []
+    merchants = []
+    tenant = _tenant()
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise khipu_service.KhipuServiceError("Cada pago debe ser un objeto JSON", status_code=400)
+            merchant = khipu_service.resolve_merchant(tenant, item.get("currency"))
+            khipu_service._prepare_khipu_payload(item, merchant)
+            merchants.append(merchant)
+        except khipu_service.KhipuServiceError as e:
+            validation_errors.append({"index": index, "status": e.status_code or 400, "error": str(e)})
+    if validation_errors:
+        current_app.logger.warning("Lote rechazado: %s de %s pagos inválidos", len(validation_errors), len(items))
+        return jsonify({"error": "Pagos inválidos en el lote", "items": validation_errors}), 400
+
+    concurrency = request.args.get("concurrency", default=settings.batch_concurrency, type=int)
+    concurrency = max(1, min(concurrency, settings.batch_max_concurrency, len(items)))
+    current_app.logger.info("Procesando lote de %s pagos con concurrencia %s", len(items), concurrency)
+
+    # El generador corre al transmitir la respuesta: se le pasa el contexto de la vista (span actual)
+    batch = _run_batch(items, merchants, concurrency, contextvars.copy_context())
+    return Response(stream_with_context(batch), status=200, mimetype="application/x-ndjson")
+
+
+def _parse_batch_items() -> list:
+    """Lee los pagos del lote desde un arreglo JSON o desde NDJSON."""
+    mimetype = request.mimetype or ""
+    if mimetype in ("application/x-ndjson", "application/ndjson", "application/jsonl"):
+        items = []
+        for line_number, line in enumerate(request.get_data(as_text=True).splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                items.append(json_codec.loads(line))
+            except ValueError:
+                raise ValueError(f"Línea {line_number} no es JSON válido")
+        return items
+    if request.is_json:
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            raise ValueError("El cuerpo debe ser un arreglo JSON de pagos")
+        return items
+    raise ValueError("El cuerpo de la solicitud debe ser un arreglo JSON o NDJSON")
+
+
+def _create_batch_item(item: dict, merchant) -> dict:
+    """Crea un pago del lote, respetando la idempotencia por transaction_id."""
+    idempotency_key = idempotency.idempotency_key_for(None, item, merchant.name)
+    if idempotency_key is None:
+        return khipu_service.create_payment_intent(item, merchant)
+    khipu_response, _ = idempotency.payment_idempotency.execute(
+        idempotency_key, lambda: khipu_service.create_payment_intent(item, merchant))
+    return khipu_response
+
+
+def _run_batch(items: list, merchants: list, concurrency: int, context: contextvars.Context):
+    """Genera una línea NDJSON por pago, en el orden en que terminan."""
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="khipu-batch")
+    try:
+        # Cada pago corre en una copia del contexto de la vista: sus spans quedan bajo la traza del lote
+        futures = {executor.submit(context.copy().run, _create_batch_item, item, merchant): index
+                   for index, (item, merchant) in enumerate(zip(items, merchants))}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                line = {"index": index, "status": 201, "result": future.result()}
+            except Exception as e:
+                body, status_code = service_error_response(e, current_app.logger)
+                line = {"index": index, "status": status_code, "error": body}
+            yield json_codec.dumps(line) + b"\n"
+    finally:
+        # Si el cliente corta la conexión no se envían los pagos pendientes
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+@bp.route('/notifications', methods=['POST'])
+@metrics.track_request("/v3/notifications")
+def handle_payment_notification():
+    """
+    Recibe las notificaciones de Khipu (notify_url, notify_api_version 3.0).
+
+    Solo verifica la firma y guarda la notificación en la cola durable; el
+    procesamiento ocurre en segundo plano, así Khipu recibe el 200 en pocos
+    milisegundos y nada se pierde si el proceso se reinicia. La firma identifica
+    al comercio (cada uno tiene su secreto).
+    """
+    if not merchant_registry.with_notification_secret():
+        current_app.logger.error("Ningún comercio tiene secreto de notificaciones; notificación rechazada.")
+        return jsonify({"error": "Receptor de notificaciones no configurado"}), 500
+
+    raw_body = request.get_data(cache=False)
+    merchant = khipu_service.notification_merchant(raw_body, request.headers.get("x-khipu-signature"))
+    if merchant is None:
+        current_app.logger.warning("Notificación con firma inválida desde %s", request.remote_addr)
+        return jsonify({"error": "Firma inválida"}), 401
+
+    try:
+        payload = json.loads(raw_body)
+    except ValueError:
+        return jsonify({"error": "El cuerpo de la notificación debe ser JSON"}), 400
+    if not isinstance(payload, dict):
+        return jsonify({"error": "El cuerpo de la notificación debe ser un objeto JSON"}), 400
+
+    notification_id = notification_queue.enqueue(dict(payload, _merchant=merchant.name))
+    # El estado del pago cambió: la próxima consulta debe ir a Khipu
+    if payload.get("payment_id"):
+        payment_status_cache.invalidate(str(payload["payment_id"]), merchant)
+    notification_queue.ensure_started()
+    return jsonify({"status": "received", "id": notification_id}), 200
 
 
 @bp.route('/health_check_payments', methods=['GET']) # Ruta de salud específica del blueprint
 def health():
-    """Ruta de salud para el blueprint de pagos."""
-    current_app.logger.info("Ruta /v3/health_check_payments alcanzada.")
-    return jsonify({"status": "OK", "message": "Servicio de Pagos Khipu (Blueprint) funcionando"}), 200
+    """
+    Ruta de salud para el blueprint de pagos.
+    Responde 503 mientras los circuit breakers de Khipu de todos los comercios están
+    abiertos, para que el balanceador deje de enviar pagos que fallarían de todos
+    modos; con un solo comercio caído, los demás siguen atendiendo. Con
+    PAYMENTS_ACCEPT_MODE="always" los pagos se siguen aceptando en el outbox.
+
+    Es el diagnóstico detallado del proceso; para las sondas del orquestador usar
+    /livez y /readyz (app/routes/health_routes.py), que no consultan SQLite.
+    """
+    settings = get_settings()
+    breaker_stats = khipu_service.get_circuit_breaker_stats()
+    open_merchants = sorted(name for name, stats in breaker_stats.items() if stats["state"] == "open")
+    is_open = len(open_merchants) == len(breaker_stats) and settings.payments_accept_mode != "always"
+    body = {
+        "status": "DEGRADED" if is_open else "OK",
+        "message": "Khipu API no disponible (circuito abierto)" if is_open else "Servicio de Pagos Khipu (Blueprint) funcionando",
+        "open_circuits": open_merchants,
+        "http_pool": khipu_service.get_http_pool_stats(),
+        "circuit_breaker": breaker_stats,
+        "payment_status_cache": payment_status_cache.stats(),
+        "admission": khipu_service.get_admission_stats(),
+    }
+    if settings.payments_accept_mode != "off":
+        body["payment_outbox"] = payment_outbox.stats()
+    return jsonify(body), 503 if is_open else 200
 
-# Podrías añadir aquí otras rutas relacionadas con pagos de Khipu si las necesitas,
-# como obtener estado de un pago, etc.
+# Podrías añadir aquí otras rutas relacionadas con pagos de Khipu si las necesitas.
@@ -0,0 +1,179 @@
+# app/server.py
+"""
+Lanzador de producción: Gunicorn multi-proceso alrededor de create_app().
+
+    python -m app.server
+
+Modos (SERVER_MODE):
+  - wsgi (por defecto): workers gthread (procesos x hilos) sirviendo la app Flask.
+  - asgi: workers Uvicorn (asyncio) sirviendo app/asgi.py; POST /v3/payments no
+    ocupa un hilo mientras espera a Khipu.
+
+Recarga sin cortes: `kill -HUP <pid del master>` reemplaza los workers de forma
+gradual. Con preload (por defecto) el código se carga en el master, así que para
+desplegar código nuevo se usa USR2 (nuevo master) seguido de QUIT al master anterior.
+"""
+import os
+import math
+import tempfile
+import multiprocessing
+from gunicorn.app.base import BaseApplication
+from app.settings import _env_str, _env_bool, _env_number
+
+# Constantes (valores por defecto, sobreescribibles por variables de entorno)
+DEFAULT_THREADS = 4
+DEFAULT_KEEPALIVE_SECONDS = 5
+DEFAULT_TIMEOUT_SECONDS = 60          # Mayor que el plazo total hacia Khipu (35 s)
+DEFAULT_GRACEFUL_TIMEOUT_SECONDS = 30
+DEFAULT_MAX_REQUESTS = 10000
+DEFAULT_MAX_REQUESTS_JITTER = 1000
+
+
+def _env_int(name: str, default: int) -> int:
+    return _env_number(os.environ, name, default, int)
+
+
+def _cgroup_cpu_limit():
+    """CPUs de la cuota del contenedor (cgroup v2 cpu.max o v1 cfs_quota_us), o None si no hay límite."""
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        return quota / period if quota > 0 and period > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+def available_cpus() -> int:
+    """
+    CPUs que el proceso puede usar: las de su afinidad (cpuset), recortadas a la cuota
+    del cgroup redondeada hacia arriba. cpu_count() cuenta las del host, y en un
+    contenedor limitado a 2 CPUs de un host de 64 daría 129 workers gthread.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError: # macOS / Windows
+        cpus = multiprocessing.cpu_count()
+    limit = _cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, max(1, math.ceil(limit)))
+    return max(1, cpus)
+
+
+def default_workers(mode: str) -> int:
+    """
+    Workers por defecto según CPUs disponibles: (2 x CPU) + 1 para gthread, que pasa
+    buena parte del tiempo esperando a Khipu; 1 por CPU para asyncio, que ya
+    multiplexa en un proceso.
+    """
+    cpus = available_cpus()
+    return cpus if mode == "asgi" else cpus * 2 + 1
+
+
+def build_options() -> dict:
+    """Opciones de Gunicorn a partir de variables de entorno."""
+    mode = _env_str(os.environ, "SERVER_MODE", "wsgi").lower()
+    host = _env_str(os.environ, "HOST", _env_str(os.environ, "FLASK_RUN_HOST", "0.0.0.0"))
+    port = _env_int("PORT", _env_int("FLASK_RUN_PORT", 8000))
+
+    options = {
+        "bind": f"{host}:{port}",
+        "workers": _env_int("WEB_CONCURRENCY", default_workers(mode)),
+        "keepalive": _env_int("GUNICORN_KEEPALIVE", DEFAULT_KEEPALIVE_SECONDS),
+        "timeout": _env_int("GUNICORN_TIMEOUT", DEFAULT_TIMEOUT_SECONDS),
+        "graceful_timeout": _env_int("GUNICORN_GRACEFUL_TIMEOUT", DEFAULT_GRACEFUL_TIMEOUT_SECONDS),
+        # Reciclar workers cada N solicitudes (con jitter para no reiniciarlos todos a la vez)
+        "max_requests": _env_int("GUNICORN_MAX_REQUESTS", DEFAULT_MAX_REQUESTS),
+        "max_requests_jitter": _env_int("GUNICORN_MAX_REQUESTS_JITTER", DEFAULT_MAX_REQUESTS_JITTER),
+        # Cargar la app en el master antes del fork: arranque más rápido y memoria compartida (copy-on-write)
+        "preload_app": _env_bool(os.environ, "GUNICORN_PRELOAD", True),
+        "accesslog": "-" if _env_bool(os.environ, "GUNICORN_ACCESS_LOG", False) else None,
+        "errorlog": "-",
+        "loglevel": _env_str(os.environ, "GUNICORN_LOG_LEVEL", "info"),
+        "proc_name": "khipu-payments",
+        "worker_exit": worker_exit,
+    }
+    if os.path.isdir("/dev/shm"):
+        options["worker_tmp_dir"] = "/dev/shm" # Heartbeat en memoria, no en el overlay del contenedor
+
+    if mode == "asgi":
+        options["worker_class"] = "uvicorn_worker.UvicornWorker"
+    else:
+        options["worker_class"] = "gthread"
+        options["threads"] = _env_int("GUNICORN_THREADS", DEFAULT_THREADS)
+    return options
+
+
+def worker_exit(server, worker):
+    """
+    Hook de Gunicorn en el worker que termina (SIGTERM, reciclado por max_requests):
+    el despachador del outbox deja de reclamar pagos y espera los envíos en curso,
+    en lugar de morir con el proceso a mitad de una llamada a Khipu, y las métricas
+    del worker se vuelcan por última vez para que /metrics las siga sumando.
+    """
+    from app.services.payment_outbox import payment_outbox
+    from app import metrics
+    payment_outbox.stop()
+    metrics.flush()
+
+
+class ProductionServer(BaseApplication):
+    """Aplicación Gunicorn embebida que carga la app con la fábrica del proyecto."""
+
+    def __init__(self, options: dict):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if value is not None and key in self.cfg.settings:
+                self.cfg.set(key, value)
+
+    def load(self):
+        from app import create_app
+        from app.services.readiness import worker_load
+        flask_app = create_app()
+        # Hilos por worker: /readyz informa la saturación frente a este límite
+        worker_load.capacity = self.options.get("threads")
+        if self.cfg.preload_app:
+            # Con preload, cargar en el master las dependencias que el resto del código
+            # importa de forma diferida: los workers las heredan compartidas (copy-on-write)
+            import requests # noqa: F401
+        if self.options.get("worker_class") == "uvicorn_worker.UvicornWorker":
+            from app.asgi import create_asgi_app
+            return create_asgi_app(flask_app)
+        return flask_app
+
+
+def _metrics_dir(port: int) -> str:
+    """Directorio compartido por los workers para sumar sus métricas en /metrics (ver app/metrics.py)."""
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(base, f"khipu-payments-metrics-{port}")
+
+
+def main():
+    options = build_options()
+    # Cada worker tiene sus propias métricas: se vuelcan a un directorio común y
+    # /metrics devuelve la suma. Los snapshots de una ejecución anterior se borran.
+    os.environ.setdefault("METRICS_MULTIPROC_DIR", _metrics_dir(options["bind"].rsplit(":", 1)[-1]))
+    from app.settings import get_settings
+    from app import metrics
+    metrics.configure(get_settings())
+    if metrics.MULTIPROCESS is not None:
+        metrics.MULTIPROCESS.clear()
+    print(f"Starting production server on {options['bind']} "
+          f"(worker_class={options['worker_class']}, workers={options['workers']}, threads={options.get('threads', 1)})")
+    ProductionServer(options).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+# app/services/circuit_breaker.py
+import time
+import random
+import threading
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """La llamada se rechazó sin intentarla porque el circuito está abierto."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Circuito '{name}' abierto; reintentar en {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker de ventana deslizante (por cantidad de llamadas).
+
+    - CLOSED: las llamadas pasan. Si en las últimas `window_size` llamadas (con al menos
+      `minimum_calls`) la tasa de errores o de llamadas lentas supera su umbral, se abre.
+    - OPEN: las llamadas fallan de inmediato con CircuitOpenError durante `open_seconds`.
+    - HALF_OPEN: se dejan pasar hasta `half_open_max_calls` llamadas de prueba. Si todas
+      terminan bien se cierra; si alguna falla se vuelve a abrir.
+
+    Seguro entre hilos. Se usa con `before_call()` y luego `record_success()`, `record_failure()` o,
+    si la llamada no terminó, `release()`.
+    """
+
+    def __init__(self, name: str, failure_rate_threshold: float = 0.5, slow_call_rate_threshold: float = 0.8,
+                 slow_call_seconds: float = 10.0, window_size: int = 20, minimum_calls: int = 10,
+                 open_seconds: float = 15.0, half_open_max_calls: int = 3):
+        self.name = name
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.minimum_calls = minimum_calls
+        self.open_seconds = open_seconds
+        self.half_open_max_calls = half_open_max_calls
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._window = deque(maxlen=window_size) # (failed, slow)
+        self._opened_at = 0.0
+        self._half_open_in_flight = 0
+        self._half_open_successes = 0
+        self._rejected = 0
+        self._transitions = {}
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._maybe_half_open()
+            return self._state
+
+    def before_call(self):
+        """
+        Reserva el permiso para una llamada.
+        :raises CircuitOpenError: Si el circuito está abierto o sin cupo de prueba.
+        """
+        with self._lock:
+            self._maybe_half_open()
+            if self._state == CLOSED:
+                return
+            if self._state == HALF_OPEN and self._half_open_in_flight < self.half_open_max_calls:
+                self._half_open_in_flight += 1
+                return
+            self._reject()
+
+    def check(self):
+        """
+        Como `before_call()` pero sin reservar nada: para rechazar antes de esperar
+        otros recursos (cola, cuota). Con el circuito cerrado no toma el lock.
+        :raises CircuitOpenError: Si el circuito está abierto o sin cupo de prueba.
+        """
+        if self._state == CLOSED:
+            return
+        with self._lock:
+            self._maybe_half_open()
+            if self._state == CLOSED or (self._state == HALF_OPEN and self._half_open_in_flight < self.half_open_max_calls):
+                return
+            self._reject()
+
+    def record_success(self, duration: float):
+        with self._lock:
+            slow = duration >= self.slow_call_seconds
+            if self._state == HALF_OPEN:
+                self._half_open_in_flight = max(self._half_open_in_flight - 1, 0)
+                if slow:
+                    self._transition(OPEN)
+                    return
+                self._half_open_successes += 1
+                if self._half_open_successes >= self.half_open_max_calls:
+                    self._transition(CLOSED)
+                return
+            self._window.append((False, slow))
+            self._evaluate()
+
+    def record_failure(self, duration: float):
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._half_open_in_flight = max(self._half_open_in_flight - 1, 0)
+                self._transition(OPEN)
+                return
+            self._window.append((True, duration >= self.slow_call_seconds))
+            self._evaluate()
+
+    def release(self):
+        """
+        Devuelve el permiso de `before_call()` sin registrar un resultado, para llamadas
+        que no terminaron (p. ej. canceladas con CancelledError): una prueba de
+        HALF_OPEN sin liberar dejaría el circuito sin cupo de prueba para siempre.
+        """
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._half_open_in_flight = max(self._half_open_in_flight - 1, 0)
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._maybe_half_open()
+            calls = len(self._window)
+            failures = sum(1 for failed, _ in self._window if failed)
+            slow_calls = sum(1 for _, slow in self._window if slow)
+            stats = {
+                "name": self.name,
+                "state": self._state,
+                "window_calls": calls,
+                "failure_rate": round(failures / calls, 3) if calls else 0.0,
+                "slow_call_rate": round(slow_calls / calls, 3) if calls else 0.0,
+                "rejected_calls": self._rejected,
+                "transitions": dict(self._transitions),
+            }
+            if self._state == OPEN:
+                stats["retry_after_seconds"] = round(max(self._opened_at + self.open_seconds - time.monotonic(), 0.0), 3)
+            return stats
+
+    # Los métodos siguientes se llaman con self._lock tomado
+
+    def _reject(self):
+        self._rejected += 1
+        retry_after = max(self._opened_at + self.open_seconds - time.monotonic(), 0.0)
+        raise CircuitOpenError(self.name, retry_after)
+
+    def _evaluate(self):
+        calls = len(self._window)
+        if self._state != CLOSED or calls < self.minimum_calls:
+            return
+        failures = sum(1 for failed, _ in self._window if failed)
+        slow_calls = sum(1 for _, slow in self._window if slow)
+        if failures / calls >= self.failure_rate_threshold or slow_calls / calls >= self.slow_call_rate_threshold:
+            self._transition(OPEN)
+
+    def _maybe_half_open(self):
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._transition(HALF_OPEN)
+
+    def _transition(self, new_state: str):
+        key = f"{self._state}->{new_state}"
+        self._transitions[key] = self._transitions.get(key, 0) + 1
+        logger.warning("Circuit breaker '%s': %s", self.name, key)
+        self._state = new_state
+        if new_state == OPEN:
+            self._opened_at = time.monotonic()
+        elif new_state == HALF_OPEN:
+            self._half_open_in_flight = 0
+            self._half_open_successes = 0
+        elif new_state == CLOSED:
+            self._window.clear()
+
+
+def backoff_delay(attempt: int, base_seconds: float, max_seconds: float) -> float:
+    """Backoff exponencial con jitter completo: uniforme en [0, min(max, base * 2^attempt)]."""
+    return random.uniform(0, min(max_seconds, base_seconds * (2 ** attempt)))
@@ -0,0 +1,163 @@
+# app/services/http_session.py
+import os
+import threading
+import logging
+from app.settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+# Tamaños de pool y timeouts: ver app/settings.py (KHIPU_HTTP_POOL_CONNECTIONS,
+# KHIPU_HTTP_POOL_MAXSIZE, KHIPU_ASYNC_MAX_CONNECTIONS, KHIPU_*_TIMEOUT_SECONDS).
+# requests y httpx se importan al crear la sesión/cliente, no al importar el módulo:
+# el arranque del proceso no paga su costo hasta la primera llamada a Khipu.
+# Cada comercio tiene su propia sesión y cliente asíncrono (ver merchants.py).
+
+
+def get_timeouts() -> tuple:
+    """
+    Devuelve la tupla (connect, read) de timeouts para requests.
+    Se configuran con KHIPU_CONNECT_TIMEOUT_SECONDS y KHIPU_READ_TIMEOUT_SECONDS.
+    """
+    settings = get_settings()
+    return settings.connect_timeout_seconds, settings.read_timeout_seconds
+
+
+class PooledSession:
+    """
+    Sesión HTTP de larga vida, una por proceso y comercio, con pool de conexiones keep-alive.
+
+    Es segura frente a fork: si el proceso actual no es el que creó la sesión
+    (p. ej. un worker de Gunicorn con preload), se descarta y se crea una nueva,
+    de modo que nunca se comparten sockets entre procesos.
+    """
+
+    def __init__(self, pool_connections=None, pool_maxsize=None):
+        self._pool_connections = pool_connections
+        self._pool_maxsize = pool_maxsize
+        self._lock = threading.Lock()
+        self._session = None
+        self._adapter = None
+        self._pid = None
+
+    def _build(self):
+        import requests # Import diferido (ver arriba)
+        from requests.adapters import HTTPAdapter
+
+        settings = get_settings()
+        pool_connections = self._pool_connections or settings.http_pool_connections
+        pool_maxsize = self._pool_maxsize or settings.http_pool_maxsize
+
+        # max_retries=0: los reintentos (si los hay) se deciden en la capa de servicio.
+        # pool_block=False: si el pool se agota se abre una conexión extra en lugar de bloquear.
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=0)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        self._session = session
+        self._adapter = adapter
+        self._pid = os.getpid()
+        logger.info("Sesión HTTP creada (pid=%s, pool_connections=%s, pool_maxsize=%s)",
+                    self._pid, pool_connections, pool_maxsize)
+
+    def get(self):
+        """Devuelve la `requests.Session` del proceso actual, creándola si es necesario."""
+        session = self._session
+        if session is not None and self._pid == os.getpid():
+            return session
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                self._build()
+            return self._session
+
+    def reset_after_fork(self):
+        """Descarta la sesión heredada del proceso padre sin cerrar sus sockets."""
+        self._lock = threading.Lock()
+        self._session = None
+        self._adapter = None
+        self._pid = None
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+            self._adapter = None
+            self._pid = None
+
+    def stats(self) -> dict:
+        """
+        Estadísticas del pool: solicitudes totales, conexiones nuevas y reutilizadas,
+        y conexiones en uso por host.
+        """
+        result = {"pid": os.getpid(), "requests": 0, "new_connections": 0,
+                  "reused_connections": 0, "hosts": {}}
+        adapter = self._adapter
+        if adapter is None or self._pid != os.getpid():
+            return result
+
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            idle_slots = pool.pool.qsize() if pool.pool is not None else 0
+            host_stats = {
+                "requests": pool.num_requests,
+                "new_connections": pool.num_connections,
+                "reused_connections": max(pool.num_requests - pool.num_connections, 0),
+                "maxsize": pool.pool.maxsize if pool.pool is not None else 0,
+                "in_use": max((pool.pool.maxsize if pool.pool is not None else 0) - idle_slots, 0),
+            }
+            result["hosts"][f"{pool.scheme}://{pool.host}:{pool.port}"] = host_stats
+            result["requests"] += host_stats["requests"]
+            result["new_connections"] += host_stats["new_connections"]
+            result["reused_connections"] += host_stats["reused_connections"]
+        return result
+
+
+class AsyncPooledClient:
+    """
+    Cliente `httpx.AsyncClient` de larga vida para el camino asyncio (ASGI).
+
+    Un AsyncClient queda ligado al event loop que lo usa, así que se mantiene uno
+    por loop y por proceso. Usa los mismos tamaños de pool y timeouts que la sesión síncrona.
+    """
+
+    def __init__(self, max_connections=None):
+        self._max_connections = max_connections
+        self._client = None
+        self._loop = None
+        self._pid = None
+
+    def get(self):
+        """Devuelve el cliente del loop actual. Debe llamarse desde una corrutina."""
+        import asyncio
+        import httpx # Import diferido: solo el camino asyncio necesita httpx
+
+        loop = asyncio.get_running_loop()
+        if self._client is not None and self._loop is loop and self._pid == os.getpid():
+            return self._client
+
+        settings = get_settings()
+        max_connections = self._max_connections or settings.async_max_connections
+        connect_timeout, read_timeout = get_timeouts()
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=settings.http_pool_maxsize),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        )
+        self._loop = loop
+        self._pid = os.getpid()
+        logger.info("Cliente HTTP asíncrono creado (pid=%s, max_connections=%s)", self._pid, max_connections)
+        return self._client
+
+    def reset_after_fork(self):
+        self._client = None
+        self._loop = None
+        self._pid = None
+
+    async def aclose(self):
+        if self._client is not None and self._pid == os.getpid():
+            await self._client.aclose()
+        self.reset_after_fork()
@@ -0,0 +1,217 @@
+# app/services/idempotency.py
+import time
+import threading
+import logging
+from collections import OrderedDict
+from app.settings import get_settings, ProcessSingleton
+from app.services.khipu_service import KhipuServiceError
+
+logger = logging.getLogger(__name__)
+
+# Constantes (valores por defecto; el ejecutor de pagos usa IDEMPOTENCY_* de app/settings.py)
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+DEFAULT_WAIT_TIMEOUT_SECONDS = 40 # Algo más que el timeout de lectura hacia Khipu
+
+
+class IdempotencyStore:
+    """
+    Interfaz del almacén de respuestas idempotentes.
+
+    La implementación por defecto vive en memoria del proceso. Para compartir las
+    respuestas entre workers se puede conectar otro backend (Redis, memcached, SQL...)
+    implementando `get` y `set` y registrándolo con `set_store()`.
+    """
+
+    def get(self, key: str):
+        """Devuelve el valor guardado para `key`, o None si no existe o expiró."""
+        raise NotImplementedError
+
+    def set(self, key: str, value, ttl_seconds: float):
+        """Guarda `value` para `key` durante `ttl_seconds` segundos."""
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        """Elimina `key` si existe."""
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {}
+
+
+class InMemoryLRUStore(IdempotencyStore):
+    """Almacén LRU acotado en memoria, con expiración por TTL. Seguro entre hilos."""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value, ttl_seconds: float):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "entries": len(self._entries), "max_entries": self.max_entries}
+
+
+class _Flight:
+    """Llamada en curso para una clave; los duplicados esperan su resultado."""
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class IdempotentExecutor:
+    """
+    Ejecuta una operación a lo sumo una vez por clave de idempotencia.
+
+    - Si la clave ya tiene una respuesta guardada, se devuelve sin llamar a la operación.
+    - Si hay una llamada en curso para la misma clave (en este proceso), los duplicados
+      concurrentes esperan su resultado en lugar de lanzar otra (single-flight).
+    - Solo se guardan los resultados exitosos; los errores se propagan a quienes esperaban.
+    """
+
+    def __init__(self, store: IdempotencyStore, ttl_seconds: float = DEFAULT_TTL_SECONDS,
+                 wait_timeout_seconds: float = DEFAULT_WAIT_TIMEOUT_SECONDS):
+        self.store = store
+        self.ttl_seconds = ttl_seconds
+        self.wait_timeout_seconds = wait_timeout_seconds
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._async_inflight = {}
+
+    def execute(self, key: str, fn) -> tuple:
+        """
+        :return: Tupla (resultado, replayed). `replayed` es True si el resultado
+                 proviene de otra solicitud con la misma clave.
+        :raises KhipuServiceError: (409) si la llamada original no termina a tiempo.
+        """
+        cached = self.store.get(key)
+        if cached is not None:
+            return cached, True
+
+        with self._lock:
+            flight = self._inflight.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = self._inflight[key] = _Flight()
+
+        if not is_leader:
+            logger.info("Solicitud duplicada en curso para la clave de idempotencia %s; esperando resultado.", key)
+            if not flight.event.wait(self.wait_timeout_seconds):
+                raise KhipuServiceError("Hay una solicitud en curso con la misma clave de idempotencia", status_code=409)
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            # Otra solicitud pudo terminar entre la consulta al store y el registro de la llamada
+            cached = self.store.get(key)
+            if cached is not None:
+                flight.result = cached
+                return cached, True
+            result = fn()
+            self.store.set(key, result, self.ttl_seconds)
+            flight.result = result
+            return result, False
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.event.set()
+
+    async def execute_async(self, key: str, coro_fn) -> tuple:
+        """Equivalente de `execute` para el camino asyncio; `coro_fn` devuelve una corrutina."""
+        import asyncio # Import diferido: solo el camino ASGI lo necesita
+
+        cached = self.store.get(key)
+        if cached is not None:
+            return cached, True
+
+        future = self._async_inflight.get(key)
+        if future is not None:
+            try:
+                result = await asyncio.wait_for(asyncio.shield(future), self.wait_timeout_seconds)
+            except asyncio.TimeoutError:
+                raise KhipuServiceError("Hay una solicitud en curso con la misma clave de idempotencia", status_code=409)
+            return result, True
+
+        future = self._async_inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await coro_fn()
+            self.store.set(key, result, self.ttl_seconds)
+            future.set_result(result)
+            return result, False
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception() # Marcar como consultada si nadie más esperaba
+            raise
+        finally:
+            self._async_inflight.pop(key, None)
+
+    def stats(self) -> dict:
+        stats = dict(self.store.stats())
+        stats["inflight"] = len(self._inflight) + len(self._async_inflight)
+        return stats
+
+
+# Ejecutor compartido por el proceso para la creación de pagos
+def _build_payment_idempotency() -> IdempotentExecutor:
+    settings = get_settings()
+    return IdempotentExecutor(
+        InMemoryLRUStore(settings.idempotency_max_entries),
+        ttl_seconds=settings.idempotency_ttl_seconds,
+        wait_timeout_seconds=settings.idempotency_wait_timeout_seconds,
+    )
+
+
+payment_idempotency = ProcessSingleton(_build_payment_idempotency)
+
+
+def set_store(store: IdempotencyStore):
+    """Reemplaza el backend del ejecutor de pagos (p. ej. por uno compartido entre workers)."""
+    payment_idempotency.store = store
+
+
+def idempotency_key_for(header_key, client_data, merchant_name: str = None) -> str:
+    """
+    Clave de idempotencia de una solicitud de pago: el valor de la cabecera
+    `Idempotency-Key` o, en su defecto, el `transaction_id` del payload, dentro
+    del espacio del comercio (dos comercios pueden repetir transaction_id).
+    None si no hay ninguna.
+    """
+    prefix = f"{merchant_name}/" if merchant_name else ""
+    if header_key:
+        return f"{prefix}key:{header_key.strip()}"
+    transaction_id = client_data.get("transaction_id") if isinstance(client_data, dict) else None
+    if transaction_id:
+        return f"{prefix}tx:{transaction_id}"
+    return None
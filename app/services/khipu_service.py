@@ -1,7 +1,20 @@
 # app/services/khipu_service.py
-import os
-import requests
+import re
+import time
+import hmac
+import base64
+import hashlib
 import logging
+from app.settings import get_settings
+from app.services.http_session import get_timeouts
+from app.services.circuit_breaker import CircuitOpenError, backoff_delay
+from app.services.rate_limit import rate_limiter, RateLimitExceeded, ConcurrencyLimitExceeded
+from app.services.merchants import merchant_registry
+from app.logging_config import redact_headers
+from app import metrics
+from app import tracing
+from app import json_codec
+from app.services.validation import ValidationError
 
 # Obtener el logger configurado por la fábrica de la aplicación
 # Es mejor obtener el logger específico del módulo actual.
@@ -9,16 +22,30 @@ logger = logging.getLogger(__name__)
 # Si __name__ es 'app.services.khipu_service', usará la configuración raíz si no hay una específica.
 
 # Constantes
-DEFAULT_KHIPU_TARGET_API_URL = "https://payment-api.khipu.com"
-DEFAULT_NOTIFY_API_VERSION = "1.3"
-REQUEST_TIMEOUT_SECONDS = 30
+# La notify_api_version por defecto, las monedas aceptadas y el esquema de validación son
+# por comercio (ver merchants.py).
+# Los timeouts de conexión y lectura se configuran por separado en http_session
+# (KHIPU_CONNECT_TIMEOUT_SECONDS / KHIPU_READ_TIMEOUT_SECONDS).
+
+# Reintentos: solo errores transitorios, con backoff exponencial con jitter y
+# dentro de un plazo total por solicitud (KHIPU_MAX_RETRIES, KHIPU_RETRY_BACKOFF_*,
+# KHIPU_REQUEST_DEADLINE_SECONDS; ver app/settings.py).
+# Un POST (creación de pago) solo se reintenta si Khipu seguro no lo procesó: 429 y
+# 503, o un error antes de enviar la solicitud (conexión rechazada, DNS, timeout de
+# conexión). Tras un 502/504, un timeout de lectura o una conexión cortada después
+# del envío el pago pudo haberse creado, y reintentarlo podría duplicarlo.
+TRANSIENT_STATUS_CODES = (429, 502, 503, 504) # Consultas (GET, idempotentes)
+POST_RETRY_STATUS_CODES = (429, 503)
+# Identificadores de pago aceptados en la consulta de estado (evita inyectar rutas en la URL de Khipu)
+PAYMENT_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
 
 class KhipuServiceError(Exception):
     """Excepción base para errores del servicio Khipu."""
-    def __init__(self, message, status_code=None, khipu_response_data=None):
+    def __init__(self, message, status_code=None, khipu_response_data=None, retryable=False):
         super().__init__(message)
         self.status_code = status_code
         self.khipu_response_data = khipu_response_data
+        self.retryable = retryable # True si reintentar la llamada a Khipu tiene sentido
 
 class KhipuConfigError(KhipuServiceError):
     """Error si la configuración de Khipu (ej. API Key) falta."""
@@ -32,134 +59,518 @@ class KhipuConnectionError(KhipuServiceError):
     """Error de conexión con la API de Khipu."""
     pass
 
+class KhipuCircuitOpenError(KhipuConnectionError):
+    """Khipu no se llamó porque el circuit breaker está abierto (fallo rápido)."""
+    def __init__(self, message, retry_after=None):
+        super().__init__(message, status_code=503)
+        self.retry_after = retry_after
 
-def _prepare_khipu_payload(client_data: dict) -> dict:
-    """
-    Prepara y valida el payload para enviar a la API de Khipu.
-    Aplica lógica de negocio como validación de moneda y monto.
+class KhipuRateLimitError(KhipuServiceError):
+    """Khipu no se llamó por control de admisión: cuota global agotada (429) o demasiadas llamadas en curso (503)."""
+    def __init__(self, message, status_code=429, retry_after=None):
+        super().__init__(message, status_code=status_code)
+        self.retry_after = retry_after
+
+
+def resolve_merchant(tenant: str = None, currency=None):
     """
-    subject = client_data.get("subject")
-    amount_str = client_data.get("amount")
-    currency = client_data.get("currency")
+    Comercio que atiende la solicitud: el del tenant si se indica; si no, el que
+    acepta la moneda del pago; si no hay moneda, el comercio por defecto.
 
-    if not all([subject, amount_str, currency]):
-        logger.warning(f"Faltan campos obligatorios para Khipu. Recibido: subject='{subject}', amount='{amount_str}', currency='{currency}'")
-        raise KhipuServiceError("Faltan campos obligatorios: subject, amount, currency", status_code=400)
+    :raises KhipuServiceError: (400) si el tenant no existe o ningún comercio acepta la moneda.
+    """
+    # Vienen del cliente: una lista u objeto JSON no se puede buscar en el registro
+    if tenant is not None and not isinstance(tenant, str):
+        raise KhipuServiceError("El tenant debe ser texto", status_code=400)
+    if currency is not None and not isinstance(currency, str):
+        raise KhipuServiceError("El campo 'currency' debe ser texto", status_code=400)
+    if tenant:
+        merchant = merchant_registry.for_tenant(tenant)
+        if merchant is None:
+            raise KhipuServiceError(f"Tenant desconocido: {tenant}", status_code=400)
+        return merchant
+    if not currency:
+        return merchant_registry.default
+    merchant = merchant_registry.for_currency(currency)
+    if merchant is None:
+        raise KhipuServiceError(f"Moneda no válida para las API Keys configuradas. Usar {', '.join(merchant_registry.currencies)}.",
+                                status_code=400)
+    return merchant
 
-    # La consigna actual es ARS para tu API Key
-    if currency != "ARS": 
-        logger.error(f"Moneda debe ser ARS para la API Key configurada. Se recibió: {currency}")
-        raise KhipuServiceError("Moneda no válida para la API Key configurada. Usar ARS.", status_code=400)
 
+def _prepare_khipu_payload(client_data: dict, merchant=None) -> dict:
+    """
+    Prepara y valida el payload para enviar a la API de Khipu con el esquema del
+    comercio (por defecto, el que acepta la moneda del pago). Aplica lógica de
+    negocio como validación de moneda y monto (con Decimal, sin redondeos de float,
+    y dentro de los límites del comercio), y el formato de URLs, email y expires_date.
+    """
+    if merchant is None:
+        merchant = resolve_merchant(currency=client_data.get("currency") if isinstance(client_data, dict) else None)
     try:
-        amount = float(amount_str)
-        if amount <= 0:
-            logger.error(f"El monto debe ser mayor que cero, se recibió: {amount}")
-            raise KhipuServiceError("El monto debe ser mayor que cero", status_code=400)
-        
-        # Límite para ARS en DemoBank (si aplica, ajustar o quitar)
-        # Ejemplo: si el límite fuera 100000 ARS
-        # if currency == "ARS" and amount > 100000: 
-        #     logger.warning(f"Monto {amount} ARS excede el límite de prueba de 100000 ARS. Ajustando...")
-        #     amount = 100000.0
-    except ValueError:
-        logger.error(f"El campo 'amount' no es un número válido: {amount_str}")
-        raise KhipuServiceError("El campo 'amount' debe ser un número válido", status_code=400)
-
-    payload = {
-        "subject": subject,
-        "amount": amount,
-        "currency": currency,
-        "transaction_id": client_data.get("transaction_id"),
-        "custom": client_data.get("custom"),
-        "body": client_data.get("body"),
-        "payer_email": client_data.get("payer_email"),
-        "return_url": client_data.get("return_url"),
-        "cancel_url": client_data.get("cancel_url"),
-        "notify_url": client_data.get("notify_url"),
-        "picture_url": client_data.get("picture_url"),
-        "notify_api_version": client_data.get("notify_api_version", DEFAULT_NOTIFY_API_VERSION),
-        "expires_date": client_data.get("expires_date"),
-    }
-    return {k: v for k, v in payload.items() if v is not None}
+        return merchant.schema.validate(client_data)
+    except ValidationError as e:
+        logger.warning("Payload inválido para Khipu: %s", e)
+        raise KhipuServiceError(str(e), status_code=400)
 
 
-def create_payment_intent(client_payment_data: dict) -> dict:
+def _khipu_api_key(merchant) -> str:
     """
-    Crea una intención de pago en Khipu.
+    :return: API key del comercio.
+    :raises KhipuConfigError: Si falta la API Key.
+    """
+    if not merchant.api_key:
+        logger.error("El comercio '%s' no tiene API key de Khipu configurada.", merchant.name)
+        raise KhipuConfigError("Error de configuración del servidor: clave API de Khipu faltante", status_code=500)
+    return merchant.api_key
 
-    :param client_payment_data: Diccionario con los datos del pago del cliente.
-    :return: Diccionario con la respuesta de Khipu si es exitosa.
+
+def prepare_payment(client_payment_data: dict, merchant) -> dict:
+    """
+    Valida la configuración del comercio y el pago del cliente, sin llamar a Khipu.
+
+    :return: Payload listo para enviar a Khipu (ver `create_prepared_payment`).
     :raises KhipuConfigError: Si falta la API Key.
-    :raises KhipuRequestError: Si Khipu devuelve un error HTTP.
-    :raises KhipuConnectionError: Si hay un problema de red.
-    :raises KhipuServiceError: Para otros errores de validación o inesperados.
+    :raises KhipuServiceError: Si el payload no es válido.
     """
-    khipu_merchant_api_key = os.environ.get('KHIPU_MERCHANT_API_KEY')
-    khipu_target_base_url = os.environ.get('KHIPU_TARGET_API_URL', DEFAULT_KHIPU_TARGET_API_URL)
+    _khipu_api_key(merchant)
+    with metrics.stage("validate"), tracing.span("khipu.validate", **{"khipu.merchant": merchant.name}):
+        return _prepare_khipu_payload(client_payment_data, merchant)
 
-    if not khipu_merchant_api_key:
-        logger.error("KHIPU_MERCHANT_API_KEY no está configurada.")
-        raise KhipuConfigError("Error de configuración del servidor: clave API de Khipu faltante", status_code=500)
 
-    try:
-        # Validar y preparar el payload antes de enviarlo
-        khipu_payload = _prepare_khipu_payload(client_payment_data)
-    except KhipuServiceError as e: # Re-lanzar errores de validación de _prepare_khipu_payload
-        raise e
+def _build_khipu_request(client_payment_data: dict, merchant) -> tuple:
+    """
+    Valida la configuración y el payload del cliente, y arma la solicitud a Khipu.
+
+    :return: Tupla (endpoint, payload, headers).
+    :raises KhipuConfigError: Si falta la API Key.
+    :raises KhipuServiceError: Si el payload no es válido.
+    """
+    # Validar y preparar el payload antes de enviarlo
+    khipu_payload = prepare_payment(client_payment_data, merchant)
+    return _khipu_request(khipu_payload, merchant)
+
 
+def _khipu_request(khipu_payload: dict, merchant) -> tuple:
+    """:return: Tupla (endpoint, payload, headers) para un payload ya validado."""
     khipu_headers = {
         'Content-Type': 'application/json',
         'Accept': 'application/json',
-        'x-api-key': khipu_merchant_api_key
+        'x-api-key': _khipu_api_key(merchant)
     }
 
-    khipu_api_endpoint = f"{khipu_target_base_url.rstrip('/')}/v3/payments"
-    
-    logger.info(f"Enviando solicitud a Khipu API: POST {khipu_api_endpoint}")
-    logger.debug(f"Khipu Payload (JSON a enviar): {khipu_payload}")
-    logger.debug(f"Khipu Headers (a enviar): {khipu_headers}")
+    khipu_api_endpoint = merchant.payments_endpoint
+
+    logger.info("Enviando solicitud a Khipu API: POST %s", khipu_api_endpoint)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Khipu Payload (JSON a enviar): %s", khipu_payload)
+        logger.debug("Khipu Headers (a enviar): %s", redact_headers(khipu_headers))
+    return khipu_api_endpoint, khipu_payload, khipu_headers
+
 
+def _parse_khipu_response(response, method: str = "POST") -> dict:
+    """
+    Interpreta la respuesta HTTP de Khipu. Funciona con respuestas de `requests`
+    y de `httpx`, que comparten `status_code`, `headers`, `text` y `json()`.
+    `method` decide qué códigos de error se marcan como reintentables.
+
+    :return: Diccionario con la respuesta de Khipu si es exitosa (2xx).
+    :raises KhipuRequestError: Si Khipu devuelve un error HTTP.
+    """
+    logger.debug("Khipu raw response status: %s", response.status_code)
+    metrics.UPSTREAM_RESPONSES.labels(str(response.status_code)).inc()
+    upstream_span = tracing.current_span()
+    if upstream_span is not None:
+        upstream_span.set_attribute("http.status_code", response.status_code)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Khipu raw response headers: %s", response.headers)
+        logger.debug("Khipu raw response body (text): %s", response.text)
+
+    if not 200 <= response.status_code < 300: # Si el código de estado no es 2xx
+        retryable = response.status_code in (TRANSIENT_STATUS_CODES if method == "GET" else POST_RETRY_STATUS_CODES)
+        try:
+            error_data = response.json()
+        except ValueError: # Si el cuerpo del error no es JSON
+            logger.error("Error HTTP de Khipu (texto plano): %s - %s", response.status_code, response.text)
+            raise KhipuRequestError(f"Error de Khipu: {response.text}", status_code=response.status_code, khipu_response_data=response.text,
+                                    retryable=retryable)
+
+        error_message = error_data.get("message", response.text) if isinstance(error_data, dict) else response.text
+        # Intentar extraer un mensaje más específico si Khipu lo provee
+        if isinstance(error_data, dict) and isinstance(error_data.get("errors"), list) and len(error_data["errors"]) > 0:
+            error_detail = error_data['errors'][0]
+            error_message = f"Campo '{error_detail.get('field', 'desconocido')}': {error_detail.get('message', response.text)}"
+        logger.error("Error HTTP de Khipu: %s - Detalle: %s - Respuesta Completa: %s", response.status_code, error_message, response.text)
+        raise KhipuRequestError(f"Error de Khipu: {error_message}", status_code=response.status_code, khipu_response_data=error_data,
+                                retryable=retryable)
+
+    # Si la respuesta es OK (2xx)
+    khipu_response_data = json_codec.loads(response.content)
+    logger.debug("Respuesta JSON exitosa de Khipu: %s", khipu_response_data)
+    return khipu_response_data
+
+
+def _attempt_timeouts(deadline: float) -> tuple:
+    """Timeouts (connect, read) del próximo intento, recortados al plazo restante."""
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        logger.error("Se agotó el plazo total de la solicitud a Khipu API")
+        raise KhipuConnectionError("Se agotó el plazo de la solicitud a Khipu API", status_code=504)
+    connect_timeout, read_timeout = get_timeouts()
+    return min(connect_timeout, remaining), min(read_timeout, remaining)
+
+
+def _acquire_breaker(merchant, reserve: bool = True):
+    """
+    Permiso del circuit breaker para un intento. Con `reserve=False` solo verifica
+    el estado (sin ocupar cupo de prueba): cada intento lo hace antes de esperar en
+    el limitador y de gastar cuota, así con el circuito abierto no consume ninguno.
+    """
     try:
-        response = requests.post(
-            khipu_api_endpoint,
-            json=khipu_payload,
-            headers=khipu_headers,
-            timeout=REQUEST_TIMEOUT_SECONDS
-        )
-        logger.info(f"Khipu raw response status: {response.status_code}")
-        logger.debug(f"Khipu raw response headers: {response.headers}")
-        logger.debug(f"Khipu raw response body (text): {response.text}")
-
-        if not response.ok: # Si el código de estado no es 2xx
-            try:
-                error_data = response.json()
-                error_message = error_data.get("message", response.text)
-                # Intentar extraer un mensaje más específico si Khipu lo provee
-                if "errors" in error_data and isinstance(error_data["errors"], list) and len(error_data["errors"]) > 0:
-                     error_detail = error_data['errors'][0]
-                     error_message = f"Campo '{error_detail.get('field', 'desconocido')}': {error_detail.get('message', response.text)}"
-                logger.error(f"Error HTTP de Khipu: {response.status_code} - Detalle: {error_message} - Respuesta Completa: {response.text}")
-                raise KhipuRequestError(f"Error de Khipu: {error_message}", status_code=response.status_code, khipu_response_data=error_data)
-            except ValueError: # Si el cuerpo del error no es JSON
-                logger.error(f"Error HTTP de Khipu (texto plano): {response.status_code} - {response.text}")
-                raise KhipuRequestError(f"Error de Khipu: {response.text}", status_code=response.status_code, khipu_response_data=response.text)
-        
-        # Si la respuesta es OK (2xx)
-        khipu_response_data = response.json()
-        logger.info(f"Respuesta JSON exitosa de Khipu: {khipu_response_data}")
-        return khipu_response_data
+        if reserve:
+            merchant.breaker.before_call()
+        else:
+            merchant.breaker.check()
+    except CircuitOpenError as e:
+        logger.warning("Llamada a Khipu rechazada: %s", e)
+        raise KhipuCircuitOpenError("Khipu API no disponible temporalmente", retry_after=e.retry_after)
+
+
+def _acquire_quota(merchant):
+    try:
+        rate_limiter.acquire_upstream(merchant.name, merchant.quota_rate, merchant.quota_burst)
+    except RateLimitExceeded as e:
+        logger.warning("Llamada a Khipu rechazada: %s", e)
+        raise KhipuRateLimitError("Cuota de llamadas a Khipu API agotada", retry_after=e.retry_after)
+
+
+def _saturated_error(e: ConcurrencyLimitExceeded) -> KhipuRateLimitError:
+    logger.warning("Llamada a Khipu rechazada: %s", e)
+    return KhipuRateLimitError("Demasiadas llamadas en curso hacia Khipu API", status_code=503, retry_after=e.retry_after)
+
 
+def _after_failed_attempt(merchant, e: KhipuServiceError, attempt: int, started: float, deadline: float) -> float:
+    """
+    Registra el intento fallido en el circuit breaker y decide si reintentar.
+
+    :return: Segundos a esperar antes del próximo intento.
+    :raises KhipuServiceError: El mismo error si no corresponde reintentar.
+    """
+    duration = time.monotonic() - started
+    # Solo los fallos de Khipu abren el circuito; los 4xx de validación cuentan como respuesta válida
+    if isinstance(e, KhipuConnectionError) or (isinstance(e, KhipuRequestError) and (e.status_code or 0) >= 500):
+        merchant.breaker.record_failure(duration)
+    else:
+        merchant.breaker.record_success(duration)
+
+    settings = get_settings()
+    if not e.retryable or attempt >= settings.max_retries:
+        raise e
+    delay = backoff_delay(attempt, settings.retry_backoff_base_seconds, settings.retry_backoff_max_seconds)
+    if time.monotonic() + delay >= deadline:
+        raise e
+    logger.warning("Error transitorio de Khipu (%s); reintento %s en %.2fs", e.status_code, attempt + 1, delay)
+    return delay
+
+
+def _request_deadline() -> float:
+    return time.monotonic() + get_settings().request_deadline_seconds
+
+
+def _not_sent(e) -> bool:
+    """¿El ConnectionError de requests ocurrió al abrir la conexión, antes de enviar nada?"""
+    from urllib3.exceptions import NewConnectionError, ConnectTimeoutError # Import diferido, como requests
+
+    reason = e.args[0] if e.args else None
+    reason = getattr(reason, "reason", reason) # MaxRetryError envuelve la causa
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+def _send_sync(merchant, method: str, khipu_api_endpoint: str, khipu_headers: dict, timeouts: tuple, khipu_payload: dict = None) -> dict:
+    """Un intento de solicitud a Khipu (POST con payload, o GET) con la sesión persistente del comercio."""
+    import requests # Import diferido: ya está cargado si la sesión existe (ver http_session)
+
+    upstream_span = tracing.current_span()
+    if upstream_span is not None:
+        upstream_span.set_attribute("http.method", method)
+        upstream_span.set_attribute("http.url", khipu_api_endpoint)
+    try:
+        # Sesión persistente del comercio: reutiliza conexiones keep-alive hacia Khipu
+        with metrics.UPSTREAM_IN_FLIGHT.labels().track_inprogress(), metrics.stage("upstream"):
+            response = merchant.session.get().request(
+                method,
+                khipu_api_endpoint,
+                data=json_codec.dumps(khipu_payload) if khipu_payload is not None else None,
+                headers=tracing.inject(khipu_headers), # Propaga la traza a Khipu
+                timeout=timeouts
+            )
+        return _parse_khipu_response(response, method)
+
+    except KhipuServiceError:
+        raise
+    except requests.exceptions.ConnectTimeout:
+        logger.error("Timeout de conexión con Khipu API: %s", khipu_api_endpoint)
+        raise KhipuConnectionError("Timeout al conectar con Khipu API", status_code=504, retryable=True)
     except requests.exceptions.Timeout:
-        logger.error(f"Timeout al conectar con Khipu API: {khipu_api_endpoint}")
-        raise KhipuConnectionError("Timeout al conectar con Khipu API", status_code=504)
+        # Timeout de lectura: un POST pudo haberse procesado y no se reintenta; un GET sí
+        logger.error("Timeout al conectar con Khipu API: %s", khipu_api_endpoint)
+        raise KhipuConnectionError("Timeout al conectar con Khipu API", status_code=504, retryable=method == "GET")
     except requests.exceptions.ConnectionError as e:
-        logger.error(f"Error de conexión con Khipu API: {str(e)}")
-        raise KhipuConnectionError(f"Error de conexión con Khipu API: {str(e)}", status_code=503)
+        # Sin conexión la solicitud no se envió; una conexión cortada después (p. ej. una
+        # keep-alive del pool cerrada por Khipu) es ambigua para un POST, como el timeout de lectura
+        logger.error("Error de conexión con Khipu API: %s", e)
+        raise KhipuConnectionError(f"Error de conexión con Khipu API: {str(e)}", status_code=503,
+                                   retryable=method == "GET" or _not_sent(e))
     except requests.exceptions.RequestException as e: 
-        logger.error(f"Error general de requests al llamar a Khipu API: {str(e)}")
+        logger.error("Error general de requests al llamar a Khipu API: %s", e)
         raise KhipuServiceError(f"Error al comunicarse con Khipu: {str(e)}", status_code=502)
     except Exception as e: 
-        logger.error(f"Error inesperado al crear intención de pago en Khipu: {str(e)}", exc_info=True)
+        logger.error("Error inesperado al llamar a Khipu (%s %s): %s", method, khipu_api_endpoint, e, exc_info=True)
         raise KhipuServiceError(f"Error interno inesperado: {str(e)}", status_code=500)
 
+
+def _call_with_retries(merchant, attempt_fn):
+    """
+    Ejecuta `attempt_fn(timeouts)` con control de admisión, circuit breaker y
+    reintentos de errores transitorios (backoff exponencial con jitter) dentro del
+    plazo total. Cada intento verifica primero el circuito (sin reservar cupo), espera
+    un lugar en el limitador de concurrencia del comercio (cola acotada), consume un
+    token de su cuota y recién entonces reserva el permiso del breaker; el lugar se
+    libera antes del backoff.
+    """
+    deadline = _request_deadline()
+    attempt = 0
+    while True:
+        _acquire_breaker(merchant, reserve=False)
+        try:
+            merchant.limiter.acquire(deadline - time.monotonic())
+        except ConcurrencyLimitExceeded as e:
+            raise _saturated_error(e)
+        try:
+            timeouts = _attempt_timeouts(deadline)
+            _acquire_quota(merchant)
+            _acquire_breaker(merchant)
+            started = time.monotonic()
+            try:
+                # Un span por intento: su duración es la latencia de Khipu
+                with tracing.span("khipu.request", "client", **{"khipu.merchant": merchant.name, "khipu.attempt": attempt}):
+                    result = attempt_fn(timeouts)
+            except KhipuServiceError as e:
+                delay = _after_failed_attempt(merchant, e, attempt, started, deadline)
+            except BaseException:
+                # Intento cancelado (CancelledError, fin del worker) o error no previsto:
+                # sin resultado, pero el permiso de prueba del breaker se devuelve
+                merchant.breaker.release()
+                raise
+            else:
+                merchant.breaker.record_success(time.monotonic() - started)
+                return result
+        finally:
+            merchant.limiter.release()
+        time.sleep(delay)
+        attempt += 1
+
+
+async def _post_async(merchant, khipu_api_endpoint: str, khipu_payload: dict, khipu_headers: dict, timeouts: tuple) -> dict:
+    """Un intento de POST a Khipu con el cliente asíncrono del comercio."""
+    import httpx # Import diferido: solo el camino ASGI necesita httpx
+
+    connect_timeout, read_timeout = timeouts
+    upstream_span = tracing.current_span()
+    if upstream_span is not None:
+        upstream_span.set_attribute("http.method", "POST")
+        upstream_span.set_attribute("http.url", khipu_api_endpoint)
+    try:
+        client = merchant.async_client.get()
+        with metrics.UPSTREAM_IN_FLIGHT.labels().track_inprogress(), metrics.stage("upstream"):
+            response = await client.post(khipu_api_endpoint, content=json_codec.dumps(khipu_payload), headers=tracing.inject(khipu_headers),
+                                         timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+        return _parse_khipu_response(response, "POST")
+
+    except KhipuServiceError:
+        raise
+    except (httpx.ConnectTimeout, httpx.PoolTimeout):
+        logger.error("Timeout de conexión con Khipu API: %s", khipu_api_endpoint)
+        raise KhipuConnectionError("Timeout al conectar con Khipu API", status_code=504, retryable=True)
+    except httpx.TimeoutException:
+        # Timeout de lectura: la solicitud pudo haberse procesado, no se reintenta
+        logger.error("Timeout al conectar con Khipu API: %s", khipu_api_endpoint)
+        raise KhipuConnectionError("Timeout al conectar con Khipu API", status_code=504)
+    except httpx.ConnectError as e:
+        # La conexión no se abrió: la solicitud no se envió
+        logger.error("Error de conexión con Khipu API: %s", e)
+        raise KhipuConnectionError(f"Error de conexión con Khipu API: {str(e)}", status_code=503, retryable=True)
+    except httpx.TransportError as e:
+        # Conexión cortada durante o después del envío: el pago pudo haberse creado, no se reintenta
+        logger.error("Error de conexión con Khipu API: %s", e)
+        raise KhipuConnectionError(f"Error de conexión con Khipu API: {str(e)}", status_code=503)
+    except httpx.HTTPError as e:
+        logger.error("Error general de httpx al llamar a Khipu API: %s", e)
+        raise KhipuServiceError(f"Error al comunicarse con Khipu: {str(e)}", status_code=502)
+    except Exception as e:
+        logger.error("Error inesperado al crear intención de pago en Khipu: %s", e, exc_info=True)
+        raise KhipuServiceError(f"Error interno inesperado: {str(e)}", status_code=500)
+
+
+def _merchant_for_payment(client_payment_data, merchant):
+    if merchant is not None:
+        return merchant
+    return resolve_merchant(currency=client_payment_data.get("currency") if isinstance(client_payment_data, dict) else None)
+
+
+def create_payment_intent(client_payment_data: dict, merchant=None) -> dict:
+    """
+    Crea una intención de pago en Khipu con las credenciales y conexiones del
+    comercio indicado (por defecto, el que acepta la moneda del pago; ver
+    `resolve_merchant`).
+
+    Los errores transitorios se reintentan con backoff exponencial con jitter dentro
+    del plazo KHIPU_REQUEST_DEADLINE_SECONDS. Si el circuit breaker está abierto
+    falla de inmediato con KhipuCircuitOpenError (503), sin llamar a Khipu.
+
+    :param client_payment_data: Diccionario con los datos del pago del cliente.
+    :param merchant: Comercio de merchants.merchant_registry (opcional).
+    :return: Diccionario con la respuesta de Khipu si es exitosa.
+    :raises KhipuConfigError: Si falta la API Key.
+    :raises KhipuRequestError: Si Khipu devuelve un error HTTP.
+    :raises KhipuConnectionError: Si hay un problema de red o el circuito está abierto.
+    :raises KhipuRateLimitError: Si se agotó la cuota global o no hubo lugar para llamar a Khipu.
+    :raises KhipuServiceError: Para otros errores de validación o inesperados.
+    """
+    merchant = _merchant_for_payment(client_payment_data, merchant)
+    khipu_api_endpoint, khipu_payload, khipu_headers = _build_khipu_request(client_payment_data, merchant)
+    return _call_with_retries(merchant, lambda timeouts: _send_sync(
+        merchant, "POST", khipu_api_endpoint, khipu_headers, timeouts, khipu_payload))
+
+
+def create_prepared_payment(khipu_payload: dict, merchant) -> dict:
+    """
+    Crea en Khipu un pago ya validado con `prepare_payment` (lo usa el despachador
+    del outbox, ver payment_outbox). Mismos reintentos, plazo, admisión y circuit
+    breaker que `create_payment_intent`, mismas excepciones.
+    """
+    khipu_api_endpoint, khipu_payload, khipu_headers = _khipu_request(khipu_payload, merchant)
+    return _call_with_retries(merchant, lambda timeouts: _send_sync(
+        merchant, "POST", khipu_api_endpoint, khipu_headers, timeouts, khipu_payload))
+
+
+async def create_payment_intent_async(client_payment_data: dict, merchant=None) -> dict:
+    """
+    Versión asyncio de `create_payment_intent`. No bloquea un hilo mientras espera
+    a Khipu, por lo que un solo proceso puede mantener cientos de llamadas en vuelo.
+    Misma validación, mismos reintentos y circuit breaker, mismas excepciones.
+    """
+    import asyncio # Import diferido: solo el camino ASGI lo necesita
+
+    merchant = _merchant_for_payment(client_payment_data, merchant)
+    khipu_api_endpoint, khipu_payload, khipu_headers = _build_khipu_request(client_payment_data, merchant)
+
+    deadline = _request_deadline()
+    attempt = 0
+    while True:
+        _acquire_breaker(merchant, reserve=False)
+        try:
+            await merchant.limiter.acquire_async(deadline - time.monotonic())
+        except ConcurrencyLimitExceeded as e:
+            raise _saturated_error(e)
+        try:
+            timeouts = _attempt_timeouts(deadline)
+            _acquire_quota(merchant)
+            _acquire_breaker(merchant)
+            started = time.monotonic()
+            try:
+                with tracing.span("khipu.request", "client", **{"khipu.merchant": merchant.name, "khipu.attempt": attempt}):
+                    result = await _post_async(merchant, khipu_api_endpoint, khipu_payload, khipu_headers, timeouts)
+            except KhipuServiceError as e:
+                delay = _after_failed_attempt(merchant, e, attempt, started, deadline)
+            except BaseException:
+                # Intento cancelado (CancelledError, fin del worker) o error no previsto:
+                # sin resultado, pero el permiso de prueba del breaker se devuelve
+                merchant.breaker.release()
+                raise
+            else:
+                merchant.breaker.record_success(time.monotonic() - started)
+                return result
+        finally:
+            merchant.limiter.release()
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+def get_payment_status(payment_id: str, merchant=None) -> dict:
+    """
+    Consulta el estado de un pago en Khipu (GET /v3/payments/{payment_id}).
+
+    Mismos reintentos, plazo y circuit breaker que la creación; como la consulta
+    es idempotente, también se reintenta tras un timeout de lectura.
+
+    :param payment_id: Identificador del pago devuelto por Khipu al crearlo.
+    :param merchant: Comercio que creó el pago (por defecto, el comercio por defecto).
+    :return: Diccionario con el estado del pago (status, status_detail, ...).
+    :raises KhipuServiceError: (400) si el identificador no es válido.
+    :raises KhipuRequestError: Si Khipu devuelve un error HTTP (ej. 404).
+    :raises KhipuConnectionError: Si hay un problema de red o el circuito está abierto.
+    """
+    if not isinstance(payment_id, str) or PAYMENT_ID_RE.match(payment_id) is None:
+        raise KhipuServiceError("Identificador de pago inválido", status_code=400)
+    merchant = merchant or merchant_registry.default
+    khipu_headers = {'Accept': 'application/json', 'x-api-key': _khipu_api_key(merchant)}
+    khipu_api_endpoint = f"{merchant.payments_endpoint}/{payment_id}"
+
+    logger.info("Consultando estado en Khipu API: GET %s", khipu_api_endpoint)
+    return _call_with_retries(merchant, lambda timeouts: _send_sync(merchant, "GET", khipu_api_endpoint, khipu_headers, timeouts))
+
+
+def verify_notification_signature(body: bytes, signature_header: str, secret: str,
+                                  tolerance_seconds: float = None) -> bool:
+    """
+    Verifica la firma de una notificación de Khipu (notify_api_version 3.0).
+
+    La cabecera `x-khipu-signature` tiene la forma `t=<timestamp ms>,s=<firma>`, donde
+    la firma es el HMAC-SHA256 en base64 de `"<t>.<cuerpo>"` con el secreto del cobrador.
+    `tolerance_seconds` limita la antigüedad de la firma (reenvíos); por defecto
+    KHIPU_NOTIFICATION_TOLERANCE_SECONDS, y 0 lo desactiva.
+    """
+    if not signature_header or not secret:
+        return False
+    if tolerance_seconds is None:
+        tolerance_seconds = get_settings().khipu_notification_tolerance_seconds
+    parts = dict(item.split("=", 1) for item in signature_header.split(",") if "=" in item)
+    timestamp, signature = parts.get("t", "").strip(), parts.get("s", "").strip()
+    if not timestamp or not signature:
+        return False
+    if tolerance_seconds:
+        try:
+            if abs(time.time() - int(timestamp) / 1000.0) > tolerance_seconds:
+                return False
+        except ValueError:
+            return False
+    digest = hmac.new(secret.encode("utf-8"), timestamp.encode("utf-8") + b"." + body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest).decode("ascii"), signature)
+
+
+def notification_merchant(body: bytes, signature_header: str):
+    """
+    Comercio cuya clave firmó la notificación, o None si la firma no corresponde a
+    ninguno. Cada comercio tiene su propio secreto de notificaciones.
+    """
+    for merchant in merchant_registry.with_notification_secret():
+        if verify_notification_signature(body, signature_header, merchant.notification_secret):
+            return merchant
+    return None
+
+
+def get_http_pool_stats() -> dict:
+    """Devuelve, por comercio, las estadísticas del pool de conexiones hacia Khipu (reutilizadas vs. nuevas)."""
+    return {name: merchant.session.stats() for name, merchant in merchant_registry.merchants.items()}
+
+
+def get_admission_stats() -> dict:
+    """Devuelve el estado del control de admisión: token buckets y limitadores de concurrencia por comercio."""
+    return {"rate_limit": rate_limiter.stats(),
+            "upstream_concurrency": {name: m.limiter.stats() for name, m in merchant_registry.merchants.items()}}
+
+
+def get_circuit_breaker_stats() -> dict:
+    """Devuelve, por comercio, el estado del circuit breaker de Khipu y sus contadores de transiciones."""
+    return {name: merchant.breaker.stats() for name, merchant in merchant_registry.merchants.items()}
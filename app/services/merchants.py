@@ -0,0 +1,232 @@
+# app/services/merchants.py
+import os
+import json
+import logging
+from decimal import Decimal, InvalidOperation
+from app.settings import get_settings, PROJECT_ROOT, ProcessSingleton
+from app.services.http_session import PooledSession, AsyncPooledClient
+from app.services.circuit_breaker import CircuitBreaker
+from app.services.rate_limit import ConcurrencyLimiter
+from app.services.validation import PaymentSchema, payment_optional_fields
+
+logger = logging.getLogger(__name__)
+
+# Registro de comercios (cuentas de cobrador en Khipu) cargado una vez al arrancar.
+# Cada comercio tiene su API key, URL base, monedas con límites de monto y sus propios
+# pool de conexiones, limitador de concurrencia, cuota y circuit breaker: la lentitud
+# de Khipu con un comercio no consume las conexiones de los demás.
+#
+# Origen de la configuración, en orden: KHIPU_MERCHANTS_FILE (archivo JSON),
+# KHIPU_MERCHANTS (el mismo JSON en la variable) o, si no hay ninguno, un único
+# comercio "default" con KHIPU_MERCHANT_API_KEY, KHIPU_TARGET_API_URL y KHIPU_CURRENCIES.
+#
+#   {"merchants": [
+#     {"name": "ar", "api_key_env": "KHIPU_API_KEY_AR", "currencies": {"ARS": {"max_amount": "5000000"}},
+#      "tenants": ["tienda-ar"], "notification_secret_env": "KHIPU_SECRET_AR", "pool_maxsize": 20},
+#     {"name": "cl", "api_key_env": "KHIPU_API_KEY_CL", "currencies": ["CLP"], "max_concurrency": 16}
+#   ]}
+
+DEFAULT_NOTIFY_API_VERSION = "1.3"
+# Con secreto de notificaciones, los pagos piden por defecto notificaciones JSON firmadas:
+# /v3/notifications solo acepta esas (Khipu envía las 1.3 como formulario y sin firma)
+SIGNED_NOTIFY_API_VERSION = "3.0"
+
+
+class MerchantConfigError(ValueError):
+    """La configuración de comercios (KHIPU_MERCHANTS_FILE / KHIPU_MERCHANTS) no es válida."""
+    pass
+
+
+def _decimal_or_none(merchant_name: str, name: str, value):
+    if value is None:
+        return None
+    try:
+        return Decimal(str(value))
+    except InvalidOperation:
+        raise MerchantConfigError(f"Comercio '{merchant_name}': '{name}' debe ser un número")
+
+
+def _secret(config: dict, name: str):
+    """Valor directo (`name`) o leído de la variable de entorno indicada en `name_env`."""
+    if config.get(name):
+        return config[name]
+    env_name = config.get(f"{name}_env")
+    return os.environ.get(env_name) or None if env_name else None
+
+
+class Merchant:
+    """Un comercio de Khipu con sus credenciales, reglas de moneda y conexiones propias."""
+
+    def __init__(self, name: str, api_key, base_url: str, currencies: dict, tenants=(), notification_secret=None,
+                 pool_connections=None, pool_maxsize=None, async_max_connections=None, max_concurrency=None,
+                 rate_limit_per_second=None, rate_limit_burst=None, settings=None):
+        settings = settings or get_settings()
+        self.name = name
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.payments_endpoint = f"{self.base_url}/v3/payments"
+        self.currencies = tuple(currencies)
+        self.tenants = tuple(tenants)
+        self.notification_secret = notification_secret
+        self.notify_api_version = SIGNED_NOTIFY_API_VERSION if notification_secret else DEFAULT_NOTIFY_API_VERSION
+        self.schema = PaymentSchema(payment_optional_fields(self.notify_api_version),
+                                    allowed_currencies=self.currencies,
+                                    amount_limits={c: limits for c, limits in currencies.items() if limits != (None, None)})
+
+        enabled = settings.rate_limit_enabled
+        self.quota_rate = (settings.khipu_rate_limit_per_second if rate_limit_per_second is None
+                           else float(rate_limit_per_second)) if enabled else 0.0
+        self.quota_burst = settings.khipu_rate_limit_burst if rate_limit_burst is None else float(rate_limit_burst)
+
+        self.session = PooledSession(pool_connections, pool_maxsize)
+        self.async_client = AsyncPooledClient(async_max_connections)
+        self.limiter = ConcurrencyLimiter(
+            (settings.khipu_max_concurrency if max_concurrency is None else int(max_concurrency)) if enabled else 0,
+            settings.khipu_max_queue,
+            settings.khipu_queue_timeout_seconds,
+        )
+        self.breaker = CircuitBreaker(
+            f"khipu:{name}",
+            failure_rate_threshold=settings.breaker_failure_rate,
+            slow_call_rate_threshold=settings.breaker_slow_call_rate,
+            slow_call_seconds=settings.breaker_slow_call_seconds,
+            window_size=settings.breaker_window,
+            minimum_calls=settings.breaker_min_calls,
+            open_seconds=settings.breaker_open_seconds,
+            half_open_max_calls=settings.breaker_half_open_calls,
+        )
+
+    @classmethod
+    def from_config(cls, config: dict, settings) -> "Merchant":
+        name = config.get("name")
+        if not name or not isinstance(name, str):
+            raise MerchantConfigError("Cada comercio necesita un 'name'")
+        raw_currencies = config.get("currencies") or ()
+        if isinstance(raw_currencies, dict):
+            currencies = {
+                str(code).upper(): (_decimal_or_none(name, "min_amount", (limits or {}).get("min_amount")),
+                                    _decimal_or_none(name, "max_amount", (limits or {}).get("max_amount")))
+                for code, limits in raw_currencies.items()
+            }
+        else:
+            currencies = {str(code).upper(): (None, None) for code in raw_currencies}
+        if not currencies:
+            raise MerchantConfigError(f"Comercio '{name}': falta 'currencies'")
+        return cls(
+            name,
+            api_key=_secret(config, "api_key"),
+            base_url=config.get("base_url") or settings.khipu_target_api_url,
+            currencies=currencies,
+            tenants=config.get("tenants") or (),
+            notification_secret=_secret(config, "notification_secret"),
+            pool_connections=config.get("pool_connections"),
+            pool_maxsize=config.get("pool_maxsize"),
+            async_max_connections=config.get("async_max_connections"),
+            max_concurrency=config.get("max_concurrency"),
+            rate_limit_per_second=config.get("rate_limit_per_second"),
+            rate_limit_burst=config.get("rate_limit_burst"),
+            settings=settings,
+        )
+
+    def reset_after_fork(self):
+        self.session.reset_after_fork()
+        self.async_client.reset_after_fork()
+        self.limiter.reset_after_fork()
+
+    def __repr__(self):
+        return f"Merchant({self.name!r}, currencies={self.currencies!r})"
+
+
+class MerchantRegistry:
+    """
+    Comercios por nombre, tenant y moneda; cada búsqueda es un acceso a dict.
+
+    Un tenant (o el nombre del comercio) identifica a un solo comercio. Para enrutar
+    por moneda se usa el primer comercio declarado que la acepta; el primero de la
+    lista es además el comercio por defecto (consultas sin tenant).
+    """
+
+    def __init__(self, merchants: list):
+        if not merchants:
+            raise MerchantConfigError("No hay comercios configurados")
+        self.merchants = {}
+        self._by_tenant = {}
+        self._by_currency = {}
+        for merchant in merchants:
+            if merchant.name in self.merchants:
+                raise MerchantConfigError(f"Comercio duplicado: '{merchant.name}'")
+            self.merchants[merchant.name] = merchant
+            for tenant in (merchant.name, *merchant.tenants):
+                if self._by_tenant.setdefault(tenant, merchant) is not merchant:
+                    raise MerchantConfigError(f"El tenant '{tenant}' está asignado a más de un comercio")
+            for currency in merchant.currencies:
+                self._by_currency.setdefault(currency, merchant)
+        self.default = merchants[0]
+        self.currencies = tuple(sorted(self._by_currency))
+
+    @classmethod
+    def from_settings(cls, settings=None) -> "MerchantRegistry":
+        settings = settings or get_settings()
+        configs = load_merchant_configs(settings)
+        registry = cls([Merchant.from_config(config, settings) for config in configs])
+        logger.info("Comercios de Khipu: %s", ", ".join(
+            f"{m.name} ({'/'.join(m.currencies)})" for m in registry.merchants.values()))
+        return registry
+
+    def for_tenant(self, tenant: str):
+        return self._by_tenant.get(tenant) if isinstance(tenant, str) else None
+
+    def for_currency(self, currency):
+        return self._by_currency.get(currency) if isinstance(currency, str) else None
+
+    def with_notification_secret(self) -> list:
+        return [m for m in self.merchants.values() if m.notification_secret]
+
+    def reset_after_fork(self):
+        for merchant in self.merchants.values():
+            merchant.reset_after_fork()
+
+    async def aclose(self):
+        for merchant in self.merchants.values():
+            await merchant.async_client.aclose()
+
+
+def load_merchant_configs(settings) -> list:
+    """Lista de configuraciones de comercio (dicts) según KHIPU_MERCHANTS_FILE / KHIPU_MERCHANTS."""
+    if settings.khipu_merchants_file:
+        path = settings.khipu_merchants_file
+        path = path if os.path.isabs(path) else os.path.join(PROJECT_ROOT, path)
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            raise MerchantConfigError(f"No se pudo leer KHIPU_MERCHANTS_FILE ({path}): {e}")
+    elif settings.khipu_merchants:
+        try:
+            data = json.loads(settings.khipu_merchants)
+        except ValueError as e:
+            raise MerchantConfigError(f"KHIPU_MERCHANTS no es JSON válido: {e}")
+    else:
+        return [{
+            "name": "default",
+            "api_key": settings.khipu_merchant_api_key,
+            "base_url": settings.khipu_target_api_url,
+            "currencies": list(settings.khipu_currencies),
+            "notification_secret": settings.khipu_notification_secret,
+        }]
+    merchants = data.get("merchants") if isinstance(data, dict) else data
+    if not isinstance(merchants, list) or not all(isinstance(m, dict) for m in merchants):
+        raise MerchantConfigError("La configuración de comercios debe ser una lista de objetos (o {\"merchants\": [...]})")
+    return merchants
+
+
+def _build_merchant_registry() -> MerchantRegistry:
+    registry = MerchantRegistry.from_settings()
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=registry.reset_after_fork)
+    return registry
+
+
+# Registro del proceso; create_app lo construye, así que un error de configuración
+# detiene el arranque
+merchant_registry = ProcessSingleton(_build_merchant_registry)
@@ -0,0 +1,241 @@
+# app/services/notification_queue.py
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+import logging
+from app.settings import get_settings, ProcessSingleton
+
+logger = logging.getLogger(__name__)
+
+# Constantes (valores por defecto; la cola del proceso usa NOTIFICATIONS_* de app/settings.py)
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_CLAIM_BATCH = 10
+DEFAULT_VISIBILITY_TIMEOUT_SECONDS = 300 # Filas 'processing' más viejas vuelven a 'pending' (worker caído)
+DEFAULT_POLL_SECONDS = 2.0
+DEFAULT_RETENTION_DAYS = 7.0 # Las filas 'done' más viejas se borran (0 = conservarlas)
+SWEEP_INTERVAL_SECONDS = 3600.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS notifications (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    received_at REAL NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    locked_by TEXT,
+    locked_at REAL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_notifications_ready ON notifications (status, available_at);
+"""
+
+
+class NotificationQueue:
+    """
+    Cola durable de notificaciones (webhooks) de Khipu sobre SQLite en modo WAL,
+    con un pool acotado de hilos que las procesa en segundo plano.
+
+    - `enqueue` solo inserta una fila (sub-milisegundo con WAL), así el webhook
+      responde de inmediato.
+    - Las filas se reclaman de forma atómica, por lo que varios procesos (workers de
+      Gunicorn) pueden compartir el mismo archivo sin procesar dos veces una notificación.
+    - Lo pendiente sobrevive a reinicios; si un worker muere a mitad de proceso, la
+      fila vuelve a estar disponible tras el visibility timeout.
+    - Los errores se reintentan con backoff exponencial hasta `max_attempts`.
+    - Los workers borran cada hora las filas 'done' con más de `retention_days`,
+      para que el archivo no crezca sin límite; las 'failed' se conservan.
+    """
+
+    def __init__(self, db_path: str, workers: int = DEFAULT_WORKERS, max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 visibility_timeout: float = DEFAULT_VISIBILITY_TIMEOUT_SECONDS, poll_seconds: float = DEFAULT_POLL_SECONDS,
+                 retention_days: float = DEFAULT_RETENTION_DAYS):
+        self.db_path = db_path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.visibility_timeout = visibility_timeout
+        self.poll_seconds = poll_seconds
+        self.retention_days = retention_days
+        self._next_sweep = 0.0
+        self._sweep_lock = threading.Lock()
+        self._handlers = []
+        self._local = threading.local()
+        self._wakeup = threading.Condition()
+        self._start_lock = threading.Lock()
+        self._started_pid = None
+        self._stopping = False
+        self._threads = []
+        self._schema_ready = False
+
+    # --- Conexiones -------------------------------------------------------
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and getattr(self._local, "pid", None) == os.getpid():
+            return conn
+        directory = os.path.dirname(os.path.abspath(self.db_path))
+        os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None) # autocommit; transacciones explícitas
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL") # Con WAL: durable ante caída del proceso, rápido
+        if not self._schema_ready:
+            conn.executescript(_SCHEMA)
+            self._schema_ready = True
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    # --- Productor ---------------------------------------------------------
+
+    def enqueue(self, payload: dict) -> int:
+        """Guarda la notificación de forma durable y despierta a un worker. Devuelve su id."""
+        now = time.time()
+        cursor = self._connect().execute(
+            "INSERT INTO notifications (received_at, payload, available_at) VALUES (?, ?, ?)",
+            (now, json.dumps(payload), now))
+        with self._wakeup:
+            self._wakeup.notify()
+        return cursor.lastrowid
+
+    # --- Consumidores ------------------------------------------------------
+
+    def register_handler(self, handler):
+        """Registra una función `handler(payload: dict)` que procesa cada notificación."""
+        self._handlers.append(handler)
+        return handler
+
+    def ensure_started(self):
+        """Arranca el pool de workers en este proceso (una vez por pid; seguro tras fork)."""
+        if self._started_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            self._wakeup = threading.Condition()
+            self._stopping = False
+            self._threads = [
+                threading.Thread(target=self._worker_loop, name=f"khipu-notify-{i}", daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+            self._started_pid = os.getpid()
+            logger.info("Pool de notificaciones iniciado (pid=%s, workers=%s, db=%s)", os.getpid(), self.workers, self.db_path)
+
+    def stop(self, timeout: float = 5.0):
+        self._stopping = True
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._started_pid = None
+
+    def _claim(self, limit: int) -> list:
+        """Reclama hasta `limit` notificaciones listas, de forma atómica entre procesos."""
+        conn = self._connect()
+        now = time.time()
+        token = uuid.uuid4().hex
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "UPDATE notifications SET status='pending', locked_by=NULL "
+                "WHERE status='processing' AND locked_at < ?", (now - self.visibility_timeout,))
+            conn.execute(
+                "UPDATE notifications SET status='processing', locked_by=?, locked_at=?, attempts=attempts+1 "
+                "WHERE id IN (SELECT id FROM notifications WHERE status='pending' AND available_at <= ? "
+                "ORDER BY id LIMIT ?)", (token, now, now, limit))
+            rows = conn.execute(
+                "SELECT id, payload, attempts FROM notifications WHERE locked_by=? AND status='processing'",
+                (token,)).fetchall()
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return rows
+
+    def purge_done(self, older_than: float) -> int:
+        """Borra las notificaciones 'done' procesadas antes de `older_than` (epoch). Devuelve cuántas."""
+        cursor = self._connect().execute("DELETE FROM notifications WHERE status='done' AND locked_at < ?",
+                                         (older_than,))
+        return cursor.rowcount
+
+    def _maybe_sweep(self):
+        """Barrido de retención, como mucho una vez por SWEEP_INTERVAL_SECONDS y por proceso."""
+        if self.retention_days <= 0 or time.time() < self._next_sweep or not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_sweep = time.time() + SWEEP_INTERVAL_SECONDS
+            deleted = self.purge_done(time.time() - self.retention_days * 86400)
+            if deleted:
+                logger.info("Retención de notificaciones: %s filas 'done' borradas", deleted)
+        except sqlite3.Error as e:
+            logger.error("Error en el barrido de retención de notificaciones: %s", e)
+        finally:
+            self._sweep_lock.release()
+
+    def _worker_loop(self):
+        while not self._stopping:
+            self._maybe_sweep()
+            try:
+                rows = self._claim(DEFAULT_CLAIM_BATCH)
+            except sqlite3.Error as e:
+                logger.error("Error al reclamar notificaciones: %s", e)
+                rows = []
+            if not rows:
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_seconds)
+                continue
+            for notification_id, payload, attempts in rows:
+                self._process(notification_id, json.loads(payload), attempts)
+
+    def _process(self, notification_id: int, payload: dict, attempts: int):
+        conn = self._connect()
+        try:
+            for handler in self._handlers:
+                handler(payload)
+        except Exception as e:
+            if attempts >= self.max_attempts:
+                logger.error("Notificación %s descartada tras %s intentos: %s", notification_id, attempts, e)
+                conn.execute("UPDATE notifications SET status='failed', locked_by=NULL, last_error=? WHERE id=?",
+                             (str(e), notification_id))
+            else:
+                delay = min(2 ** attempts, 300)
+                logger.warning("Error procesando notificación %s (intento %s); reintento en %ss: %s",
+                               notification_id, attempts, delay, e)
+                conn.execute("UPDATE notifications SET status='pending', locked_by=NULL, available_at=?, last_error=? "
+                             "WHERE id=?", (time.time() + delay, str(e), notification_id))
+            return
+        conn.execute("UPDATE notifications SET status='done', locked_by=NULL, last_error=NULL WHERE id=?",
+                     (notification_id,))
+
+    def stats(self) -> dict:
+        rows = self._connect().execute("SELECT status, COUNT(*) FROM notifications GROUP BY status").fetchall()
+        counts = {status: count for status, count in rows}
+        return {"workers": self.workers, "running": self._started_pid == os.getpid(),
+                **{s: counts.get(s, 0) for s in ("pending", "processing", "done", "failed")}}
+
+
+def log_notification(payload: dict):
+    """Handler por defecto: deja constancia del cambio de estado del pago."""
+    logger.info("Notificación de Khipu procesada: payment_id=%s status=%s",
+                payload.get("payment_id"), payload.get("status"))
+
+
+def _build_notification_queue() -> NotificationQueue:
+    settings = get_settings()
+    queue = NotificationQueue(
+        settings.notifications_db_path,
+        workers=settings.notifications_workers,
+        max_attempts=settings.notifications_max_attempts,
+        retention_days=settings.notifications_retention_days,
+    )
+    queue.register_handler(log_notification)
+    return queue
+
+
+# Cola compartida por el proceso para las notificaciones de pago
+notification_queue = ProcessSingleton(_build_notification_queue)
@@ -0,0 +1,436 @@
+# app/services/payment_outbox.py
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from app.settings import get_settings, ProcessSingleton
+from app.services import khipu_service
+from app.services.khipu_service import KhipuServiceError
+from app.services.circuit_breaker import backoff_delay
+from app.services.merchants import merchant_registry
+from app import tracing
+
+logger = logging.getLogger(__name__)
+
+# Modo "aceptado" de POST /v3/payments (PAYMENTS_ACCEPT_MODE): el pago validado se
+# guarda en un outbox durable y la solicitud responde 202 con un tracking_id, sin
+# esperar a Khipu. Un despachador en segundo plano crea los pagos en Khipu con
+# concurrencia acotada; si Khipu no responde, lo pendiente espera en el outbox y se
+# envía al ritmo que permiten la cuota y el circuit breaker del comercio.
+#
+#   off     Siempre síncrono (comportamiento original).
+#   prefer  Aceptado solo si el cliente envía `Prefer: respond-async` (RFC 7240).
+#   always  Siempre aceptado.
+#
+# Cualquier otro valor equivale a "off".
+
+STATUS_PATH = "/v3/payments/accepted/{}"
+
+# Constantes (valores por defecto; el outbox del proceso usa PAYMENT_OUTBOX_* de app/settings.py)
+DEFAULT_CONCURRENCY = 8
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_MAX_ATTEMPTS = 20
+DEFAULT_VISIBILITY_TIMEOUT_SECONDS = 300 # Filas 'processing' más viejas pasan a 'unknown' (worker caído)
+DEFAULT_POLL_SECONDS = 1.0
+DEFAULT_DRAIN_SECONDS = 10 # Espera de los envíos en curso al detener el despachador
+MAX_BACKOFF_SECONDS = 300
+DEFAULT_RETENTION_SECONDS = 24 * 60 * 60 # Igual que IDEMPOTENCY_TTL_SECONDS
+SWEEP_INTERVAL_SECONDS = 600.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS payment_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    tracking_id TEXT NOT NULL UNIQUE,
+    idempotency_key TEXT UNIQUE,
+    merchant TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    traceparent TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    available_at REAL NOT NULL,
+    locked_by TEXT,
+    locked_at REAL,
+    result TEXT,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_payment_outbox_ready ON payment_outbox (status, available_at);
+"""
+
+_PUBLIC_COLUMNS = "tracking_id, merchant, status, attempts, created_at, updated_at, result, last_error"
+
+
+def _public(row) -> dict:
+    """Vista del cliente de una fila del outbox (GET /v3/payments/accepted/<tracking_id>)."""
+    tracking_id, merchant, status, attempts, created_at, updated_at, result, last_error = row
+    submission = {"tracking_id": tracking_id, "merchant": merchant, "status": status, "attempts": attempts,
+                  "created_at": created_at, "updated_at": updated_at}
+    if result is not None:
+        submission["payment"] = json.loads(result)
+    if last_error is not None:
+        submission["error"] = json.loads(last_error)
+    return submission
+
+
+_ABANDONED_ERROR = json.dumps({
+    "error": "El envío a Khipu se interrumpió (worker detenido); el pago pudo haberse creado en Khipu",
+    "status_code": None, "details": None})
+
+
+def _error_detail(e: Exception) -> dict:
+    if isinstance(e, KhipuServiceError):
+        return {"error": str(e), "status_code": e.status_code, "details": e.khipu_response_data}
+    return {"error": f"Error interno inesperado: {e}", "status_code": 500, "details": None}
+
+
+class PaymentOutbox:
+    """
+    Outbox durable de pagos aceptados sobre SQLite en modo WAL, con el mismo esquema
+    de reclamo atómico que la cola de notificaciones (varios workers de Gunicorn
+    pueden compartir el archivo sin enviar dos veces un pago).
+
+    - `submit` solo inserta una fila; con clave de idempotencia, un reintento del
+      cliente recibe el tracking_id del pago ya aceptado.
+    - Un hilo despachador reclama lotes de hasta `batch_size` pagos, sin superar
+      `concurrency` llamadas en curso, y los envía desde un pool de hilos a través de
+      `khipu_service.create_prepared_payment` (cuota, limitador y circuit breaker del
+      comercio incluidos).
+    - Los errores transitorios, la cuota agotada y el circuito abierto reprograman el
+      pago (respetando Retry-After; estos dos últimos no cuentan como intento). Los
+      rechazos de Khipu y los timeouts de lectura, en los que el pago pudo haberse
+      creado, lo dejan en 'failed' con el error para conciliarlo.
+    - Un pago que quedó 'processing' más de `visibility_timeout` (el worker murió
+      durante el envío) pasa a 'unknown' y no se reenvía: Khipu pudo haberlo creado,
+      y reenviarlo lo duplicaría. Se concilia como los 'failed'.
+    - `stop` deja de reclamar, devuelve a 'pending' lo reclamado que aún no se envió
+      y espera los envíos en curso (app/server.py lo llama al terminar cada worker).
+    - Pasados `retention_seconds` (el TTL de idempotencia) desde que terminaron, los
+      pagos 'done' se borran y los 'failed'/'unknown' liberan su clave de idempotencia
+      (se conservan para conciliarlos): la clave repite la respuesta lo mismo que en
+      modo síncrono, no para siempre.
+    """
+
+    def __init__(self, db_path: str, concurrency: int = DEFAULT_CONCURRENCY, batch_size: int = DEFAULT_BATCH_SIZE,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS, visibility_timeout: float = DEFAULT_VISIBILITY_TIMEOUT_SECONDS,
+                 poll_seconds: float = DEFAULT_POLL_SECONDS, retention_seconds: float = DEFAULT_RETENTION_SECONDS):
+        self.db_path = db_path
+        self.concurrency = max(1, concurrency)
+        self.batch_size = max(1, batch_size)
+        self.max_attempts = max_attempts
+        self.visibility_timeout = visibility_timeout
+        self.poll_seconds = poll_seconds
+        self.retention_seconds = retention_seconds
+        self._next_sweep = 0.0
+        self._local = threading.local()
+        self._wakeup = threading.Condition()
+        self._start_lock = threading.Lock()
+        self._started_pid = None
+        self._stopping = False
+        self._thread = None
+        self._executor = None
+        self._in_flight = 0
+        self._schema_ready = False
+
+    # --- Conexiones -------------------------------------------------------
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and getattr(self._local, "pid", None) == os.getpid():
+            return conn
+        directory = os.path.dirname(os.path.abspath(self.db_path))
+        os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None) # autocommit; transacciones explícitas
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL") # Con WAL: durable ante caída del proceso, rápido
+        if not self._schema_ready:
+            conn.executescript(_SCHEMA)
+            self._schema_ready = True
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    # --- Productor ---------------------------------------------------------
+
+    def submit(self, merchant_name: str, khipu_payload: dict, idempotency_key: str = None, traceparent: str = None) -> tuple:
+        """
+        Guarda un pago validado de forma durable y despierta al despachador.
+
+        :return: Tupla (submission, created); created es False si la clave de
+                 idempotencia ya tenía un pago aceptado (se devuelve ese).
+        """
+        now = time.time()
+        conn = self._connect()
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO payment_outbox (tracking_id, idempotency_key, merchant, payload, traceparent, "
+            "created_at, updated_at, available_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (uuid.uuid4().hex, idempotency_key, merchant_name, json.dumps(khipu_payload), traceparent, now, now, now))
+        created = cursor.rowcount == 1
+        if created:
+            row = conn.execute(f"SELECT {_PUBLIC_COLUMNS} FROM payment_outbox WHERE id=?", (cursor.lastrowid,)).fetchone()
+            with self._wakeup:
+                self._wakeup.notify()
+        else:
+            row = conn.execute(f"SELECT {_PUBLIC_COLUMNS} FROM payment_outbox WHERE idempotency_key=?",
+                               (idempotency_key,)).fetchone()
+        return _public(row), created
+
+    def accept(self, client_data: dict, merchant, idempotency_key: str = None) -> tuple:
+        """
+        Valida el pago del cliente con el esquema del comercio y lo deja en el outbox.
+
+        :return: Tupla (submission, created), como `submit`.
+        :raises KhipuConfigError: Si falta la API Key del comercio.
+        :raises KhipuServiceError: (400) si el payload no es válido.
+        """
+        khipu_payload = khipu_service.prepare_payment(client_data, merchant)
+        active = tracing.current_span()
+        submission, created = self.submit(merchant.name, khipu_payload, idempotency_key,
+                                          active.traceparent if active is not None else None)
+        self.ensure_started()
+        return submission, created
+
+    def get(self, tracking_id: str):
+        """:return: Estado del pago aceptado, o None si el tracking_id no existe."""
+        row = self._connect().execute(f"SELECT {_PUBLIC_COLUMNS} FROM payment_outbox WHERE tracking_id=?",
+                                      (tracking_id,)).fetchone()
+        return _public(row) if row is not None else None
+
+    # --- Despachador -------------------------------------------------------
+
+    def ensure_started(self):
+        """Arranca el despachador en este proceso (una vez por pid; seguro tras fork)."""
+        if self._started_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            self._wakeup = threading.Condition()
+            self._stopping = False
+            self._in_flight = 0
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="khipu-outbox")
+            self._thread = threading.Thread(target=self._dispatch_loop, name="khipu-outbox-dispatcher", daemon=True)
+            self._thread.start()
+            self._started_pid = os.getpid()
+            logger.info("Despachador del outbox de pagos iniciado (pid=%s, concurrency=%s, db=%s)",
+                        os.getpid(), self.concurrency, self.db_path)
+
+    def stop(self, timeout: float = DEFAULT_DRAIN_SECONDS):
+        """
+        Detiene el despachador de este proceso: no reclama más pagos y espera hasta
+        `timeout` segundos a que terminen los envíos en curso. Un envío que no
+        termina a tiempo queda 'processing' y pasa a 'unknown' tras el visibility timeout.
+        """
+        if self._started_pid != os.getpid():
+            return
+        deadline = time.monotonic() + timeout
+        with self._wakeup:
+            self._stopping = True
+            self._wakeup.notify_all()
+        self._thread.join(max(deadline - time.monotonic(), 0.0))
+        with self._wakeup:
+            while self._in_flight > 0 and time.monotonic() < deadline:
+                self._wakeup.wait(deadline - time.monotonic())
+            in_flight = self._in_flight
+        self._executor.shutdown(wait=False)
+        self._started_pid = None
+        if in_flight:
+            logger.warning("Despachador del outbox detenido con %s envíos a Khipu sin terminar (pid=%s)",
+                           in_flight, os.getpid())
+
+    def _claim(self, limit: int) -> list:
+        """Reclama hasta `limit` pagos listos, de forma atómica entre procesos."""
+        conn = self._connect()
+        now = time.time()
+        token = uuid.uuid4().hex
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Envíos interrumpidos (worker caído): Khipu pudo haber creado el pago, no se reenvían
+            abandoned = conn.execute(
+                "UPDATE payment_outbox SET status='unknown', locked_by=NULL, updated_at=?, last_error=? "
+                "WHERE status='processing' AND locked_at < ?", (now, _ABANDONED_ERROR, now - self.visibility_timeout)).rowcount
+            conn.execute(
+                "UPDATE payment_outbox SET status='processing', locked_by=?, locked_at=?, updated_at=?, attempts=attempts+1 "
+                "WHERE id IN (SELECT id FROM payment_outbox WHERE status='pending' AND available_at <= ? "
+                "ORDER BY id LIMIT ?)", (token, now, now, now, limit))
+            rows = conn.execute(
+                "SELECT id, tracking_id, merchant, payload, traceparent, attempts FROM payment_outbox "
+                "WHERE locked_by=? AND status='processing'", (token,)).fetchall()
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if abandoned:
+            logger.error("%s pagos del outbox quedaron en 'unknown': su envío a Khipu se interrumpió "
+                         "y pudieron haberse creado; conciliar antes de reintentarlos", abandoned)
+        return rows
+
+    def _release(self, row_ids: list):
+        """Devuelve a 'pending' pagos reclamados que no llegaron a enviarse (no cuenta como intento)."""
+        self._connect().executemany(
+            "UPDATE payment_outbox SET status='pending', locked_by=NULL, attempts=attempts-1 WHERE id=? AND status='processing'",
+            [(row_id,) for row_id in row_ids])
+
+    def purge(self, older_than: float) -> tuple:
+        """
+        Barrido de retención de los pagos terminados antes de `older_than` (epoch): borra
+        los 'done' y quita la clave de idempotencia a los 'failed'/'unknown'.
+
+        :return: Tupla (borrados, claves liberadas).
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            deleted = conn.execute("DELETE FROM payment_outbox WHERE status='done' AND updated_at < ?",
+                                   (older_than,)).rowcount
+            released = conn.execute(
+                "UPDATE payment_outbox SET idempotency_key=NULL WHERE status IN ('failed', 'unknown') "
+                "AND idempotency_key IS NOT NULL AND updated_at < ?", (older_than,)).rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return deleted, released
+
+    def _maybe_sweep(self):
+        """Barrido de retención desde el despachador, como mucho una vez por SWEEP_INTERVAL_SECONDS."""
+        if self.retention_seconds <= 0 or time.time() < self._next_sweep:
+            return
+        self._next_sweep = time.time() + SWEEP_INTERVAL_SECONDS
+        try:
+            deleted, released = self.purge(time.time() - self.retention_seconds)
+        except sqlite3.Error as e:
+            logger.error("Error en el barrido de retención del outbox: %s", e)
+            return
+        if deleted or released:
+            logger.info("Retención del outbox: %s pagos 'done' borrados, %s claves de idempotencia liberadas",
+                        deleted, released)
+
+    def _dispatch_loop(self):
+        while not self._stopping:
+            self._maybe_sweep()
+            # Solo se reclama lo que se puede enviar ya: el resto queda disponible para otros procesos
+            with self._wakeup:
+                while self._in_flight >= self.concurrency and not self._stopping:
+                    self._wakeup.wait()
+                free = self.concurrency - self._in_flight
+            if self._stopping:
+                break
+            try:
+                rows = self._claim(min(free, self.batch_size))
+            except sqlite3.Error as e:
+                logger.error("Error al reclamar pagos del outbox: %s", e)
+                rows = []
+            if not rows:
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_seconds)
+                continue
+            with self._wakeup:
+                self._in_flight += len(rows)
+            for index, row in enumerate(rows):
+                try:
+                    self._executor.submit(self._dispatch, *row)
+                except RuntimeError:
+                    # Intérprete o pool cerrándose: lo que no se envió vuelve a 'pending'
+                    self._release([r[0] for r in rows[index:]])
+                    with self._wakeup:
+                        self._in_flight -= len(rows) - index
+                        self._wakeup.notify_all()
+                    return
+
+    def _dispatch(self, row_id: int, tracking_id: str, merchant_name: str, payload: str, traceparent, attempts: int):
+        dispatch_span, token = tracing.start_request_span(
+            "khipu.outbox.dispatch", traceparent, kind="consumer",
+            **{"khipu.merchant": merchant_name, "khipu.tracking_id": tracking_id, "khipu.outbox_attempt": attempts})
+        try:
+            if self._stopping:
+                self._release([row_id])
+                return
+            merchant = merchant_registry.merchants.get(merchant_name)
+            if merchant is None:
+                self._fail(row_id, tracking_id, KhipuServiceError(f"Comercio desconocido: {merchant_name}", status_code=500))
+                return
+            try:
+                khipu_response = khipu_service.create_prepared_payment(json.loads(payload), merchant)
+            except Exception as e:
+                if dispatch_span is not None:
+                    dispatch_span.record_error(e)
+                self._after_error(row_id, tracking_id, attempts, e)
+                return
+            self._connect().execute(
+                "UPDATE payment_outbox SET status='done', locked_by=NULL, updated_at=?, result=?, last_error=NULL WHERE id=?",
+                (time.time(), json.dumps(khipu_response), row_id))
+            logger.info("Pago aceptado %s creado en Khipu: payment_id=%s", tracking_id, khipu_response.get("payment_id"))
+        except sqlite3.Error as e:
+            # La fila queda 'processing' y pasa a 'unknown' tras el visibility timeout
+            logger.error("Error al actualizar el pago %s del outbox: %s", tracking_id, e)
+        finally:
+            tracing.end_request_span(dispatch_span, token)
+            with self._wakeup:
+                self._in_flight -= 1
+                self._wakeup.notify_all()
+
+    def _after_error(self, row_id: int, tracking_id: str, attempts: int, e: Exception):
+        retry_after = getattr(e, "retry_after", None)
+        if retry_after is not None:
+            # Cuota agotada, Khipu saturado o circuito abierto: Khipu no se llamó, no cuenta como intento
+            delay, attempts_used = retry_after, attempts - 1
+        elif not isinstance(e, KhipuServiceError) or e.retryable:
+            delay, attempts_used = backoff_delay(attempts, 1.0, MAX_BACKOFF_SECONDS), attempts
+        else:
+            self._fail(row_id, tracking_id, e)
+            return
+        if attempts_used >= self.max_attempts:
+            self._fail(row_id, tracking_id, e)
+            return
+        logger.warning("Pago aceptado %s no se pudo enviar a Khipu (intento %s); reintento en %.1fs: %s",
+                       tracking_id, attempts, delay, e)
+        now = time.time()
+        self._connect().execute(
+            "UPDATE payment_outbox SET status='pending', locked_by=NULL, attempts=?, available_at=?, updated_at=?, "
+            "last_error=? WHERE id=?", (attempts_used, now + delay, now, json.dumps(_error_detail(e)), row_id))
+
+    def _fail(self, row_id: int, tracking_id: str, e: Exception):
+        logger.error("Pago aceptado %s descartado: %s", tracking_id, e)
+        self._connect().execute(
+            "UPDATE payment_outbox SET status='failed', locked_by=NULL, updated_at=?, last_error=? WHERE id=?",
+            (time.time(), json.dumps(_error_detail(e)), row_id))
+
+    def stats(self) -> dict:
+        conn = self._connect()
+        rows = conn.execute("SELECT status, COUNT(*) FROM payment_outbox GROUP BY status").fetchall()
+        counts = {status: count for status, count in rows}
+        oldest = conn.execute("SELECT MIN(created_at) FROM payment_outbox WHERE status IN ('pending', 'processing')").fetchone()[0]
+        return {"concurrency": self.concurrency, "running": self._started_pid == os.getpid(), "in_flight": self._in_flight,
+                "oldest_pending_seconds": round(time.time() - oldest, 3) if oldest is not None else 0.0,
+                **{s: counts.get(s, 0) for s in ("pending", "processing", "done", "failed", "unknown")}}
+
+
+def wants_accepted(prefer_header) -> bool:
+    """¿Se responde 202 y se envía desde el outbox? Según PAYMENTS_ACCEPT_MODE y la cabecera Prefer."""
+    mode = get_settings().payments_accept_mode
+    if mode == "always":
+        return True
+    if mode != "prefer" or not prefer_header:
+        return False
+    return any(preference.split(";")[0].strip().lower() == "respond-async" for preference in prefer_header.split(","))
+
+
+# Outbox compartido por el proceso; el despachador arranca con el primer pago aceptado
+# o la primera solicitud (ver create_app), y retoma lo pendiente en el archivo.
+def _build_payment_outbox() -> PaymentOutbox:
+    settings = get_settings()
+    return PaymentOutbox(
+        settings.payment_outbox_db_path,
+        concurrency=settings.payment_outbox_concurrency,
+        batch_size=settings.payment_outbox_batch_size,
+        max_attempts=settings.payment_outbox_max_attempts,
+        retention_seconds=settings.idempotency_ttl_seconds,
+    )
+
+
+payment_outbox = ProcessSingleton(_build_payment_outbox)
@@ -0,0 +1,159 @@
+# app/services/payment_status_cache.py
+import threading
+import logging
+from app.settings import get_settings, ProcessSingleton
+from app.services import khipu_service
+from app.services.merchants import merchant_registry
+from app.services.idempotency import IdempotencyStore, InMemoryLRUStore
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+# Constantes (valores por defecto; la caché del proceso usa PAYMENT_STATUS_* de app/settings.py)
+DEFAULT_PENDING_TTL_SECONDS = 2.0      # Un pago pendiente puede cambiar en cualquier momento
+# Un pago terminado ya no cambia salvo reversas, que se notifican; pero la notificación
+# solo invalida la caché del worker que la recibe, y los demás ven el cambio al vencer
+# este TTL. Es también la demora máxima con la que se ve una reversa.
+DEFAULT_TERMINAL_TTL_SECONDS = 60.0
+DEFAULT_WAIT_TIMEOUT_SECONDS = 40      # Algo más que el timeout de lectura hacia Khipu
+
+# Estados de Khipu que no vuelven a cambiar por sí solos
+TERMINAL_STATUSES = frozenset(("done",))
+TERMINAL_STATUS_DETAILS = frozenset(("rejected-by-payer", "marked-as-abuse", "reversed"))
+
+
+def is_terminal(payment_status: dict) -> bool:
+    return (payment_status.get("status") in TERMINAL_STATUSES
+            or payment_status.get("status_detail") in TERMINAL_STATUS_DETAILS)
+
+
+class _Lookup:
+    """Consulta a Khipu en curso para un payment_id; las concurrentes esperan su resultado."""
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class PaymentStatusCache:
+    """
+    Caché read-through del estado de los pagos.
+
+    - Un acierto se responde desde memoria, sin llamar a Khipu.
+    - Las entradas son por comercio y payment_id.
+    - Un fallo consulta a Khipu una sola vez por payment_id: las consultas concurrentes
+      del mismo pago esperan ese resultado (request coalescing).
+    - El TTL depende del estado: corto para pagos pendientes, largo para estados finales.
+    - `invalidate` descarta la entrada (y el resultado de una consulta en curso) cuando
+      llega una notificación de Khipu para ese pago. La caché es del proceso: con
+      varios workers solo se invalida la del que recibió la notificación, y los demás
+      pueden responder el estado anterior hasta que venza su TTL (por eso el de los
+      estados finales es corto).
+    - Los errores no se guardan.
+    """
+
+    def __init__(self, fetch, store: IdempotencyStore, pending_ttl: float = DEFAULT_PENDING_TTL_SECONDS,
+                 terminal_ttl: float = DEFAULT_TERMINAL_TTL_SECONDS, wait_timeout: float = DEFAULT_WAIT_TIMEOUT_SECONDS):
+        self.fetch = fetch
+        self.store = store
+        self.pending_ttl = pending_ttl
+        self.terminal_ttl = terminal_ttl
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, payment_id: str, merchant=None) -> tuple:
+        """
+        :param merchant: Comercio que creó el pago (por defecto, el comercio por defecto).
+        :return: Tupla (estado del pago, origen) con origen "hit", "miss" o "coalesced".
+        :raises KhipuServiceError: El error de la consulta a Khipu; (504) si la consulta
+                 en curso no termina a tiempo.
+        """
+        merchant = merchant or merchant_registry.default
+        key = f"{merchant.name}/{payment_id}"
+        cached = self.store.get(key)
+        if cached is not None:
+            self._count("hit")
+            return cached, "hit"
+
+        with self._lock:
+            lookup = self._inflight.get(key)
+            is_leader = lookup is None
+            if is_leader:
+                lookup = self._inflight[key] = _Lookup()
+
+        if not is_leader:
+            self._count("coalesced")
+            if not lookup.event.wait(self.wait_timeout):
+                raise khipu_service.KhipuConnectionError("Timeout esperando la consulta de estado en curso", status_code=504)
+            if lookup.error is not None:
+                raise lookup.error
+            return lookup.result, "coalesced"
+
+        self._count("miss")
+        try:
+            result = self.fetch(payment_id, merchant)
+            lookup.result = result
+            with self._lock:
+                # Si llegó una notificación durante la consulta, el resultado puede estar desactualizado
+                if self._inflight.get(key) is lookup:
+                    ttl = self.terminal_ttl if is_terminal(result) else self.pending_ttl
+                    self.store.set(key, result, ttl)
+            return result, "miss"
+        except BaseException as e:
+            lookup.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._inflight.get(key) is lookup:
+                    del self._inflight[key]
+            lookup.event.set()
+
+    def invalidate(self, payment_id: str, merchant=None):
+        key = f"{(merchant or merchant_registry.default).name}/{payment_id}"
+        with self._lock:
+            self.store.delete(key)
+            self._inflight.pop(key, None)
+
+    def _count(self, result: str):
+        # Contadores sin lock: un incremento perdido bajo contención no afecta las proporciones
+        if result == "hit":
+            self.hits += 1
+        elif result == "miss":
+            self.misses += 1
+        else:
+            self.coalesced += 1
+        metrics.STATUS_CACHE_LOOKUPS.labels(result).inc()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        stats = dict(self.store.stats())
+        stats.update({
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            # Fracción de consultas atendidas sin una llamada propia a Khipu
+            "upstream_avoided_ratio": round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+            "inflight": len(self._inflight),
+        })
+        return stats
+
+
+# Caché compartida por el proceso para GET /v3/payments/<payment_id>
+def _build_payment_status_cache() -> PaymentStatusCache:
+    settings = get_settings()
+    return PaymentStatusCache(
+        khipu_service.get_payment_status,
+        InMemoryLRUStore(settings.payment_status_cache_max_entries),
+        pending_ttl=settings.payment_status_pending_ttl_seconds,
+        terminal_ttl=settings.payment_status_terminal_ttl_seconds,
+    )
+
+
+payment_status_cache = ProcessSingleton(_build_payment_status_cache)
@@ -0,0 +1,418 @@
+# app/services/rate_limit.py
+import os
+import math
+import time
+import mmap
+import struct
+import hashlib
+import threading
+import logging
+from collections import OrderedDict, deque
+from app.settings import get_settings, ProcessSingleton
+from app import metrics
+
+try:
+    import fcntl
+except ImportError: # Windows: sin almacén compartido
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Control de admisión: token buckets por cliente y por comercio (cuota de su API key en Khipu),
+# más un limitador de concurrencia con cola acotada para las llamadas a Khipu.
+
+DEFAULT_MAX_ENTRIES = 10000 # Buckets en memoria por proceso (LRU)
+
+
+class RateLimitExceeded(Exception):
+    """Un token bucket está vacío; reintentar en `retry_after` segundos."""
+
+    def __init__(self, scope: str, retry_after: float):
+        super().__init__(f"Límite de solicitudes '{scope}' excedido; reintentar en {retry_after:.2f}s")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+class ConcurrencyLimitExceeded(Exception):
+    """No hubo un lugar libre para llamar a Khipu: cola llena o plazo de espera agotado."""
+
+    def __init__(self, reason: str):
+        super().__init__(f"Demasiadas llamadas en curso hacia Khipu ({reason})")
+        self.reason = reason
+        self.retry_after = 1.0
+
+
+def retry_after_header(seconds: float) -> str:
+    """Valor de la cabecera Retry-After: segundos enteros, al menos 1."""
+    return str(max(1, math.ceil(seconds)))
+
+
+# --- Almacenes de buckets ---------------------------------------------------
+
+class TokenBucketStore:
+    """
+    Interfaz del almacén de token buckets.
+
+    `acquire` toma `cost` tokens de todos los buckets indicados de forma atómica
+    (todos o ninguno), así un rechazo del bucket global no consume el del cliente.
+    Para compartir los buckets entre hosts se puede conectar otro backend (p. ej.
+    Redis con un script Lua) implementando `acquire` y registrándolo con `set_store()`.
+    """
+
+    def acquire(self, buckets) -> float:
+        """
+        :param buckets: Secuencia de (clave, tokens por segundo, ráfaga, costo).
+        :return: 0.0 si se admitió; si no, segundos hasta que haya tokens suficientes.
+        """
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {}
+
+
+def _refill(tokens: float, updated: float, now: float, rate: float, burst: float) -> float:
+    return min(burst, tokens + max(now - updated, 0.0) * rate)
+
+
+def _wait_time(tokens: float, rate: float, cost: float) -> float:
+    return (cost - tokens) / rate if rate > 0 else float("inf")
+
+
+class InMemoryTokenBucketStore(TokenBucketStore):
+    """Buckets en memoria del proceso (LRU acotado). Cada worker tiene los suyos."""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._buckets = OrderedDict() # key -> [tokens, updated]
+        self._lock = threading.Lock()
+
+    def acquire(self, buckets) -> float:
+        now = time.monotonic()
+        with self._lock:
+            states = []
+            wait = 0.0
+            for key, rate, burst, cost in buckets:
+                state = self._buckets.get(key)
+                tokens = burst if state is None else _refill(state[0], state[1], now, rate, burst)
+                if tokens < cost:
+                    wait = max(wait, _wait_time(tokens, rate, cost))
+                states.append((key, tokens, cost))
+            if wait > 0:
+                return wait
+            for key, tokens, cost in states:
+                self._buckets[key] = [tokens - cost, now]
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)
+            return 0.0
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "buckets": len(self._buckets), "max_entries": self.max_entries}
+
+
+class SharedMemoryTokenBucketStore(TokenBucketStore):
+    """
+    Buckets compartidos por todos los workers del host en un archivo mapeado en
+    memoria (por defecto en /dev/shm), protegido con flock.
+
+    Tabla hash de tamaño fijo: cada clave ocupa un slot (hash de 8 bytes, tokens,
+    última actualización) con sondeo lineal acotado; si no hay lugar se reemplaza
+    el slot menos reciente de la zona de sondeo. Cada operación es O(1).
+    """
+
+    MAGIC = b"KPRL0001"
+    HEADER = struct.Struct("<8sQ")
+    SLOT = struct.Struct("<Qdd")
+    PROBES = 8
+
+    def __init__(self, path: str, slots: int = 4096):
+        self.path = path
+        self.slots = slots
+        self._size = self.HEADER.size + self.SLOT.size * slots
+        self._lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._mmap = None
+
+    def _open(self):
+        # Un descriptor por proceso: flock comparte el lock entre procesos que heredan el mismo descriptor
+        if self._pid == os.getpid():
+            return
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size < self._size:
+                os.ftruncate(fd, self._size)
+            mapped = mmap.mmap(fd, self._size)
+            magic, slots = self.HEADER.unpack_from(mapped, 0)
+            if magic != self.MAGIC or slots != self.slots:
+                mapped[:] = b"\0" * self._size
+                self.HEADER.pack_into(mapped, 0, self.MAGIC, self.slots)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self._fd, self._mmap, self._pid = fd, mapped, os.getpid()
+        logger.info("Rate limiting compartido en %s (pid=%s, slots=%s)", self.path, self._pid, self.slots)
+
+    def _slot_for(self, key_hash: int, now: float) -> int:
+        index = key_hash % self.slots
+        victim, victim_updated = index, float("inf")
+        for probe in range(self.PROBES):
+            slot = (index + probe) % self.slots
+            stored_hash, _, updated = self.SLOT.unpack_from(self._mmap, self.HEADER.size + slot * self.SLOT.size)
+            if stored_hash == key_hash:
+                return slot
+            if stored_hash == 0:
+                return slot
+            if updated < victim_updated:
+                victim, victim_updated = slot, updated
+        return victim
+
+    def acquire(self, buckets) -> float:
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                now = time.monotonic()
+                states = []
+                wait = 0.0
+                for key, rate, burst, cost in buckets:
+                    # 0 está reservado para "slot vacío"
+                    key_hash = int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little") or 1
+                    slot = self._slot_for(key_hash, now)
+                    offset = self.HEADER.size + slot * self.SLOT.size
+                    stored_hash, tokens, updated = self.SLOT.unpack_from(self._mmap, offset)
+                    tokens = burst if stored_hash != key_hash else _refill(tokens, min(updated, now), now, rate, burst)
+                    if tokens < cost:
+                        wait = max(wait, _wait_time(tokens, rate, cost))
+                    states.append((offset, key_hash, tokens, cost))
+                if wait > 0:
+                    return wait
+                for offset, key_hash, tokens, cost in states:
+                    self.SLOT.pack_into(self._mmap, offset, key_hash, tokens - cost, now)
+                return 0.0
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def reset_after_fork(self):
+        self._lock = threading.Lock()
+
+    def stats(self) -> dict:
+        return {"backend": "shared_memory", "path": self.path, "slots": self.slots}
+
+
+# --- Limitadores -------------------------------------------------------------
+
+class RateLimiter:
+    """
+    Token buckets por cliente (admisión en el endpoint) y por comercio (cada llamada
+    a Khipu, dimensionado a la cuota de su API key; ver app/services/merchants.py).
+    Una tasa <= 0 desactiva el bucket correspondiente.
+    """
+
+    def __init__(self, store: TokenBucketStore, client_rate: float, client_burst: float):
+        self.store = store
+        self.client_rate = client_rate
+        self.client_burst = client_burst or client_rate
+        self.rejected = {"client": 0, "global": 0}
+
+    def admit_client(self, client_id: str, cost: float = 1.0):
+        """:raises RateLimitExceeded: Si el bucket del cliente está vacío."""
+        if self.client_rate > 0:
+            self._acquire("client", ((f"client:{client_id}", self.client_rate, self.client_burst, cost),))
+
+    def acquire_upstream(self, name: str, rate: float, burst: float = 0.0):
+        """:raises RateLimitExceeded: Si se agotó la cuota de llamadas a Khipu de `name`."""
+        if rate > 0:
+            self._acquire("global", ((f"global:khipu:{name}", rate, burst or rate, 1.0),))
+
+    def _acquire(self, scope: str, buckets):
+        retry_after = self.store.acquire(buckets)
+        if retry_after > 0:
+            self.rejected[scope] += 1
+            metrics.RATE_LIMITED.labels(scope).inc()
+            raise RateLimitExceeded(scope, retry_after)
+
+    def stats(self) -> dict:
+        stats = dict(self.store.stats())
+        stats.update({"client_rate": self.client_rate, "client_burst": self.client_burst,
+                      "rejected": dict(self.rejected)})
+        return stats
+
+
+class _Waiter:
+    """Turno en la cola del limitador: un hilo (Event) o una corrutina (Future de su loop)."""
+    __slots__ = ("event", "loop", "future", "granted", "abandoned")
+
+    def __init__(self, event=None, loop=None, future=None):
+        self.event = event
+        self.loop = loop
+        self.future = future
+        self.granted = False
+        self.abandoned = False
+
+    def grant(self) -> bool:
+        if self.abandoned:
+            return False
+        self.granted = True
+        if self.event is not None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(_resolve, self.future)
+        return True
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class ConcurrencyLimiter:
+    """
+    Limita las llamadas simultáneas a Khipu por proceso. Quien no encuentra lugar
+    espera en una cola FIFO acotada (`max_queue`) hasta `queue_timeout` segundos o
+    hasta el plazo de la solicitud, lo que ocurra antes. Admite hilos y corrutinas;
+    al liberar un lugar se entrega directamente al primero de la cola.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiters = deque()
+        self.rejected = {"queue_full": 0, "timeout": 0}
+
+    def _try_enter(self, waiter_factory):
+        """Con el lock tomado: entra directo, encola un turno o rechaza. Devuelve el turno o None."""
+        if self._in_flight < self.max_concurrency and not self._waiters:
+            self._in_flight += 1
+            return None
+        if len(self._waiters) >= self.max_queue:
+            self._reject("queue_full")
+        waiter = waiter_factory()
+        self._waiters.append(waiter)
+        return waiter
+
+    def acquire(self, timeout: float = None):
+        """:raises ConcurrencyLimitExceeded: Si la cola está llena o se agotó la espera."""
+        if self.max_concurrency <= 0:
+            return
+        with self._lock:
+            waiter = self._try_enter(lambda: _Waiter(event=threading.Event()))
+        if waiter is None:
+            return
+        wait = self.queue_timeout if timeout is None else min(timeout, self.queue_timeout)
+        if waiter.event.wait(max(wait, 0.0)):
+            return
+        self._abandon(waiter)
+
+    async def acquire_async(self, timeout: float = None):
+        """Equivalente de `acquire` para el camino asyncio."""
+        import asyncio # Import diferido: solo el camino ASGI lo necesita
+
+        if self.max_concurrency <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            waiter = self._try_enter(lambda: _Waiter(loop=loop, future=loop.create_future()))
+        if waiter is None:
+            return
+        wait = self.queue_timeout if timeout is None else min(timeout, self.queue_timeout)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), max(wait, 0.0))
+            return
+        except asyncio.TimeoutError:
+            self._abandon(waiter)
+        except asyncio.CancelledError:
+            with self._lock:
+                granted = waiter.granted
+                waiter.abandoned = True
+                if not granted:
+                    self._waiters.remove(waiter)
+            if granted:
+                self.release()
+            raise
+
+    def _abandon(self, waiter):
+        with self._lock:
+            if waiter.granted: # El lugar llegó justo al vencer la espera
+                return
+            waiter.abandoned = True
+            self._waiters.remove(waiter)
+            self._reject("timeout")
+
+    def _reject(self, reason: str):
+        self.rejected[reason] += 1
+        metrics.RATE_LIMITED.labels("concurrency").inc()
+        raise ConcurrencyLimitExceeded(reason)
+
+    def release(self):
+        if self.max_concurrency <= 0:
+            return
+        with self._lock:
+            while self._waiters:
+                if self._waiters.popleft().grant():
+                    return # El lugar pasa al siguiente sin liberarse
+            self._in_flight -= 1
+
+    def reset_after_fork(self):
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiters = deque()
+
+    def stats(self) -> dict:
+        return {"max_concurrency": self.max_concurrency, "in_flight": self._in_flight,
+                "waiting": len(self._waiters), "max_queue": self.max_queue, "rejected": dict(self.rejected)}
+
+
+def _build_store(settings) -> TokenBucketStore:
+    if settings.rate_limit_store == "shm":
+        if fcntl is not None and os.path.isdir(os.path.dirname(settings.rate_limit_shm_path) or "."):
+            return SharedMemoryTokenBucketStore(settings.rate_limit_shm_path, settings.rate_limit_shm_slots)
+        logger.warning("Almacén compartido no disponible en esta plataforma; rate limiting por proceso.")
+    return InMemoryTokenBucketStore()
+
+
+def forwarded_client(forwarded_for, remote_addr, hops: int):
+    """
+    IP del cliente detrás de `hops` proxies de confianza (TRUSTED_PROXY_HOPS), con la
+    misma regla que ProxyFix: el valor `hops` desde la derecha de X-Forwarded-For. Los
+    valores más a la izquierda los escribe el cliente y no se usan.
+    """
+    if hops <= 0 or not forwarded_for:
+        return remote_addr
+    values = [value.strip() for value in forwarded_for.split(",")]
+    return values[-hops] if len(values) >= hops else remote_addr
+
+
+def client_id_for(header_value, remote_addr) -> str:
+    """
+    Identidad del cliente para su bucket: la IP o, si RATE_LIMIT_CLIENT_HEADER está
+    configurada y presente, esa cabecera. Solo debe configurarse con una cabecera que
+    un gateway autentica (y sobrescribe): una que el cliente elige libremente le daría
+    un bucket nuevo por valor y desalojaría a los demás clientes del almacén compartido.
+    """
+    return f"key:{header_value.strip()}" if header_value else f"ip:{remote_addr or 'unknown'}"
+
+
+def _build_rate_limiter() -> RateLimiter:
+    settings = get_settings()
+    limiter = RateLimiter(
+        _build_store(settings),
+        client_rate=settings.rate_limit_client_rate if settings.rate_limit_enabled else 0.0,
+        client_burst=settings.rate_limit_client_burst,
+    )
+    if hasattr(os, "register_at_fork") and isinstance(limiter.store, SharedMemoryTokenBucketStore):
+        os.register_at_fork(after_in_child=limiter.store.reset_after_fork)
+    return limiter
+
+
+# Token buckets compartidos por el proceso (y por los workers, con el almacén shm).
+# Los limitadores de concurrencia hacia Khipu son por comercio (ver merchants.py).
+rate_limiter = ProcessSingleton(_build_rate_limiter)
+
+
+def set_store(store: TokenBucketStore):
+    """Reemplaza el backend de los token buckets (p. ej. por uno compartido entre hosts)."""
+    rate_limiter.store = store
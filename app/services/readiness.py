@@ -0,0 +1,204 @@
+# app/services/readiness.py
+import os
+import time
+import threading
+import logging
+from contextlib import contextmanager
+from app.settings import get_settings, ProcessSingleton
+from app.services.merchants import merchant_registry
+
+logger = logging.getLogger(__name__)
+
+# Liveness y readiness para el orquestador (ver app/routes/health_routes.py).
+# La readiness solo lee estado en memoria del proceso: solicitudes en curso frente a
+# los hilos del worker, uso de los pools y limitadores de cada comercio, circuit
+# breakers y el último resultado de una sonda de alcanzabilidad de Khipu que corre
+# en un hilo aparte. Nunca llama a Khipu dentro de la solicitud.
+
+
+class WorkerLoad:
+    """
+    Solicitudes en curso en este proceso. `capacity` son los hilos del worker
+    (gthread; lo fija app/server.py); None si el proceso no tiene un límite de hilos
+    (servidor de desarrollo o workers asyncio).
+    """
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def enter(self):
+        with self._lock:
+            self._in_flight += 1
+
+    def exit(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    @contextmanager
+    def track(self):
+        self.enter()
+        try:
+            yield
+        finally:
+            self.exit()
+
+    def reset_after_fork(self):
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def stats(self, probe_threads: int = 0) -> dict:
+        """
+        :param probe_threads: Hilos ocupados por la sonda que consulta (no se cuentan en
+                              `in_flight`, pero tampoco están libres para pagos).
+        """
+        in_flight = self._in_flight
+        return {"in_flight": in_flight, "capacity": self.capacity,
+                "saturation": round((in_flight + probe_threads) / self.capacity, 3) if self.capacity else None}
+
+
+class UpstreamProbe:
+    """
+    Sonda de alcanzabilidad de Khipu: cada `interval` segundos, un hilo del proceso
+    hace un HEAD a la URL base de cada comercio (sin API key, con una sesión propia
+    que no ocupa los pools de pagos) y guarda el resultado. Cualquier respuesta HTTP
+    cuenta como alcanzable; un error de conexión o timeout, no. Los resultados más
+    viejos que `stale_after` se informan como desconocidos.
+    """
+
+    def __init__(self, interval: float, timeout: float):
+        self.interval = interval
+        self.timeout = timeout
+        self.stale_after = interval * 3 + timeout
+        self._results = {}
+        self._start_lock = threading.Lock()
+        self._started_pid = None
+
+    def ensure_started(self):
+        """Arranca el hilo de la sonda en este proceso (una vez por pid; seguro tras fork)."""
+        if self._started_pid == os.getpid() or self.interval <= 0:
+            return
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            self._results = {}
+            threading.Thread(target=self._run, name="khipu-probe", daemon=True).start()
+            self._started_pid = os.getpid()
+
+    def _run(self):
+        import requests # Import diferido: solo el hilo de la sonda lo necesita
+
+        session = requests.Session()
+        while True:
+            try:
+                targets = sorted({merchant.base_url for merchant in merchant_registry.merchants.values()})
+                results = dict(self._results)
+                for url in targets:
+                    results[url] = self._check(session, requests, url)
+                self._results = results # Reemplazo atómico: la readiness lee sin locks
+            except Exception:
+                # Un error inesperado no debe matar el hilo: los resultados envejecen y /readyz lo refleja
+                logger.exception("Error en la sonda de Khipu; se reintenta en %ss", self.interval)
+            time.sleep(self.interval)
+
+    def _check(self, session, requests, url: str) -> dict:
+        started = time.perf_counter()
+        try:
+            response = session.head(url, timeout=self.timeout, allow_redirects=False)
+            result = {"reachable": True, "status_code": response.status_code}
+        except requests.RequestException as e:
+            result = {"reachable": False, "error": type(e).__name__}
+            previous = self._results.get(url)
+            if previous is None or previous["reachable"]:
+                logger.warning("Khipu no alcanzable en %s: %s", url, e)
+        result["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        result["checked_at"] = time.time()
+        return result
+
+    def results(self) -> dict:
+        """:return: Último resultado por URL; reachable es None si aún no hay uno reciente."""
+        now = time.time()
+        report = {}
+        for url in sorted({merchant.base_url for merchant in merchant_registry.merchants.values()}):
+            result = self._results.get(url)
+            if result is None or now - result["checked_at"] > self.stale_after:
+                report[url] = {"reachable": None}
+            else:
+                report[url] = dict(result, age_seconds=round(now - result["checked_at"], 3))
+        return report
+
+
+def _pool_usage(merchant) -> dict:
+    """Conexiones en uso del pool HTTP y lugares ocupados del limitador de concurrencia del comercio."""
+    hosts = merchant.session.stats()["hosts"].values()
+    limiter = merchant.limiter.stats()
+    return {"connections_in_use": sum(h["in_use"] for h in hosts), "connections_max": sum(h["maxsize"] for h in hosts),
+            "upstream_in_flight": limiter["in_flight"], "upstream_max_concurrency": limiter["max_concurrency"],
+            "upstream_waiting": limiter["waiting"]}
+
+
+def readiness() -> tuple:
+    """
+    Estado de readiness del proceso, sin I/O.
+
+    No está listo si los hilos del worker están saturados (READINESS_MAX_SATURATION), o
+    si todos los comercios tienen el circuito abierto o Khipu no es alcanzable en
+    ninguna URL (salvo con PAYMENTS_ACCEPT_MODE="always": los pagos se aceptan en el outbox).
+
+    :return: Tupla (cuerpo, listo).
+    """
+    settings = get_settings()
+    probe.ensure_started()
+    load = worker_load.stats(probe_threads=1) # Con todos los hilos ocupados, esta sonda ni se atendería
+    reachability = probe.results()
+    breakers = {name: merchant.breaker.state for name, merchant in merchant_registry.merchants.items()}
+
+    reasons = []
+    if load["saturation"] is not None and load["saturation"] >= settings.readiness_max_saturation:
+        reasons.append("saturated")
+    if settings.payments_accept_mode != "always":
+        if all(state == "open" for state in breakers.values()):
+            reasons.append("circuit_open")
+        if all(result["reachable"] is False for result in reachability.values()):
+            reasons.append("khipu_unreachable")
+    return {
+        "status": "not_ready" if reasons else "ready",
+        "reasons": reasons,
+        "pid": os.getpid(),
+        "worker": load,
+        "pools": {name: _pool_usage(merchant) for name, merchant in merchant_registry.merchants.items()},
+        "circuit_breaker": breakers,
+        "khipu": reachability,
+    }, not reasons
+
+
+def init_app(app, exclude_endpoints=()):
+    """Cuenta las solicitudes en curso del proceso (sin las sondas) para medir la saturación del worker."""
+    from flask import request, g
+
+    exclude_endpoints = frozenset(exclude_endpoints)
+
+    @app.before_request
+    def _count_request():
+        if request.endpoint not in exclude_endpoints:
+            worker_load.enter()
+            g.worker_load_counted = True
+
+    @app.teardown_request
+    def _uncount_request(error=None):
+        if g.pop("worker_load_counted", False):
+            worker_load.exit()
+
+
+def _build_probe() -> UpstreamProbe:
+    settings = get_settings()
+    return UpstreamProbe(settings.readiness_probe_interval_seconds, settings.readiness_probe_timeout_seconds)
+
+
+# Estado del proceso
+worker_load = WorkerLoad()
+probe = ProcessSingleton(_build_probe)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=worker_load.reset_after_fork)
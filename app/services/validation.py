@@ -0,0 +1,217 @@
+# app/services/validation.py
+import re
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+# Validación de payloads en una sola pasada con especificaciones de campo
+# precompiladas (una vez por proceso, al importar el módulo).
+
+URL_RE = re.compile(r"^https?://[^\s/?#]+(?:[/?#]\S*)?$", re.IGNORECASE)
+EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+# Decimales permitidos por moneda (ISO 4217)
+CURRENCY_DECIMALS = {"ARS": 2, "CLP": 0}
+
+# Un float (el número JSON que recibe Khipu) representa exactamente cualquier decimal
+# de hasta 15 dígitos significativos; con más, el monto enviado sería otro.
+MAX_AMOUNT_DIGITS = 15
+
+# Camino rápido para montos en texto ya normalizados ("150.75"): a lo sumo
+# MAX_AMOUNT_DIGITS dígitos, así el float equivale exactamente al decimal enviado.
+AMOUNT_FAST_RE = {
+    0: re.compile(r"^[0-9]{1,15}$"),
+    2: re.compile(r"^[0-9]{1,13}(?:\.[0-9]{1,2})?$"),
+}
+
+
+class ValidationError(ValueError):
+    """El payload del cliente no cumple el esquema."""
+
+    def __init__(self, message, field=None):
+        super().__init__(message)
+        self.field = field
+
+
+def _check_str(name, value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, int) and not isinstance(value, bool):
+        return str(value)
+    raise ValidationError(f"El campo '{name}' debe ser texto", name)
+
+
+def _check_url(name, value):
+    if not isinstance(value, str) or URL_RE.match(value) is None:
+        raise ValidationError(f"El campo '{name}' debe ser una URL http(s) válida", name)
+    return value
+
+
+def _check_email(name, value):
+    if not isinstance(value, str) or EMAIL_RE.match(value) is None:
+        raise ValidationError(f"El campo '{name}' debe ser un email válido", name)
+    return value
+
+
+def _check_datetime(name, value):
+    if isinstance(value, str):
+        try:
+            # fromisoformat acepta 'Z' recién desde Python 3.11
+            datetime.fromisoformat(value[:-1] + "+00:00" if value.endswith("Z") else value)
+            return value
+        except ValueError:
+            pass
+    raise ValidationError(f"El campo '{name}' debe ser una fecha ISO 8601 (ej. 2025-01-31T23:59:59Z)", name)
+
+
+def _check_any(name, value):
+    return value
+
+
+CHECKS = {
+    "str": _check_str,
+    "url": _check_url,
+    "email": _check_email,
+    "datetime": _check_datetime,
+    "any": _check_any,
+}
+
+
+# Verificación rápida (sin llamada a función) para valores str: regex precompilada,
+# o None si cualquier texto es válido. Los demás tipos pasan por CHECKS.
+FAST_MATCHERS = {
+    "str": None,
+    "url": URL_RE.match,
+    "email": EMAIL_RE.match,
+}
+
+
+class FieldSpec:
+    """Especificación reutilizable de un campo opcional del payload."""
+    __slots__ = ("name", "check", "fast", "match", "default")
+
+    def __init__(self, name: str, kind: str = "str", default=None):
+        self.name = name
+        self.check = CHECKS[kind]
+        self.fast = kind in FAST_MATCHERS
+        self.match = FAST_MATCHERS.get(kind)
+        self.default = default
+
+
+def parse_amount(value, currency: str) -> Decimal:
+    """
+    Convierte el monto a Decimal sin pasar por float y valida que sea positivo,
+    que no tenga más decimales que los que admite la moneda y que no supere
+    MAX_AMOUNT_DIGITS dígitos significativos.
+    """
+    if isinstance(value, bool) or not isinstance(value, (str, int, float, Decimal)):
+        raise ValidationError("El campo 'amount' debe ser un número válido", "amount")
+    try:
+        # str(float) da la representación decimal más corta, que es la que envió el cliente
+        amount = Decimal(value.strip() if isinstance(value, str) else str(value))
+    except InvalidOperation:
+        raise ValidationError("El campo 'amount' debe ser un número válido", "amount")
+    if not amount.is_finite():
+        raise ValidationError("El campo 'amount' debe ser un número válido", "amount")
+    if amount <= 0:
+        raise ValidationError("El monto debe ser mayor que cero", "amount")
+    decimals = CURRENCY_DECIMALS.get(currency, 2)
+    if amount.as_tuple().exponent < -decimals and amount != amount.quantize(Decimal(1).scaleb(-decimals)):
+        raise ValidationError(f"El monto admite como máximo {decimals} decimales para {currency}", "amount")
+    if len(amount.normalize().as_tuple().digits) > MAX_AMOUNT_DIGITS:
+        raise ValidationError(f"El monto admite como máximo {MAX_AMOUNT_DIGITS} dígitos significativos", "amount")
+    return amount
+
+
+def amount_to_json(amount: Decimal, currency: str):
+    """
+    Número JSON para Khipu: int si la moneda no tiene decimales; si no, float.
+    Con montos validados por `parse_amount` (a lo sumo MAX_AMOUNT_DIGITS dígitos
+    significativos) la representación más corta del float coincide exactamente
+    con el Decimal.
+    """
+    if CURRENCY_DECIMALS.get(currency, 2) == 0:
+        return int(amount)
+    return float(amount)
+
+
+class PaymentSchema:
+    """
+    Esquema compilado del payload de creación de pagos.
+    `validate` recorre las especificaciones una sola vez y construye el payload
+    para Khipu sin incluir los campos ausentes.
+    """
+
+    def __init__(self, optional_fields, allowed_currencies=("ARS",), amount_limits=None):
+        self.optional_fields = tuple(optional_fields)
+        self.allowed_currencies = frozenset(allowed_currencies)
+        # Moneda -> (mínimo, máximo) como Decimal, o None si ese extremo no tiene límite
+        self.amount_limits = dict(amount_limits or {})
+
+    def validate(self, data: dict) -> dict:
+        if not isinstance(data, dict):
+            raise ValidationError("El cuerpo de la solicitud debe ser un objeto JSON")
+
+        subject = data.get("subject")
+        amount_raw = data.get("amount")
+        currency = data.get("currency")
+        if not subject or amount_raw in (None, "") or not currency:
+            raise ValidationError("Faltan campos obligatorios: subject, amount, currency")
+        if currency.__class__ is not str:
+            # Antes de buscarla en el frozenset: una lista u objeto JSON no es hashable
+            raise ValidationError("El campo 'currency' debe ser texto", "currency")
+        if currency not in self.allowed_currencies:
+            raise ValidationError(f"Moneda no válida para la API Key configurada. Usar {', '.join(sorted(self.allowed_currencies))}.",
+                                  "currency")
+
+        payload = {
+            "subject": subject if subject.__class__ is str else _check_str("subject", subject),
+            "amount": self._amount(amount_raw, currency),
+            "currency": currency,
+        }
+        limits = self.amount_limits.get(currency)
+        if limits is not None:
+            _check_amount_limits(payload["amount"], currency, limits)
+        for spec in self.optional_fields:
+            value = data.get(spec.name, spec.default)
+            if value is None:
+                continue
+            if spec.fast and value.__class__ is str and (spec.match is None or spec.match(value) is not None):
+                payload[spec.name] = value
+            else:
+                payload[spec.name] = spec.check(spec.name, value)
+        return payload
+
+    @staticmethod
+    def _amount(value, currency: str):
+        decimals = CURRENCY_DECIMALS.get(currency, 2)
+        fast_re = AMOUNT_FAST_RE.get(decimals)
+        if value.__class__ is str and fast_re is not None and fast_re.match(value) is not None:
+            amount = int(value) if decimals == 0 else float(value)
+            if amount > 0:
+                return amount
+        # Camino general (números JSON, espacios, notación científica, errores): Decimal exacto
+        return amount_to_json(parse_amount(value, currency), currency)
+
+
+def _check_amount_limits(amount, currency: str, limits: tuple):
+    # int/float contra Decimal se compara en forma exacta
+    minimum, maximum = limits
+    if minimum is not None and amount < minimum:
+        raise ValidationError(f"El monto mínimo para {currency} es {minimum}", "amount")
+    if maximum is not None and amount > maximum:
+        raise ValidationError(f"El monto máximo para {currency} es {maximum}", "amount")
+
+
+def payment_optional_fields(default_notify_api_version: str):
+    return (
+        FieldSpec("transaction_id"),
+        FieldSpec("custom", "any"), # Se envía tal cual, como antes de la validación (objetos y arreglos incluidos)
+        FieldSpec("body"),
+        FieldSpec("payer_email", "email"),
+        FieldSpec("return_url", "url"),
+        FieldSpec("cancel_url", "url"),
+        FieldSpec("notify_url", "url"),
+        FieldSpec("picture_url", "url"),
+        FieldSpec("notify_api_version", default=default_notify_api_version),
+        FieldSpec("expires_date", "datetime"),
+    )
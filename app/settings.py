@@ -0,0 +1,317 @@
+# app/settings.py
+import os
+import logging
+import threading
+from dataclasses import dataclass, fields
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Configuración del servicio leída una sola vez del entorno (y del .env, si existe)
+# en un objeto inmutable. El código de las solicitudes usa get_settings() en lugar
+# de consultar os.environ en cada llamada.
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def _clean(value: str) -> str:
+    # Tolerar valores con comillas o espacios, habituales en archivos .env
+    return value.strip().strip("'").strip('"')
+
+
+def _env_str(environ, name: str, default=None):
+    value = environ.get(name)
+    return _clean(value) if value is not None else default
+
+
+def _env_bool(environ, name: str, default: bool) -> bool:
+    value = environ.get(name)
+    if value is None:
+        return default
+    return _clean(value).lower() in ("true", "1", "t")
+
+
+def _env_number(environ, name: str, default, cast):
+    value = environ.get(name)
+    if value is None:
+        return default
+    try:
+        return cast(_clean(value))
+    except ValueError:
+        logger.warning("Valor inválido para %s. Usando %s.", name, default)
+        return default
+
+
+def _env_list(environ, name: str, default: tuple) -> tuple:
+    value = environ.get(name)
+    if value is None:
+        return default
+    items = tuple(item.strip() for item in _clean(value).split(",") if item.strip())
+    return items or default
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Configuración inmutable del proceso. Los nombres de variable de entorno están en `from_env`."""
+
+    # Servidor de desarrollo y logging
+    host: str = "0.0.0.0"
+    port: int = 8000
+    debug: bool = False
+    log_level: str = "INFO"
+    log_format: str = "text"
+    log_queue_size: int = 10000
+    log_sample_rates: str = "" # "logger=tasa,..." (ver app/logging_config.py)
+    json_codec: str = "orjson" # "stdlib" para no usar orjson aunque esté instalado
+
+    # Khipu
+    khipu_merchant_api_key: Optional[str] = None
+    khipu_target_api_url: str = "https://payment-api.khipu.com"
+    khipu_notification_secret: Optional[str] = None
+    khipu_notification_tolerance_seconds: float = 300.0
+    khipu_currencies: tuple = ("ARS",)
+
+    # Varios comercios (cuentas de cobrador): ver app/services/merchants.py
+    khipu_merchants_file: Optional[str] = None
+    khipu_merchants: Optional[str] = None
+    khipu_tenant_header: str = "X-Tenant-Id"
+
+    # Conexiones salientes
+    connect_timeout_seconds: float = 3.05
+    read_timeout_seconds: float = 30.0
+    http_pool_connections: int = 4
+    http_pool_maxsize: int = 20
+    async_max_connections: int = 200
+
+    # Reintentos y circuit breaker
+    max_retries: int = 2
+    retry_backoff_base_seconds: float = 0.2
+    retry_backoff_max_seconds: float = 2.0
+    request_deadline_seconds: float = 35.0
+    breaker_failure_rate: float = 0.5
+    breaker_slow_call_rate: float = 0.8
+    breaker_slow_call_seconds: float = 10.0
+    breaker_window: int = 20
+    breaker_min_calls: int = 10
+    breaker_open_seconds: float = 15.0
+    breaker_half_open_calls: int = 3
+
+    # Lotes
+    batch_max_items: int = 1000
+    batch_concurrency: int = 8
+    batch_max_concurrency: int = 32
+
+    # Idempotencia, caché de estado y cola de notificaciones
+    idempotency_max_entries: int = 10000
+    idempotency_ttl_seconds: float = 24 * 60 * 60
+    idempotency_wait_timeout_seconds: float = 40.0
+    payment_status_cache_max_entries: int = 50000
+    payment_status_pending_ttl_seconds: float = 2.0
+    payment_status_terminal_ttl_seconds: float = 60.0 # Demora máxima de una reversa en los demás workers
+    notifications_db_path: str = os.path.join("data", "notifications.db")
+    notifications_workers: int = 2
+    notifications_max_attempts: int = 8
+    notifications_retention_days: float = 7.0 # Antigüedad de las filas 'done' antes de borrarlas (0 = nunca)
+
+    # Modo aceptado de POST /v3/payments: outbox durable y despachador (payment_outbox.py)
+    payments_accept_mode: str = "off"
+    payment_outbox_db_path: str = os.path.join("data", "payment_outbox.db")
+    payment_outbox_concurrency: int = 8
+    payment_outbox_batch_size: int = 32
+    payment_outbox_max_attempts: int = 20
+
+    # Control de admisión (rate limiting y concurrencia hacia Khipu)
+    rate_limit_enabled: bool = True
+    rate_limit_store: str = "shm"
+    rate_limit_shm_path: str = "/dev/shm/khipu-payments-ratelimit"
+    rate_limit_shm_slots: int = 4096
+    rate_limit_client_header: Optional[str] = None # Solo una cabecera autenticada aguas arriba
+    rate_limit_client_rate: float = 20.0
+    rate_limit_client_burst: float = 40.0
+    trusted_proxy_hops: int = 0 # Proxies de confianza delante del servicio (X-Forwarded-For)
+    khipu_rate_limit_per_second: float = 0.0
+    khipu_rate_limit_burst: float = 0.0
+    khipu_max_concurrency: int = 64
+    khipu_max_queue: int = 256
+    khipu_queue_timeout_seconds: float = 5.0
+
+    # Liveness / readiness (app/services/readiness.py)
+    readiness_probe_interval_seconds: float = 10.0
+    readiness_probe_timeout_seconds: float = 2.0
+    readiness_max_saturation: float = 1.0
+
+    # Métricas (app/metrics.py)
+    metrics_enabled: bool = True
+    metrics_multiproc_dir: Optional[str] = None # app/server.py lo define para sumar los workers
+
+    # Trazas distribuidas (app/tracing.py)
+    tracing_enabled: bool = True
+    trace_sample_rate: float = 0.05
+    trace_exporter: str = "stdout"
+    trace_file_path: str = os.path.join("data", "traces.jsonl")
+    trace_queue_size: int = 10000
+
+    @classmethod
+    def from_env(cls, environ=None) -> "Settings":
+        environ = os.environ if environ is None else environ
+        d = {f.name: f.default for f in fields(cls)}
+        return cls(
+            host=_env_str(environ, "FLASK_RUN_HOST", d["host"]),
+            port=_env_number(environ, "FLASK_RUN_PORT", _env_number(environ, "PORT", d["port"], int), int),
+            debug=_env_bool(environ, "FLASK_DEBUG", d["debug"]),
+            log_level=_env_str(environ, "LOG_LEVEL", d["log_level"]).upper(),
+            log_format=_env_str(environ, "LOG_FORMAT", d["log_format"]).lower(),
+            log_queue_size=_env_number(environ, "LOG_QUEUE_SIZE", d["log_queue_size"], int),
+            log_sample_rates=_env_str(environ, "LOG_SAMPLE_RATES", d["log_sample_rates"]),
+            json_codec=_env_str(environ, "JSON_CODEC", d["json_codec"]).lower(),
+            khipu_merchant_api_key=_env_str(environ, "KHIPU_MERCHANT_API_KEY") or None,
+            khipu_target_api_url=_env_str(environ, "KHIPU_TARGET_API_URL", d["khipu_target_api_url"]),
+            khipu_notification_secret=_env_str(environ, "KHIPU_NOTIFICATION_SECRET") or None,
+            khipu_notification_tolerance_seconds=_env_number(environ, "KHIPU_NOTIFICATION_TOLERANCE_SECONDS",
+                                                             d["khipu_notification_tolerance_seconds"], float),
+            khipu_currencies=_env_list(environ, "KHIPU_CURRENCIES", d["khipu_currencies"]),
+            khipu_merchants_file=_env_str(environ, "KHIPU_MERCHANTS_FILE") or None,
+            khipu_merchants=_env_str(environ, "KHIPU_MERCHANTS") or None,
+            khipu_tenant_header=_env_str(environ, "KHIPU_TENANT_HEADER", d["khipu_tenant_header"]),
+            connect_timeout_seconds=_env_number(environ, "KHIPU_CONNECT_TIMEOUT_SECONDS", d["connect_timeout_seconds"], float),
+            read_timeout_seconds=_env_number(environ, "KHIPU_READ_TIMEOUT_SECONDS", d["read_timeout_seconds"], float),
+            http_pool_connections=_env_number(environ, "KHIPU_HTTP_POOL_CONNECTIONS", d["http_pool_connections"], int),
+            http_pool_maxsize=_env_number(environ, "KHIPU_HTTP_POOL_MAXSIZE", d["http_pool_maxsize"], int),
+            async_max_connections=_env_number(environ, "KHIPU_ASYNC_MAX_CONNECTIONS", d["async_max_connections"], int),
+            max_retries=_env_number(environ, "KHIPU_MAX_RETRIES", d["max_retries"], int),
+            retry_backoff_base_seconds=_env_number(environ, "KHIPU_RETRY_BACKOFF_BASE_SECONDS",
+                                                   d["retry_backoff_base_seconds"], float),
+            retry_backoff_max_seconds=_env_number(environ, "KHIPU_RETRY_BACKOFF_MAX_SECONDS",
+                                                  d["retry_backoff_max_seconds"], float),
+            request_deadline_seconds=_env_number(environ, "KHIPU_REQUEST_DEADLINE_SECONDS",
+                                                 d["request_deadline_seconds"], float),
+            breaker_failure_rate=_env_number(environ, "KHIPU_BREAKER_FAILURE_RATE", d["breaker_failure_rate"], float),
+            breaker_slow_call_rate=_env_number(environ, "KHIPU_BREAKER_SLOW_CALL_RATE", d["breaker_slow_call_rate"], float),
+            breaker_slow_call_seconds=_env_number(environ, "KHIPU_BREAKER_SLOW_CALL_SECONDS",
+                                                  d["breaker_slow_call_seconds"], float),
+            breaker_window=_env_number(environ, "KHIPU_BREAKER_WINDOW", d["breaker_window"], int),
+            breaker_min_calls=_env_number(environ, "KHIPU_BREAKER_MIN_CALLS", d["breaker_min_calls"], int),
+            breaker_open_seconds=_env_number(environ, "KHIPU_BREAKER_OPEN_SECONDS", d["breaker_open_seconds"], float),
+            breaker_half_open_calls=_env_number(environ, "KHIPU_BREAKER_HALF_OPEN_CALLS", d["breaker_half_open_calls"], int),
+            batch_max_items=_env_number(environ, "BATCH_MAX_ITEMS", d["batch_max_items"], int),
+            batch_concurrency=_env_number(environ, "BATCH_CONCURRENCY", d["batch_concurrency"], int),
+            batch_max_concurrency=_env_number(environ, "BATCH_MAX_CONCURRENCY", d["batch_max_concurrency"], int),
+            idempotency_max_entries=_env_number(environ, "IDEMPOTENCY_MAX_ENTRIES", d["idempotency_max_entries"], int),
+            idempotency_ttl_seconds=_env_number(environ, "IDEMPOTENCY_TTL_SECONDS", d["idempotency_ttl_seconds"], float),
+            idempotency_wait_timeout_seconds=_env_number(environ, "IDEMPOTENCY_WAIT_TIMEOUT_SECONDS",
+                                                         d["idempotency_wait_timeout_seconds"], float),
+            payment_status_cache_max_entries=_env_number(environ, "PAYMENT_STATUS_CACHE_MAX_ENTRIES",
+                                                         d["payment_status_cache_max_entries"], int),
+            payment_status_pending_ttl_seconds=_env_number(environ, "PAYMENT_STATUS_PENDING_TTL_SECONDS",
+                                                           d["payment_status_pending_ttl_seconds"], float),
+            payment_status_terminal_ttl_seconds=_env_number(environ, "PAYMENT_STATUS_TERMINAL_TTL_SECONDS",
+                                                            d["payment_status_terminal_ttl_seconds"], float),
+            notifications_db_path=_env_str(environ, "NOTIFICATIONS_DB_PATH", d["notifications_db_path"]),
+            notifications_workers=_env_number(environ, "NOTIFICATIONS_WORKERS", d["notifications_workers"], int),
+            notifications_max_attempts=_env_number(environ, "NOTIFICATIONS_MAX_ATTEMPTS", d["notifications_max_attempts"], int),
+            notifications_retention_days=_env_number(environ, "NOTIFICATIONS_RETENTION_DAYS",
+                                                     d["notifications_retention_days"], float),
+            payments_accept_mode=_env_str(environ, "PAYMENTS_ACCEPT_MODE", d["payments_accept_mode"]).lower(),
+            payment_outbox_db_path=_env_str(environ, "PAYMENT_OUTBOX_DB_PATH", d["payment_outbox_db_path"]),
+            payment_outbox_concurrency=_env_number(environ, "PAYMENT_OUTBOX_CONCURRENCY", d["payment_outbox_concurrency"], int),
+            payment_outbox_batch_size=_env_number(environ, "PAYMENT_OUTBOX_BATCH_SIZE", d["payment_outbox_batch_size"], int),
+            payment_outbox_max_attempts=_env_number(environ, "PAYMENT_OUTBOX_MAX_ATTEMPTS", d["payment_outbox_max_attempts"], int),
+            rate_limit_enabled=_env_bool(environ, "RATE_LIMIT_ENABLED", d["rate_limit_enabled"]),
+            rate_limit_store=_env_str(environ, "RATE_LIMIT_STORE", d["rate_limit_store"]).lower(),
+            rate_limit_shm_path=_env_str(environ, "RATE_LIMIT_SHM_PATH", d["rate_limit_shm_path"]),
+            rate_limit_shm_slots=_env_number(environ, "RATE_LIMIT_SHM_SLOTS", d["rate_limit_shm_slots"], int),
+            rate_limit_client_header=_env_str(environ, "RATE_LIMIT_CLIENT_HEADER") or None,
+            rate_limit_client_rate=_env_number(environ, "RATE_LIMIT_CLIENT_RATE", d["rate_limit_client_rate"], float),
+            rate_limit_client_burst=_env_number(environ, "RATE_LIMIT_CLIENT_BURST", d["rate_limit_client_burst"], float),
+            trusted_proxy_hops=_env_number(environ, "TRUSTED_PROXY_HOPS", d["trusted_proxy_hops"], int),
+            khipu_rate_limit_per_second=_env_number(environ, "KHIPU_RATE_LIMIT_PER_SECOND", d["khipu_rate_limit_per_second"], float),
+            khipu_rate_limit_burst=_env_number(environ, "KHIPU_RATE_LIMIT_BURST", d["khipu_rate_limit_burst"], float),
+            khipu_max_concurrency=_env_number(environ, "KHIPU_MAX_CONCURRENCY", d["khipu_max_concurrency"], int),
+            khipu_max_queue=_env_number(environ, "KHIPU_MAX_QUEUE", d["khipu_max_queue"], int),
+            khipu_queue_timeout_seconds=_env_number(environ, "KHIPU_QUEUE_TIMEOUT_SECONDS", d["khipu_queue_timeout_seconds"], float),
+            readiness_probe_interval_seconds=_env_number(environ, "READINESS_PROBE_INTERVAL_SECONDS",
+                                                         d["readiness_probe_interval_seconds"], float),
+            readiness_probe_timeout_seconds=_env_number(environ, "READINESS_PROBE_TIMEOUT_SECONDS",
+                                                        d["readiness_probe_timeout_seconds"], float),
+            readiness_max_saturation=_env_number(environ, "READINESS_MAX_SATURATION", d["readiness_max_saturation"], float),
+            metrics_enabled=_env_bool(environ, "METRICS_ENABLED", d["metrics_enabled"]),
+            metrics_multiproc_dir=_env_str(environ, "METRICS_MULTIPROC_DIR") or None,
+            tracing_enabled=_env_bool(environ, "TRACING_ENABLED", d["tracing_enabled"]),
+            trace_sample_rate=_env_number(environ, "TRACE_SAMPLE_RATE", d["trace_sample_rate"], float),
+            trace_exporter=_env_str(environ, "TRACE_EXPORTER", d["trace_exporter"]).lower(),
+            trace_file_path=_env_str(environ, "TRACE_FILE_PATH", d["trace_file_path"]),
+            trace_queue_size=_env_number(environ, "TRACE_QUEUE_SIZE", d["trace_queue_size"], int),
+        )
+
+
+_settings = None
+
+
+def get_settings() -> Settings:
+    """Devuelve la configuración del proceso, leyéndola del entorno la primera vez."""
+    global _settings
+    if _settings is None:
+        _settings = Settings.from_env()
+    return _settings
+
+
+def reload_settings(environ=None) -> Settings:
+    """
+    Vuelve a leer la configuración (p. ej. en scripts que cambian el entorno).
+    Los componentes ya creados con la configuración anterior (pools, breaker,
+    cachés) no se reconstruyen.
+    """
+    global _settings
+    _settings = Settings.from_env(environ)
+    return _settings
+
+
+class ProcessSingleton:
+    """
+    Objeto compartido por el proceso que se construye con `factory()` en su primer
+    uso, no al importar el módulo que lo define. get_settings() congela la
+    configuración la primera vez que se llama, y run.py / python -m app cargan el
+    .env después de importar el paquete: un singleton creado al importar leería
+    la configuración sin el .env. Los atributos se delegan al objeto construido.
+    """
+
+    def __init__(self, factory):
+        object.__setattr__(self, "_singleton_factory", factory)
+        object.__setattr__(self, "_singleton_instance", None)
+        object.__setattr__(self, "_singleton_lock", threading.Lock())
+
+    def _singleton(self):
+        instance = self._singleton_instance
+        if instance is None:
+            with self._singleton_lock:
+                instance = self._singleton_instance
+                if instance is None:
+                    instance = self._singleton_factory()
+                    object.__setattr__(self, "_singleton_instance", instance)
+        return instance
+
+    def __getattr__(self, name):
+        return getattr(self._singleton(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._singleton(), name, value)
+
+    def __repr__(self):
+        instance = self._singleton_instance
+        return f"<ProcessSingleton {instance!r}>" if instance is not None else "<ProcessSingleton (sin construir)>"
+
+
+def load_env_file(path: str = None) -> bool:
+    """
+    Carga variables desde un archivo .env (por defecto, en la raíz del proyecto) sin
+    sobrescribir las ya definidas. python-dotenv se importa solo si el archivo existe:
+    en contenedores la configuración llega por el entorno y no hace falta.
+    """
+    path = path or os.path.join(PROJECT_ROOT, ".env")
+    if not os.path.exists(path):
+        print(f"No .env file found at {path}. Using system/container environment variables.")
+        return False
+    from dotenv import load_dotenv # Import diferido
+    print(f"Loading .env file from: {path}")
+    load_dotenv(dotenv_path=path, verbose=True)
+    return True
@@ -0,0 +1,392 @@
+# app/tracing.py
+import os
+import re
+import sys
+import json
+import time
+import queue
+import random
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from app.settings import get_settings, ProcessSingleton
+
+logger = logging.getLogger(__name__)
+
+# Trazas distribuidas livianas, sin dependencias: contexto W3C Trace Context
+# (cabecera `traceparent`), spans por solicitud, validación y llamada a Khipu, y
+# un exportador enchufable que corre en un hilo aparte. El muestreo se decide una
+# vez al inicio de la traza (head-based): si llega un `traceparent` se respeta su
+# decisión; si no, se muestrea con probabilidad TRACE_SAMPLE_RATE. Los spans no
+# muestreados igual propagan el trace_id (cabeceras y logs), pero no se exportan.
+
+TRACEPARENT_RE = re.compile(r"^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+INVALID_TRACE_ID = "0" * 32
+INVALID_SPAN_ID = "0" * 16
+DEFAULT_BATCH_SIZE = 256
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def _new_id(nbytes: int) -> str:
+    return os.urandom(nbytes).hex()
+
+
+class SpanContext:
+    """Identidad de un span remoto (leída de `traceparent`)."""
+    __slots__ = ("trace_id", "span_id", "sampled")
+
+    def __init__(self, trace_id: str, span_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.sampled = sampled
+
+
+def parse_traceparent(header):
+    """:return: SpanContext de la cabecera `traceparent`, o None si falta o no es válida."""
+    if not header:
+        return None
+    match = TRACEPARENT_RE.match(header.strip().lower())
+    if match is None:
+        return None
+    version, trace_id, span_id, flags = match.groups()
+    if version == "ff" or trace_id == INVALID_TRACE_ID or span_id == INVALID_SPAN_ID:
+        return None
+    return SpanContext(trace_id, span_id, bool(int(flags, 16) & 0x01))
+
+
+class Span:
+    """
+    Operación medida dentro de una traza. Solo los spans muestreados guardan
+    atributos y se exportan al terminar; los demás solo llevan los identificadores.
+    """
+    __slots__ = ("name", "kind", "trace_id", "span_id", "parent_id", "sampled", "attributes",
+                 "status", "start_time", "duration", "_started")
+
+    def __init__(self, name: str, trace_id: str, parent_id, sampled: bool, kind: str = "internal", attributes=None):
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = dict(attributes) if sampled and attributes else {}
+        self.status = "ok"
+        self.start_time = time.time()
+        self.duration = None
+        self._started = time.perf_counter()
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def set_attribute(self, key: str, value):
+        if self.sampled:
+            self.attributes[key] = value
+
+    def record_error(self, error: BaseException):
+        self.status = "error"
+        if self.sampled:
+            self.attributes["error.type"] = type(error).__name__
+            self.attributes["error.message"] = str(error)
+
+    def end(self):
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._started
+        if self.sampled:
+            span_processor.submit(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "start": self.start_time,
+            "duration_ms": round(self.duration * 1000, 3) if self.duration is not None else None,
+            "status": self.status,
+            "attributes": self.attributes,
+            "pid": os.getpid(),
+        }
+
+
+class Tracer:
+    """Crea spans hijos del span actual (contextvars) y decide el muestreo de las trazas nuevas."""
+
+    def __init__(self, sample_rate: float, enabled: bool = True):
+        self.sample_rate = sample_rate
+        self.enabled = enabled
+
+    def _sample(self) -> bool:
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+    def new_span(self, name: str, kind: str = "internal", attributes=None, remote=None) -> Span:
+        """Span hijo del actual; si no hay, raíz de una traza nueva o continuación de `remote`."""
+        parent = _current_span.get()
+        if parent is not None:
+            return Span(name, parent.trace_id, parent.span_id, parent.sampled, kind, attributes)
+        if remote is not None:
+            return Span(name, remote.trace_id, remote.span_id, remote.sampled, kind, attributes)
+        return Span(name, _new_id(16), None, self._sample(), kind, attributes)
+
+
+def current_span():
+    """Span activo en el contexto actual (hilo o tarea asyncio), o None."""
+    return _current_span.get()
+
+
+@contextmanager
+def span(name: str, kind: str = "internal", **attributes):
+    """
+    Context manager que mide una operación como span hijo del actual. Si el span
+    termina con una excepción se marca como error y la excepción se propaga.
+    """
+    if not tracer.enabled:
+        yield None
+        return
+    current = tracer.new_span(name, kind, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.record_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end()
+
+
+def start_request_span(name: str, traceparent=None, kind: str = "server", **attributes):
+    """
+    Abre el span raíz de una solicitud entrante (o de un trabajo en segundo plano,
+    con kind="consumer"), continuando `traceparent` si viene, y lo deja como span
+    actual. Se cierra con `end_request_span`.
+
+    :return: Tupla (span, token) o (None, None) si el tracing está desactivado.
+    """
+    if not tracer.enabled:
+        return None, None
+    request_span = tracer.new_span(name, kind, attributes, remote=parse_traceparent(traceparent))
+    return request_span, _current_span.set(request_span)
+
+
+def end_request_span(request_span, token, status_code=None):
+    if request_span is None:
+        return
+    if status_code is not None:
+        request_span.set_attribute("http.status_code", status_code)
+        if status_code >= 500:
+            request_span.status = "error"
+    _reset_current(token)
+    request_span.end()
+
+
+def _reset_current(token):
+    try:
+        _current_span.reset(token)
+    except ValueError: # El token es de otro contexto (p. ej. teardown en otro hilo)
+        _current_span.set(None)
+
+
+def inject(headers: dict) -> dict:
+    """Cabeceras salientes con el `traceparent` del span actual (sin modificar las originales)."""
+    active = _current_span.get()
+    if active is None:
+        return headers
+    return dict(headers, traceparent=active.traceparent)
+
+
+# --- Exportadores -------------------------------------------------------------
+
+class SpanExporter:
+    """Interfaz del exportador: recibe lotes de spans terminados (dicts) desde el hilo del procesador."""
+
+    def export(self, spans: list):
+        raise NotImplementedError
+
+    def shutdown(self):
+        pass
+
+
+class StdoutSpanExporter(SpanExporter):
+    """Una línea JSON por span en stdout (junto a los logs del contenedor)."""
+
+    def export(self, spans: list):
+        sys.stdout.write("".join(json.dumps({"span": s}, default=str) + "\n" for s in spans))
+        sys.stdout.flush()
+
+
+class FileSpanExporter(SpanExporter):
+    """Una línea JSON por span, agregada al archivo indicado (un archivo por host; cada línea lleva el pid)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self._pid = None
+
+    def export(self, spans: list):
+        if self._file is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+            self._pid = os.getpid()
+        self._file.write("".join(json.dumps(s, default=str) + "\n" for s in spans))
+        self._file.flush()
+
+    def shutdown(self):
+        if self._file is not None and self._pid == os.getpid():
+            self._file.close()
+        self._file = None
+
+
+class NoopSpanExporter(SpanExporter):
+    def export(self, spans: list):
+        pass
+
+
+class SpanProcessor:
+    """
+    Cola acotada de spans terminados y un hilo que los exporta por lotes, así la
+    solicitud nunca espera por I/O. Si la cola se llena, los spans se descartan.
+    """
+
+    def __init__(self, exporter: SpanExporter, max_queue: int = 10000, batch_size: int = DEFAULT_BATCH_SIZE):
+        self.exporter = exporter
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._pid = None
+        self.exported = 0
+        self.dropped = 0
+
+    def submit(self, finished: Span):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(finished)
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                threading.Thread(target=self._run, name="span-exporter", daemon=True).start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.exporter.export([s.to_dict() for s in batch])
+                self.exported += len(batch)
+            except Exception:
+                logger.warning("No se pudieron exportar %s spans", len(batch), exc_info=True)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def flush(self):
+        """Espera a que se exporten los spans encolados (benchmarks y scripts)."""
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    def reset_after_fork(self):
+        # El hilo no sobrevive al fork; los spans heredados en la cola se descartan
+        self._queue = queue.Queue(maxsize=self._queue.maxsize)
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def stats(self) -> dict:
+        return {"exporter": type(self.exporter).__name__, "sample_rate": tracer.sample_rate,
+                "exported": self.exported, "dropped": self.dropped, "queued": self._queue.qsize()}
+
+
+def _build_exporter(settings) -> SpanExporter:
+    if settings.trace_exporter == "file":
+        return FileSpanExporter(settings.trace_file_path)
+    if settings.trace_exporter == "none":
+        return NoopSpanExporter()
+    return StdoutSpanExporter()
+
+
+def set_exporter(exporter: SpanExporter):
+    """Reemplaza el exportador de spans (p. ej. por uno OTLP o de un proveedor de APM)."""
+    span_processor.exporter = exporter
+
+
+# --- Integración con Flask ----------------------------------------------------
+
+def init_app(app, exclude_endpoints=()):
+    """
+    Registra el middleware de trazas: un span raíz por solicitud (continuando el
+    `traceparent` entrante), el atributo de código HTTP, y las cabeceras de respuesta
+    `X-Request-ID` (la del cliente o el trace_id) y `traceresponse`.
+    """
+    from flask import request, g
+
+    exclude_endpoints = frozenset(exclude_endpoints)
+
+    @app.before_request
+    def _start_trace():
+        if request.endpoint in exclude_endpoints:
+            return
+        route = request.url_rule.rule if request.url_rule is not None else request.path
+        g.trace_span, g.trace_token = start_request_span(
+            f"{request.method} {route}", request.headers.get("traceparent"),
+            **{"http.method": request.method, "http.route": route})
+        if g.trace_span is not None:
+            g.request_id = request.headers.get("X-Request-ID") or g.trace_span.trace_id
+            g.trace_span.set_attribute("request_id", g.request_id)
+
+    @app.after_request
+    def _trace_headers(response):
+        request_span = g.get("trace_span")
+        if request_span is not None:
+            request_span.set_attribute("http.status_code", response.status_code)
+            response.headers["X-Request-ID"] = g.request_id
+            response.headers["traceresponse"] = request_span.traceparent
+            if response.is_streamed:
+                # Respuestas en streaming (lotes): el span dura hasta enviar el último byte
+                g.trace_streamed = True
+                response.call_on_close(request_span.end)
+        return response
+
+    @app.teardown_request
+    def _end_trace(error=None):
+        request_span = g.pop("trace_span", None)
+        if request_span is None:
+            return
+        if error is not None:
+            request_span.record_error(error)
+        if g.pop("trace_streamed", False) and error is None:
+            _reset_current(g.pop("trace_token", None))
+            return
+        end_request_span(request_span, g.pop("trace_token", None),
+                         request_span.attributes.get("http.status_code", 500 if error is not None else None))
+
+
+def _build_tracer() -> Tracer:
+    settings = get_settings()
+    return Tracer(min(max(settings.trace_sample_rate, 0.0), 1.0), enabled=settings.tracing_enabled)
+
+
+def _build_span_processor() -> SpanProcessor:
+    settings = get_settings()
+    processor = SpanProcessor(_build_exporter(settings), max_queue=settings.trace_queue_size)
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=processor.reset_after_fork)
+    return processor
+
+
+# Se construyen en el primer uso: este módulo se importa (vía logging_config) antes
+# de que los puntos de entrada carguen el .env
+tracer = ProcessSingleton(_build_tracer)
+span_processor = ProcessSingleton(_build_span_processor)
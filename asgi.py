@@ -0,0 +1,8 @@
+# asgi.py
+# Punto de entrada ASGI, equivalente a run.py para servidores asíncronos:
+#   uvicorn asgi:application --host 0.0.0.0 --port 8000
+# POST /v3/payments se atiende con asyncio; el resto de rutas pasa por la app Flask.
+from run import application as wsgi_application # Carga .env y crea la app con la fábrica
+from app.asgi import create_asgi_app
+
+application = create_asgi_app(wsgi_application)
@@ -0,0 +1,222 @@
+# benchmarks/bench_startup.py
+"""
+Benchmark de arranque en frío: tiempo de import/creación de la app y memoria por worker.
+
+1. Procesos nuevos (--runs): en cada uno mide el import de `app`, `create_app()` y la
+   primera solicitud, junto con el RSS del proceso después de cada etapa.
+2. Servidor de producción (--workers N, solo Linux): levanta `python -m app.server`
+   con N workers, mide el tiempo hasta responder y lee RSS y PSS (memoria
+   proporcional, descuenta lo compartido copy-on-write) del master y de cada worker.
+
+Uso (desde la raíz del proyecto):
+    python -m benchmarks.bench_startup --runs 10 --workers 4 --output bench_results_startup.json
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime, timezone
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Se ejecuta en un intérprete nuevo: nada importado de antemano
+_PROBE = r"""
+import sys, time, json
+t0 = time.perf_counter()
+
+def rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+from app import create_app
+t1 = time.perf_counter()
+rss_import = rss_mb()
+application = create_app()
+t2 = time.perf_counter()
+rss_app = rss_mb()
+response = application.test_client().get("/v3/health_check_payments")
+t3 = time.perf_counter()
+with open(sys.argv[1], "w") as out:
+    json.dump({
+        "import_ms": (t1 - t0) * 1000, "create_app_ms": (t2 - t1) * 1000, "first_request_ms": (t3 - t2) * 1000,
+        "rss_after_import_mb": rss_import, "rss_after_create_app_mb": rss_app, "rss_after_first_request_mb": rss_mb(),
+        "modules": len(sys.modules),
+        "lazy_not_loaded": [m for m in ("requests", "dotenv", "asyncio", "httpx") if m not in sys.modules],
+        "status": response.status_code,
+    }, out)
+"""
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _summary(values: list) -> dict:
+    return {"median": round(statistics.median(values), 2), "min": round(min(values), 2), "max": round(max(values), 2)}
+
+
+def _probe_env() -> dict:
+    return dict(os.environ, LOG_LEVEL="WARNING", KHIPU_MERCHANT_API_KEY=os.environ.get("KHIPU_MERCHANT_API_KEY", "bench"),
+                NOTIFICATIONS_DB_PATH=os.path.join(tempfile.gettempdir(), "bench_startup_notifications.db"))
+
+
+def bench_cold_start(runs: int) -> dict:
+    samples = []
+    # El resultado va a un archivo: el log de la app (hilo aparte) también escribe en stdout
+    fd, result_path = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        subprocess.check_call([sys.executable, "-c", _PROBE, result_path], cwd=PROJECT_ROOT, env=_probe_env(),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with open(result_path) as f:
+            sample = json.load(f)
+        sample["process_total_ms"] = (time.perf_counter() - t0) * 1000 # Incluye el arranque del intérprete
+        samples.append(sample)
+    os.remove(result_path)
+    keys = ("import_ms", "create_app_ms", "first_request_ms", "process_total_ms",
+            "rss_after_import_mb", "rss_after_create_app_mb", "rss_after_first_request_mb")
+    result = {key: _summary([s[key] for s in samples]) for key in keys}
+    result["runs"] = runs
+    result["modules"] = samples[-1]["modules"]
+    result["lazy_not_loaded"] = samples[-1]["lazy_not_loaded"]
+    return result
+
+
+def _proc_memory(pid: int) -> dict:
+    memory = {"pid": pid}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    memory["rss_mb"] = round(int(line.split()[1]) / 1024.0, 2)
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    memory["pss_mb"] = round(int(line.split()[1]) / 1024.0, 2)
+    except OSError:
+        pass
+    return memory
+
+
+def _children(pid: int) -> list:
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def bench_workers(workers: int, mode: str, timeout: float = 30.0) -> dict:
+    """Arranca el servidor de producción y mide tiempo hasta servir y memoria por proceso."""
+    if not os.path.exists("/proc/self/smaps_rollup"):
+        return {"skipped": "requiere /proc (Linux)"}
+    import httpx
+
+    port = _free_port()
+    env = dict(_probe_env(), PORT=str(port), WEB_CONCURRENCY=str(workers), SERVER_MODE=mode,
+               GUNICORN_LOG_LEVEL="warning")
+    t0 = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", "app.server"], cwd=PROJECT_ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        ready_ms = None
+        while time.perf_counter() - t0 < timeout:
+            try:
+                httpx.get(f"http://127.0.0.1:{port}/v3/health_check_payments", timeout=1.0)
+                ready_ms = (time.perf_counter() - t0) * 1000
+                break
+            except httpx.HTTPError:
+                time.sleep(0.02)
+        # Esperar a que todos los workers terminen de arrancar antes de medir memoria
+        deadline = time.perf_counter() + timeout
+        while len(_children(process.pid)) < workers and time.perf_counter() < deadline:
+            time.sleep(0.05)
+        time.sleep(1.0)
+        # Una solicitud por conexión nueva reparte tráfico entre workers
+        for _ in range(workers * 4):
+            try:
+                httpx.get(f"http://127.0.0.1:{port}/v3/health_check_payments", timeout=2.0)
+            except httpx.HTTPError:
+                pass
+        master = _proc_memory(process.pid)
+        worker_memory = [_proc_memory(pid) for pid in _children(process.pid)]
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    pss = [w["pss_mb"] for w in worker_memory if "pss_mb" in w]
+    return {
+        "mode": mode,
+        "workers": workers,
+        "ready_ms": round(ready_ms, 1) if ready_ms is not None else None,
+        "master": master,
+        "worker_processes": worker_memory,
+        "worker_rss_mb_median": round(statistics.median([w["rss_mb"] for w in worker_memory]), 2) if worker_memory else None,
+        "worker_pss_mb_median": round(statistics.median(pss), 2) if pss else None,
+        "total_pss_mb": round(sum(pss) + master.get("pss_mb", 0.0), 2) if pss else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de arranque en frío y memoria por worker")
+    parser.add_argument("--runs", type=int, default=10, help="Procesos nuevos a medir")
+    parser.add_argument("--workers", type=int, default=2, help="Workers del servidor de producción (0 = omitir)")
+    parser.add_argument("--mode", default="wsgi", choices=("wsgi", "asgi"), help="SERVER_MODE del servidor")
+    parser.add_argument("--output", default=None, help="Archivo JSON de resultados")
+    args = parser.parse_args()
+
+    cold = bench_cold_start(args.runs)
+    print(f"Arranque en frío ({args.runs} procesos, mediana): import {cold['import_ms']['median']} ms, "
+          f"create_app {cold['create_app_ms']['median']} ms, primera solicitud {cold['first_request_ms']['median']} ms, "
+          f"proceso completo {cold['process_total_ms']['median']} ms")
+    print(f"RSS: tras import {cold['rss_after_import_mb']['median']} MB, tras create_app "
+          f"{cold['rss_after_create_app_mb']['median']} MB, tras primera solicitud {cold['rss_after_first_request_mb']['median']} MB "
+          f"(diferidos sin cargar: {', '.join(cold['lazy_not_loaded']) or '-'})")
+
+    server = None
+    if args.workers > 0:
+        server = bench_workers(args.workers, args.mode)
+        if "skipped" in server:
+            print(f"Servidor: omitido ({server['skipped']})")
+        else:
+            print(f"Servidor {args.mode} con {args.workers} workers: listo en {server['ready_ms']} ms; "
+                  f"master RSS {server['master'].get('rss_mb')} MB; worker RSS {server['worker_rss_mb_median']} MB, "
+                  f"PSS {server['worker_pss_mb_median']} MB (mediana); PSS total {server['total_pss_mb']} MB")
+
+    if args.output:
+        report = {
+            "meta": {
+                "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+            },
+            "cold_start": cold,
+            "server": server,
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Resultados guardados en {args.output}")
+
+
+if __name__ == "__main__":
+    main()
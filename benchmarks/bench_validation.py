@@ -0,0 +1,100 @@
+# benchmarks/bench_validation.py
+"""
+Microbenchmark del costo de CPU por solicitud en el camino de creación de pagos:
+validación del payload y codificación JSON, antes (float + dict.get + stdlib json)
+y después (esquema compilado con Decimal + orjson).
+
+Uso (desde la raíz del proyecto):
+    python -m benchmarks.bench_validation [--number 20000]
+"""
+import os
+import sys
+import json
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app import json_codec
+from app.services.khipu_service import _prepare_khipu_payload
+
+SAMPLE_REQUEST = {
+    "subject": "Pago de Prueba ARS",
+    "amount": "150.75",
+    "currency": "ARS",
+    "transaction_id": "TX-MIAPP-12345",
+    "payer_email": "comprador.prueba@example.com",
+    "return_url": "https://mi-aplicacion.com/pago/retorno",
+    "cancel_url": "https://mi-aplicacion.com/pago/cancelado",
+    "notify_url": "https://mi-webhook-publico.com/khipu/notificacion",
+    "expires_date": "2030-01-31T23:59:59Z",
+}
+SAMPLE_RESPONSE = {
+    "payment_id": "gqzdy6chjne9",
+    "payment_url": "https://khipu.com/payment/info/gqzdy6chjne9",
+    "simplified_transfer_url": "https://app.khipu.com/payment/simplified/gqzdy6chjne9",
+    "transfer_url": "https://khipu.com/payment/manual/gqzdy6chjne9",
+    "app_url": "khipu:///pos/gqzdy6chjne9",
+    "ready_for_terminal": False,
+}
+
+
+def legacy_prepare_khipu_payload(client_data: dict) -> dict:
+    """Copia de la validación original (float + dict.get + comprensión), como referencia."""
+    subject = client_data.get("subject")
+    amount_str = client_data.get("amount")
+    currency = client_data.get("currency")
+    if not all([subject, amount_str, currency]):
+        raise ValueError("Faltan campos obligatorios")
+    if currency != "ARS":
+        raise ValueError("Moneda no válida")
+    amount = float(amount_str)
+    if amount <= 0:
+        raise ValueError("El monto debe ser mayor que cero")
+    payload = {
+        "subject": subject,
+        "amount": amount,
+        "currency": currency,
+        "transaction_id": client_data.get("transaction_id"),
+        "custom": client_data.get("custom"),
+        "body": client_data.get("body"),
+        "payer_email": client_data.get("payer_email"),
+        "return_url": client_data.get("return_url"),
+        "cancel_url": client_data.get("cancel_url"),
+        "notify_url": client_data.get("notify_url"),
+        "picture_url": client_data.get("picture_url"),
+        "notify_api_version": client_data.get("notify_api_version", "1.3"),
+        "expires_date": client_data.get("expires_date"),
+    }
+    return {k: v for k, v in payload.items() if v is not None}
+
+
+def _per_call_us(fn, number: int) -> float:
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=20000, help="Iteraciones por medición")
+    args = parser.parse_args()
+
+    request_bytes = json.dumps(SAMPLE_REQUEST).encode()
+    results = {
+        "validate (antes: float, sin checks de formato)": _per_call_us(lambda: legacy_prepare_khipu_payload(SAMPLE_REQUEST), args.number),
+        "validate (después: esquema compilado + Decimal)": _per_call_us(lambda: _prepare_khipu_payload(SAMPLE_REQUEST), args.number),
+        "decode request (stdlib json)": _per_call_us(lambda: json.loads(request_bytes), args.number),
+        "encode response (stdlib json, como jsonify)": _per_call_us(lambda: json.dumps(SAMPLE_RESPONSE, sort_keys=True), args.number),
+    }
+    if json_codec.orjson is not None:
+        orjson = json_codec.orjson
+        results["decode request (orjson)"] = _per_call_us(lambda: orjson.loads(request_bytes), args.number)
+        results["encode response (orjson)"] = _per_call_us(
+            lambda: orjson.dumps(SAMPLE_RESPONSE, option=orjson.OPT_SORT_KEYS), args.number)
+
+    width = max(len(name) for name in results)
+    for name, micros in results.items():
+        print(f"{name:<{width}}  {micros:8.2f} µs/op")
+
+
+if __name__ == "__main__":
+    main()
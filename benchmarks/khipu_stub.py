@@ -0,0 +1,176 @@
+# benchmarks/khipu_stub.py
+"""
+Servidor local que imita la API v3 de Khipu para pruebas de carga.
+
+Atiende POST /v3/payments (crea un pago ficticio) y GET /v3/payments/<id>
+(estado del pago), con latencia, tasa de errores y tasa de timeouts configurables.
+
+Uso:
+    python -m benchmarks.khipu_stub --port 9000 --latency-ms 80 --jitter-ms 20 --error-rate 0.01
+
+y en el servicio: KHIPU_TARGET_API_URL=http://127.0.0.1:9000
+"""
+import json
+import time
+import uuid
+import random
+import socket
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class StubConfig:
+    def __init__(self, latency_ms=50.0, jitter_ms=0.0, error_rate=0.0, timeout_rate=0.0, timeout_s=60.0,
+                 api_key=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_s = timeout_s
+        self.api_key = api_key
+
+
+class StubStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.connections = 0
+
+    def add(self, field: str):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def as_dict(self) -> dict:
+        return {"requests": self.requests, "errors": self.errors, "timeouts": self.timeouts,
+                "connections": self.connections}
+
+
+class KhipuStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive, como la API real
+    server_version = "KhipuStub/1.0"
+
+    def setup(self):
+        super().setup()
+        # Sin Nagle: cabeceras y cuerpo salen en escrituras separadas y, con delayed ACK,
+        # cada respuesta sumaría ~40 ms que no existen en la API real
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.stats.add("connections")
+
+    def log_message(self, format, *args):
+        pass # Sin log por solicitud: distorsionaría la medición
+
+    def _send_json(self, status: int, data: dict):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _simulate(self) -> bool:
+        """Aplica latencia, timeouts y errores. Devuelve False si ya respondió con error."""
+        config = self.server.config
+        self.server.stats.add("requests")
+        if config.api_key and self.headers.get("x-api-key") != config.api_key:
+            self._send_json(401, {"status": 401, "message": "API key inválida"})
+            return False
+        roll = random.random()
+        if roll < config.timeout_rate:
+            self.server.stats.add("timeouts")
+            time.sleep(config.timeout_s)
+        latency = max(config.latency_ms + random.uniform(-config.jitter_ms, config.jitter_ms), 0.0)
+        time.sleep(latency / 1000.0)
+        if config.timeout_rate <= roll < config.timeout_rate + config.error_rate:
+            self.server.stats.add("errors")
+            self._send_json(503, {"status": 503, "message": "Servicio no disponible (stub)"})
+            return False
+        return True
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        if self.path.rstrip("/") != "/v3/payments":
+            self._send_json(404, {"status": 404, "message": "No encontrado"})
+            return
+        if not self._simulate():
+            return
+        try:
+            payload = json.loads(raw or b"{}")
+        except ValueError:
+            self._send_json(400, {"status": 400, "message": "JSON inválido"})
+            return
+        missing = [f for f in ("subject", "amount", "currency") if f not in payload]
+        if missing:
+            self._send_json(400, {"status": 400, "message": "Faltan campos",
+                                  "errors": [{"field": f, "message": "requerido"} for f in missing]})
+            return
+        payment_id = uuid.uuid4().hex[:12]
+        self._send_json(201, {
+            "payment_id": payment_id,
+            "payment_url": f"https://khipu.com/payment/info/{payment_id}",
+            "simplified_transfer_url": f"https://app.khipu.com/payment/simplified/{payment_id}",
+            "transfer_url": f"https://khipu.com/payment/manual/{payment_id}",
+            "app_url": f"khipu:///pos/{payment_id}",
+            "ready_for_terminal": False,
+        })
+
+    def do_GET(self):
+        if self.path == "/__stats":
+            self._send_json(200, self.server.stats.as_dict())
+            return
+        if not self.path.startswith("/v3/payments/"):
+            self._send_json(404, {"status": 404, "message": "No encontrado"})
+            return
+        if not self._simulate():
+            return
+        payment_id = self.path.rsplit("/", 1)[-1]
+        self._send_json(200, {"payment_id": payment_id, "status": "pending", "status_detail": "pending"})
+
+
+class KhipuStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024 # Backlog amplio para concurrencias altas
+
+    def __init__(self, address, config: StubConfig):
+        super().__init__(address, KhipuStubHandler)
+        self.config = config
+        self.stats = StubStats()
+
+
+def start_in_thread(port: int = 0, config: StubConfig = None) -> KhipuStubServer:
+    """Arranca el stub en un hilo (útil desde otros scripts). `server.server_port` tiene el puerto."""
+    server = KhipuStubServer(("127.0.0.1", port), config or StubConfig())
+    threading.Thread(target=server.serve_forever, name="khipu-stub", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub local de la API v3 de Khipu")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="Latencia media por respuesta")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Variación uniforme ± de la latencia")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fracción de respuestas 503")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="Fracción de respuestas que se cuelgan")
+    parser.add_argument("--timeout-s", type=float, default=60.0, help="Duración de un 'timeout'")
+    parser.add_argument("--api-key", default=None, help="Si se indica, exige esta x-api-key")
+    args = parser.parse_args()
+
+    config = StubConfig(args.latency_ms, args.jitter_ms, args.error_rate, args.timeout_rate, args.timeout_s, args.api_key)
+    server = KhipuStubServer((args.host, args.port), config)
+    print(f"Khipu stub escuchando en http://{args.host}:{args.port} "
+          f"(latencia {args.latency_ms}±{args.jitter_ms} ms, errores {args.error_rate:.1%}, timeouts {args.timeout_rate:.1%})",
+          flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+# benchmarks/load_test.py
+"""
+Prueba de carga del servicio contra el stub local de Khipu.
+
+Levanta el stub (benchmarks/khipu_stub.py) y el servicio (por defecto `python run.py`)
+como subprocesos, y envía POST /v3/payments con concurrencia creciente. Por cada nivel
+reporta RPS, latencias p50/p95/p99 y tasa de errores, y guarda todo en un JSON para
+comparar entre versiones.
+
+Uso (desde la raíz del proyecto):
+    python -m benchmarks.load_test --concurrency 1,8,32,128 --duration 10 --output bench_results.json
+    python -m benchmarks.load_test --target http://127.0.0.1:8000   # servicio ya levantado
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import asyncio
+import argparse
+import platform
+import subprocess
+from datetime import datetime, timezone
+
+import httpx
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_http(url: str, timeout: float = 20.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} no respondió en {timeout:.0f}s")
+
+
+def _percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def _payment_body() -> dict:
+    # transaction_id único: cada solicitud debe llegar a Khipu (sin respuestas idempotentes)
+    return {
+        "subject": "Pago de carga",
+        "amount": "150.75",
+        "currency": "ARS",
+        "transaction_id": f"LOAD-{uuid.uuid4().hex}",
+        "payer_email": "carga@example.com",
+        "return_url": "https://example.com/retorno",
+        "notify_url": "https://example.com/notify",
+    }
+
+
+async def _run_level(target: str, path: str, concurrency: int, duration: float, warmup: float) -> dict:
+    """Carga de lazo cerrado: `concurrency` clientes envían una solicitud tras otra."""
+    latencies = []
+    status_codes = {}
+    transport_errors = 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=target, limits=limits, timeout=60.0) as client:
+        started = time.perf_counter()
+        measure_from = started + warmup
+        stop_at = measure_from + duration
+
+        async def worker():
+            nonlocal transport_errors
+            while True:
+                now = time.perf_counter()
+                if now >= stop_at:
+                    return
+                t0 = time.perf_counter()
+                try:
+                    response = await client.post(path, json=_payment_body())
+                    status = response.status_code
+                except httpx.HTTPError:
+                    status = None
+                t1 = time.perf_counter()
+                if t0 < measure_from:
+                    continue
+                if status is None:
+                    transport_errors += 1
+                else:
+                    status_codes[str(status)] = status_codes.get(str(status), 0) + 1
+                    latencies.append(t1 - t0)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    latencies.sort()
+    total = len(latencies) + transport_errors
+    errors = transport_errors + sum(n for code, n in status_codes.items() if not code.startswith("2"))
+    return {
+        "concurrency": concurrency,
+        "duration_s": duration,
+        "requests": total,
+        "rps": round(total / duration, 2),
+        "latency_ms": {
+            "p50": round(_percentile(latencies, 0.50) * 1000, 3),
+            "p95": round(_percentile(latencies, 0.95) * 1000, 3),
+            "p99": round(_percentile(latencies, 0.99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+        },
+        "errors": errors,
+        "error_rate": round(errors / total, 4) if total else 0.0,
+        "status_codes": status_codes,
+        "transport_errors": transport_errors,
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga de /v3/payments contra el stub de Khipu")
+    parser.add_argument("--concurrency", default="1,4,16,64", help="Niveles de concurrencia separados por coma")
+    parser.add_argument("--duration", type=float, default=10.0, help="Segundos medidos por nivel")
+    parser.add_argument("--warmup", type=float, default=2.0, help="Segundos de calentamiento por nivel (no medidos)")
+    parser.add_argument("--path", default="/v3/payments")
+    parser.add_argument("--target", default=None, help="URL de un servicio ya levantado (no se arranca ninguno)")
+    parser.add_argument("--server-cmd", default=f"{sys.executable} run.py",
+                        help="Comando para levantar el servicio; recibe PORT/FLASK_RUN_PORT por entorno")
+    parser.add_argument("--stub-latency-ms", type=float, default=50.0)
+    parser.add_argument("--stub-jitter-ms", type=float, default=10.0)
+    parser.add_argument("--stub-error-rate", type=float, default=0.0)
+    parser.add_argument("--stub-timeout-rate", type=float, default=0.0)
+    parser.add_argument("--output", default="bench_results.json", help="Archivo JSON de resultados")
+    args = parser.parse_args()
+
+    processes = []
+    target = args.target
+    try:
+        if target is None:
+            stub_port, service_port = _free_port(), _free_port()
+            processes.append(subprocess.Popen(
+                [sys.executable, "-m", "benchmarks.khipu_stub", "--port", str(stub_port),
+                 "--latency-ms", str(args.stub_latency_ms), "--jitter-ms", str(args.stub_jitter_ms),
+                 "--error-rate", str(args.stub_error_rate), "--timeout-rate", str(args.stub_timeout_rate)],
+                cwd=PROJECT_ROOT, stdout=subprocess.DEVNULL))
+            env = dict(os.environ,
+                       KHIPU_TARGET_API_URL=f"http://127.0.0.1:{stub_port}",
+                       KHIPU_MERCHANT_API_KEY=os.environ.get("KHIPU_MERCHANT_API_KEY", "bench-api-key"),
+                       FLASK_RUN_PORT=str(service_port), PORT=str(service_port),
+                       FLASK_DEBUG="0", LOG_LEVEL=os.environ.get("LOG_LEVEL", "WARNING"),
+                       # Todo el tráfico sale de un solo cliente: sin límites salvo que se pidan
+                       RATE_LIMIT_ENABLED=os.environ.get("RATE_LIMIT_ENABLED", "0"))
+            processes.append(subprocess.Popen(args.server_cmd.split(), cwd=PROJECT_ROOT, env=env,
+                                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+            target = f"http://127.0.0.1:{service_port}"
+            _wait_http(f"http://127.0.0.1:{stub_port}/__stats")
+            _wait_http(f"{target}/v3/health_check_payments")
+
+        levels = []
+        for concurrency in (int(c) for c in args.concurrency.split(",") if c.strip()):
+            result = asyncio.run(_run_level(target, args.path, concurrency, args.duration, args.warmup))
+            levels.append(result)
+            print(f"c={concurrency:<4} rps={result['rps']:<9} p50={result['latency_ms']['p50']}ms "
+                  f"p95={result['latency_ms']['p95']}ms p99={result['latency_ms']['p99']}ms "
+                  f"errores={result['error_rate']:.2%}", flush=True)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "target": args.target or args.server_cmd,
+            "path": args.path,
+            "duration_s": args.duration,
+            "warmup_s": args.warmup,
+            "stub": {"latency_ms": args.stub_latency_ms, "jitter_ms": args.stub_jitter_ms,
+                     "error_rate": args.stub_error_rate, "timeout_rate": args.stub_timeout_rate},
+        },
+        "levels": levels,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Resultados guardados en {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+# tests/test_validation.py
+import pytest
+from app.services.validation import PaymentSchema, ValidationError, payment_optional_fields
+
+SCHEMA = PaymentSchema((), allowed_currencies=("ARS", "CLP"))
+
+
+def _amount(amount, currency="ARS"):
+    return SCHEMA.validate({"subject": "Pago", "amount": amount, "currency": currency})["amount"]
+
+
+@pytest.mark.parametrize("amount, expected", [
+    ("150.75", 150.75),                 # Camino rápido
+    ("9999999999999.99", 9999999999999.99),
+    (" 150.75 ", 150.75),               # Camino general (Decimal)
+    (150.75, 150.75),
+    (123456789012345, 123456789012345),
+    ("1.5e3", 1500),
+])
+def test_amount_is_sent_exactly(amount, expected):
+    assert _amount(amount) == expected
+
+
+@pytest.mark.parametrize("amount", [
+    "12345678901234567.25",   # Ni el camino rápido ni el Decimal lo aceptan: el float cambiaría el monto
+    12345678901234567,
+    "99999999999999999999",
+    " 9999999999999999 ",
+])
+def test_amount_with_too_many_digits_is_rejected(amount):
+    with pytest.raises(ValidationError):
+        _amount(amount)
+
+
+def test_clp_amount_is_an_integer():
+    assert _amount("5000", "CLP") == 5000
+    assert _amount(5000, "CLP") == 5000
+    with pytest.raises(ValidationError):
+        _amount("5000.5", "CLP")
+
+
+@pytest.mark.parametrize("custom", ["texto", {"order": 42, "items": [1, 2]}, [1, "a"]])
+def test_custom_is_passed_through(custom):
+    schema = PaymentSchema(payment_optional_fields("3.0"), allowed_currencies=("ARS",))
+    assert schema.validate({"subject": "Pago", "amount": "10", "currency": "ARS", "custom": custom})["custom"] == custom